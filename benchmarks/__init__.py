@@ -0,0 +1,3 @@
+"""
+    Benchmarks for the heavy parts of the pipeline, run against synthetic data. See README.md in this folder.
+"""
@@ -0,0 +1,41 @@
+import argparse
+import logging
+import sys
+
+from bunnyhop import config
+from bunnyhop import profiling
+
+from . import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Times the heavy parts of bunnyhop against synthetic data")
+    parser.add_argument("--benchmark", nargs="+", choices=list(harness.BENCHMARKS), help="which benchmarks to run - defaults to all of them")
+    arcpy_only = [name for name, (setup, engines) in harness.BENCHMARKS.items() if engines == ("arcpy",)]
+    parser.add_argument("--engine", nargs="+", default=["open"], choices=["open", "arcpy"],
+                        help=f"geometry engines to run them with - {', '.join(arcpy_only)} only runs with arcpy, and is skipped for the open engine")
+    parser.add_argument("--scale", nargs="+", type=float, default=[1], help="fixture sizes, where 1 is about California's size - try 1 10 100")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark - the fastest one counts")
+    parser.add_argument("--results", default=harness.DEFAULT_RESULTS_PATH, help="JSON lines file to append the results to")
+    parser.add_argument("--threshold", type=float, default=0.1, help="how much slower than the last version counts as a regression")
+    parser.add_argument("--profile", metavar="REPORT_PATH", help="also write a profiling run report of the benchmarks here")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    config.PROFILE_ENABLED = args.profile is not None  # the profiling sections and counts add time to what we're measuring
+
+    scales = [int(scale) if scale.is_integer() else scale for scale in args.scale]
+    history = harness.load_results(args.results)
+    results = harness.run(args.benchmark, engine_names=args.engine, scales=scales, repeat=args.repeat)
+    harness.save_results(results, args.results)
+
+    comparisons = harness.compare(results, history, threshold=args.threshold)
+    harness.print_comparisons(comparisons)
+    if args.profile:
+        profiling.write_report(args.profile)
+
+    return 1 if any(comparison["regression"] for comparison in comparisons) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
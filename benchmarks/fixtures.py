@@ -0,0 +1,247 @@
+"""
+    Synthetic stand-ins for the pipeline's inputs, so the benchmarks don't need the live services and can be run at
+    more than one size.
+
+    Scale 1 is roughly California - 58 counties with 8 cities each and about 5,000 parcel-level CDTFA polygons. Higher
+    scales keep the same counties and cities and split them into more, smaller parcels, so the dissolves, joins, and
+    coastline steps see about `scale` times as many features (and vertices) as they do at scale 1.
+
+    The counties are squares laid out on a grid in California Albers (EPSG:3310), and the westmost column of them is
+    on the coast. Each county is divided into a 3 x 3 block of cities, with the last block left unincorporated, and a
+    few of its unincorporated parcels are handed out to the cities so that some cities come out multipart. Everything
+    is generated from a seeded random number generator, so a scale always produces the same data.
+
+    Each make_ function returns a Dataset - attributes, shapely geometries (None for tables), and an EPSG code - that
+    load_dataset puts into either geometry engine.
+"""
+
+import math
+import os
+
+import numpy
+import pandas
+import shapely
+
+from bunnyhop import config
+from bunnyhop import geometry_engine
+
+FIELD_NAMES = config.FIELD_NAMES
+
+COUNTY_COUNT = 58
+COUNTY_GRID_COLUMNS = 8
+COUNTY_SIZE_METERS = 50000
+CITY_BLOCKS = 3  # each county is split into CITY_BLOCKS x CITY_BLOCKS blocks - all but the last one are cities
+PARCELS_AT_SCALE_1 = 5000
+VERTICES_PER_EDGE = 8  # parcel edges get split into this many segments so the geometries have some weight to them
+ORIGIN = (-400000, -600000)
+CRS = 3310
+SEED = 2024
+
+
+class Dataset:
+
+    def __init__(self, attributes, geometry=None, crs=None):
+        self.attributes = attributes
+        self.geometry = geometry
+        self.crs = crs
+
+    def __len__(self):
+        return len(self.attributes)
+
+
+def county_name(county):
+    return f"Synthetic {county:02d} County"
+
+
+def city_name(county, city):
+    return f"Synthetic {county:02d}-{city}"
+
+
+def _county_origin(county):
+    row, column = divmod(county, COUNTY_GRID_COLUMNS)
+    return ORIGIN[0] + column * COUNTY_SIZE_METERS, ORIGIN[1] + row * COUNTY_SIZE_METERS
+
+
+def _parcels_per_side(scale):
+    per_side = math.sqrt(PARCELS_AT_SCALE_1 * scale / COUNTY_COUNT)
+    return max(CITY_BLOCKS, round(per_side / CITY_BLOCKS) * CITY_BLOCKS)  # whole blocks of parcels for each city
+
+
+def make_cdtfa(scale=1):
+    """
+        The CDTFA layer - one polygon per parcel with its county, city (or "Unincorporated"), and COPRI code, already using
+        the renamed CDTFA fields
+    """
+    random = numpy.random.default_rng(SEED)
+    per_side = _parcels_per_side(scale)
+    per_block = per_side // CITY_BLOCKS
+    parcel_size = COUNTY_SIZE_METERS / per_side
+
+    columns, rows = numpy.meshgrid(numpy.arange(per_side), numpy.arange(per_side))
+    columns, rows = columns.ravel(), rows.ravel()
+    blocks = (rows // per_block) * CITY_BLOCKS + columns // per_block
+    unincorporated_block = CITY_BLOCKS * CITY_BLOCKS - 1
+
+    counties, cities, copris, geometry = [], [], [], []
+    for county in range(COUNTY_COUNT):
+        x, y = _county_origin(county)
+        parcel_cities = blocks.copy()
+        annexed = (blocks == unincorporated_block) & (random.random(len(blocks)) < 0.05)  # some cities get an outlying piece
+        parcel_cities[annexed] = random.integers(0, unincorporated_block, annexed.sum())
+
+        for city in parcel_cities:
+            counties.append(county_name(county))
+            cities.append("Unincorporated" if city == unincorporated_block else city_name(county, city))
+            copris.append(f"{county + 1:02d}{999 if city == unincorporated_block else city:03d}")
+        geometry.append(shapely.box(x + columns * parcel_size, y + rows * parcel_size,
+                                    x + (columns + 1) * parcel_size, y + (rows + 1) * parcel_size))
+
+    geometry = shapely.segmentize(numpy.concatenate(geometry), parcel_size / VERTICES_PER_EDGE)
+    attributes = pandas.DataFrame({FIELD_NAMES['copri']: copris, FIELD_NAMES['county']: counties, FIELD_NAMES['city']: cities})
+    return Dataset(attributes, geometry, CRS)
+
+
+def coastal_counties():
+    return [county for county in range(COUNTY_COUNT) if county % COUNTY_GRID_COLUMNS == 0]
+
+
+def make_coastline(cities_counties, scale=1, width_meters=20000, overlap_meters=25):
+    """
+        Coastline exclusion polygons for the cities or the counties - a strip of ocean off the west edge of each coastal
+        place, overlapping the land a little the way the cartographic coastline does, with the place's name fields filled in
+    """
+    per_side = _parcels_per_side(scale)
+    parcel_size = COUNTY_SIZE_METERS / per_side
+    block_size = COUNTY_SIZE_METERS / CITY_BLOCKS
+
+    places = []  # (y min, y max, legal place name, place name, place type)
+    for county in coastal_counties():
+        x, y = _county_origin(county)
+        if cities_counties == "counties":
+            places.append((y, y + COUNTY_SIZE_METERS, county_name(county), county_name(county), "County"))
+        else:
+            for block_row in range(CITY_BLOCKS):
+                city = block_row * CITY_BLOCKS  # the westmost city in each row of blocks
+                if city == CITY_BLOCKS * CITY_BLOCKS - 1:
+                    continue
+                name = city_name(county, city)
+                places.append((y + block_row * block_size, y + (block_row + 1) * block_size, f"City of {name}", name, "City"))
+
+    west = ORIGIN[0]
+    geometry = shapely.segmentize(numpy.array([shapely.box(west - width_meters, y_min, west + overlap_meters, y_max) for y_min, y_max, *names in places]),
+                                  parcel_size / VERTICES_PER_EDGE)
+    attributes = pandas.DataFrame({
+        config.COASTLINE_EXCLUSION_FIELD: ["ocean"] * len(places),
+        FIELD_NAMES['legal_place_name']: [place[2] for place in places],
+        FIELD_NAMES['place_name']: [place[3] for place in places],
+        FIELD_NAMES['place_type']: [place[4] for place in places],
+    })
+    return Dataset(attributes, geometry, CRS)
+
+
+def make_slivers(scale=1, fragments_per_side=2, place_size_meters=5000, fragment_size_meters=50):
+    """
+        What the coastline union leaves for fix_slivers - for each coastal place, a land polygon and an ocean polygon that
+        share its legal place name, each with small fragments stranded inside the other one. 200 places at scale 1.
+    """
+    place_count = max(1, round(200 * scale))
+    names, geometry = [], []
+    for place in range(place_count):
+        x, y = 0, place * place_size_meters * 2  # spaced out so places don't touch each other
+        land = shapely.box(x, y, x + place_size_meters, y + place_size_meters)
+        ocean = shapely.box(x - place_size_meters, y, x, y + place_size_meters)
+
+        step = place_size_meters / (fragments_per_side + 1)
+        land_fragments = [shapely.box(x - 500, y + step * (index + 1), x - 500 + fragment_size_meters, y + step * (index + 1) + fragment_size_meters)
+                          for index in range(fragments_per_side)]
+        ocean_fragments = [shapely.box(x + 500, y + step * (index + 1), x + 500 + fragment_size_meters, y + step * (index + 1) + fragment_size_meters)
+                           for index in range(fragments_per_side)]
+
+        name = f"Synthetic Coastal Place {place}"
+        names += [name, name]
+        geometry.append(shapely.union_all([shapely.difference(land, shapely.union_all(ocean_fragments))] + land_fragments))
+        geometry.append(shapely.union_all([shapely.difference(ocean, shapely.union_all(land_fragments))] + ocean_fragments))
+
+    attributes = pandas.DataFrame({FIELD_NAMES['legal_place_name']: names, config.COASTLINE_EXCLUSION_FIELD: ["", "ocean"] * place_count})
+    return Dataset(attributes, numpy.array(geometry, dtype=object), CRS)
+
+
+def _places():
+    """
+        Every county and city name in the CDTFA fixture, with a stable number for each
+    """
+    places = []
+    for county in range(COUNTY_COUNT):
+        places.append(("county", county, None))
+        places += [("city", county, city) for city in range(CITY_BLOCKS * CITY_BLOCKS - 1)]
+    return places
+
+
+def make_gnis(scale=1, other_records_per_place=5):
+    """
+        The raw GNIS Federal Codes data, like retrieve.retrieve_gnis loads it - the California cities and counties, plus
+        records for other kinds of features and other states that processing filters out
+    """
+    random = numpy.random.default_rng(SEED)
+    records = []
+    for index, (kind, county, city) in enumerate(_places()):
+        if kind == "county":
+            records.append((index + 1, county_name(county), "Civil", "H1", "California"))
+        else:
+            records.append((index + 1, f"City of {city_name(county, city)}", "Civil", "C1", "California"))
+
+    other_count = round(len(records) * other_records_per_place * scale)
+    classes = random.choice(["Populated Place", "Civil", "Census"], other_count)
+    states = random.choice(["California", "Nevada", "Oregon"], other_count)
+    for index in range(other_count):
+        records.append((100000 + index, f"Other Place {index}", classes[index], "U6" if classes[index] == "Civil" else "", states[index]))
+
+    attributes = pandas.DataFrame(records, columns=["feature_id", "feature_name", "feature_class", "census_class_code", "state_name"])
+    return Dataset(attributes.astype({column: dtype for column, dtype in config.GNIS_COLUMNS.items()}))
+
+
+def make_census(scale=1, other_records_per_place=5):
+    """
+        The California records of the Census all-geocodes file, like retrieve.retrieve_census returns them - the counties
+        and cities plus census designated places that don't get a GEOID
+    """
+    records = []
+    for index, (kind, county, city) in enumerate(_places()):
+        county_fips = f"{county * 2 + 1:03d}"
+        if kind == "county":
+            records.append(("06", county_fips, "00000", county_name(county)))
+        else:
+            records.append(("06", county_fips, f"{index:05d}", f"{city_name(county, city)} city"))
+
+    for index in range(round(len(records) * other_records_per_place * scale)):
+        records.append(("06", f"{(index % COUNTY_COUNT) * 2 + 1:03d}", f"{50000 + index % 49999:05d}", f"Other Place {index} CDP"))
+
+    return Dataset(pandas.DataFrame(records, columns=["State_FIPS_Code", "County_FIPS_Code", "Place_FIPS_Code", "Area_Name"]))
+
+
+def make_dla():
+    """
+        The DLA place abbreviations table, keyed on the Census place name
+    """
+    records = []
+    for kind, county, city in _places():
+        name = county_name(county) if kind == "county" else city_name(county, city)
+        records.append((name, f"C{county:02d}{'' if city is None else city}", f"CO{county:02d}"))
+    return Dataset(pandas.DataFrame(records, columns=["CENSUS_PLACE_NAME", FIELD_NAMES['place_abbr'], FIELD_NAMES['cnty_abbr']]))
+
+
+def load_dataset(engine, name, dataset):
+    """
+        Puts a fixture into a geometry engine as name, replacing anything already there, and returns what to call it by -
+        the name for the open engine, or a full path in the current workspace for the arcpy engine
+    """
+    if isinstance(engine, geometry_engine.OpenEngine):
+        engine.from_frame(name, dataset.attributes, dataset.geometry, crs=dataset.crs)
+        return name
+
+    import arcpy
+    staging = geometry_engine.OpenEngine()  # it already knows how to write shapely geometries out with arcpy
+    staging.from_frame(name, dataset.attributes, dataset.geometry, crs=dataset.crs)
+    path = os.path.join(arcpy.env.workspace, name)
+    staging.export(name, path)
+    return path
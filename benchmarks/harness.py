@@ -0,0 +1,308 @@
+"""
+    Times the heavy parts of the pipeline against the synthetic fixtures and keeps the results, so a slowdown between
+    versions shows up as a regression instead of a vague feeling that runs take longer.
+
+    Each benchmark has a setup, which isn't timed, and a run, which is. Setups give every repeat fresh copies of its
+    inputs, since most of the steps change their datasets in place. A benchmark's result is its fastest repeat.
+
+    Results are appended to a JSON lines file, one record per benchmark, engine, and scale, along with the bunnyhop
+    version, git commit, and machine they came from. compare lines each new result up against the most recent result
+    from a different version or commit on the same machine.
+"""
+
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from bunnyhop import __version__
+from bunnyhop import bunny
+from bunnyhop import coastline
+from bunnyhop import config
+from bunnyhop import geometry_engine
+from bunnyhop import parallel
+from bunnyhop import profiling
+
+from . import fixtures
+
+log = logging.getLogger("bunnyhop.benchmarks")
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "results.jsonl")
+
+
+class Workbench:
+    """
+        The fixtures for one engine and scale, loaded into the engine once and shared by the benchmarks. The later steps
+        of the pipeline need the earlier ones' outputs, so those get built the first time a benchmark asks for them.
+    """
+
+    def __init__(self, engine_name, scale):
+        self.engine_name = engine_name
+        self.scale = scale
+        if engine_name == "arcpy":
+            folder = os.path.join(tempfile.gettempdir(), "bunnyhop_benchmarks")
+            parallel.create_scratch_workspace(folder, f"scale_{str(scale).replace('.', '_')}")
+        self.engine = geometry_engine.get_engine(engine_name)
+        self._loaded = {}
+        self._pathways = None
+        self._joined = None
+
+    def dataset(self, name, make):
+        """
+            Returns the name of a fixture in the engine, making and loading it the first time it's asked for
+        """
+        if name not in self._loaded:
+            self._loaded[name] = fixtures.load_dataset(self.engine, name, make())
+        return self._loaded[name]
+
+    def fresh_copy(self, dataset, name):
+        """
+            Copies a dataset for one repeat of a benchmark to change
+        """
+        self.engine.delete(name)
+        self.engine.copy(dataset, name)
+        return name
+
+    def runner(self):
+        runner = bunny.CDTFARetrieve(detect_changes=False, partition_by_county=False, engine=self.engine)
+        runner.gnis_table = self.dataset("gnis_table", lambda: fixtures.Dataset(bunny.process_gnis_frame(fixtures.make_gnis(self.scale).attributes)))
+        runner.census_table = self.dataset("census_table", lambda: fixtures.Dataset(bunny.process_census_frame(fixtures.make_census(self.scale).attributes)))
+        runner.dla_source_table = self.dataset("dla_table", lambda: fixtures.Dataset(fixtures.make_dla().attributes))
+        return runner
+
+    def pathways(self):
+        """
+            The cities and counties after the dissolves, as they go into the joins
+        """
+        if self._pathways is None:
+            runner = self.runner()
+            runner.cdtfa_input_path = self.fresh_copy(self.dataset("cdtfa", lambda: fixtures.make_cdtfa(self.scale)), "prepared_cdtfa")
+            runner.cities_pathway()
+            runner.counties_pathway()
+            self._pathways = (self.fresh_copy(runner.cities_output_path, "prepared_cities"),
+                              self.fresh_copy(runner.counties_output_path, "prepared_counties"))
+        return self._pathways
+
+    def joined(self):
+        """
+            The cities and counties after the joins, as they go into the coastline cut
+        """
+        if self._joined is None:
+            runner = self.runner()
+            runner.cities_output_path, runner.counties_output_path = self.pathways()
+            runner.run_joins()  # joins into new datasets, so the pathways stay as they were
+            self._joined = (runner.cities_output_path, runner.counties_output_path)
+        return self._joined
+
+
+def _process_gnis(bench):
+    raw = fixtures.make_gnis(bench.scale).attributes
+    return len(raw), lambda: bunny.process_gnis_frame(raw.copy())
+
+
+def _process_census(bench):
+    raw = fixtures.make_census(bench.scale).attributes
+    return len(raw), lambda: bunny.process_census_frame(raw.copy())
+
+
+def _pathways(bench):
+    runner = bench.runner()
+    runner.cdtfa_input_path = bench.fresh_copy(bench.dataset("cdtfa", lambda: fixtures.make_cdtfa(bench.scale)), "cdtfa_input")
+
+    def run():
+        runner.cities_pathway()
+        runner.counties_pathway()
+    return bench.engine.count(runner.cdtfa_input_path), run
+
+
+def _run_joins(bench):
+    runner = bench.runner()
+    cities, counties = bench.pathways()
+
+    def run():
+        runner.cities_output_path, runner.counties_output_path = cities, counties
+        runner.run_joins()
+    return bench.engine.count(cities) + bench.engine.count(counties), run
+
+
+def _coastal_cut(bench):
+    cities, counties = bench.joined()
+    inputs = {
+        "cities": (bench.fresh_copy(cities, "cities_coastal"), bench.dataset("coastline_cities", lambda: fixtures.make_coastline("cities", bench.scale))),
+        "counties": (bench.fresh_copy(counties, "counties_coastal"), bench.dataset("coastline_counties", lambda: fixtures.make_coastline("counties", bench.scale))),
+    }
+
+    def run():
+        for cities_counties, (features, coastal_layer) in inputs.items():
+            coastline.coastal_cut(features, f"{cities_counties}_cut", cities_counties, log, coastal_layer=coastal_layer, engine=bench.engine)
+    return bench.engine.count(cities) + bench.engine.count(counties), run
+
+
+def _fix_slivers(bench):
+    slivers = bench.fresh_copy(bench.dataset("slivers", lambda: fixtures.make_slivers(bench.scale)), "slivers_working")
+    return bench.engine.count(slivers), lambda: bench.engine.fix_slivers(slivers)
+
+
+def _reconcile_parts(bench):
+    """
+        Just the geometry work of the arcpy sliver fix, without the cursors around it
+    """
+    import arcpy
+    from bunnyhop import spatial_index
+
+    slivers = bench.dataset("slivers", lambda: fixtures.make_slivers(bench.scale))
+    places = {}
+    sr = geometry_engine.arcpy_spatial_reference(config.COASTLINE_CHECK_SR)
+    with arcpy.da.SearchCursor(slivers, ["SHAPE@", config.FIELD_NAMES['legal_place_name'], "OID@"], spatial_reference=sr) as cursor:
+        for row in cursor:
+            places.setdefault(row[1], []).append(list(row))
+    keep_fragment_geoms = coastline.keep_fragment_geometries()
+    keep_fragment_index = spatial_index.STRTree([geometry_engine.arcpy_envelope(geom) for geom in keep_fragment_geoms])
+
+    def run():
+        for rows in places.values():
+            coastline.reconcile_parts(rows, keep_fragment_geoms, config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS,
+                                      keep_fragment_index=keep_fragment_index)
+    return sum(len(rows) for rows in places.values()), run
+
+
+# name -> (setup, engines it runs on). A setup takes a Workbench and returns the number of input records and a function to time
+BENCHMARKS = {
+    "process_gnis": (_process_gnis, ("open", "arcpy")),
+    "process_census": (_process_census, ("open", "arcpy")),
+    "pathways": (_pathways, ("open", "arcpy")),
+    "run_joins": (_run_joins, ("open", "arcpy")),
+    "coastal_cut": (_coastal_cut, ("open", "arcpy")),
+    "fix_slivers": (_fix_slivers, ("open", "arcpy")),
+    "reconcile_parts": (_reconcile_parts, ("arcpy",)),
+}
+
+
+def git_commit():
+    """
+        Returns the commit the benchmarks are running against, or None outside of a git checkout
+    """
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run_benchmark(name, bench, repeat=3):
+    """
+        Runs one benchmark repeat times and returns a result record for its fastest run
+    """
+    setup, engines = BENCHMARKS[name]
+    best = None
+    for attempt in range(repeat):
+        records, run = setup(bench)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        run()
+        timing = (time.perf_counter() - wall_start, time.process_time() - cpu_start)
+        if best is None or timing[0] < best[0]:
+            best = timing
+
+    return {
+        "benchmark": name,
+        "engine": bench.engine_name,
+        "scale": bench.scale,
+        "records": records,
+        "wall_seconds": best[0],
+        "cpu_seconds": best[1],
+        "repeat": repeat,
+        "peak_rss_bytes": profiling.peak_rss_bytes(),  # for the whole process so far, so it only ever goes up
+        "version": __version__,
+        "commit": git_commit(),
+        "machine": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "finished": datetime.datetime.now().isoformat(),
+    }
+
+
+def run(names=None, engine_names=("open",), scales=(1,), repeat=3):
+    """
+        Runs the benchmarks for every engine and scale
+
+    Args:
+        names (list, optional): which benchmarks to run. Defaults to all of them
+        engine_names (tuple, optional): which geometry engines to run them with. Benchmarks that don't apply to an engine are skipped
+        scales (tuple, optional): fixture sizes, where 1 is about the size of California's data
+        repeat (int, optional): how many times to run each benchmark - the fastest run counts
+
+    Returns:
+        list: result records
+    """
+    results = []
+    for engine_name in engine_names:
+        for scale in scales:
+            bench = Workbench(engine_name, scale)
+            for name in names or BENCHMARKS:
+                if engine_name not in BENCHMARKS[name][1]:
+                    continue
+                log.info(f"Running {name} with the {engine_name} engine at scale {scale}")
+                result = run_benchmark(name, bench, repeat=repeat)
+                log.info(f"{name}: {result['wall_seconds']:.3f}s ({result['cpu_seconds']:.3f}s CPU) for {result['records']} records")
+                results.append(result)
+    return results
+
+
+def load_results(path=DEFAULT_RESULTS_PATH) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def save_results(results, path=DEFAULT_RESULTS_PATH):
+    """
+        Appends result records to the JSON lines file at path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as results_file:
+        for result in results:
+            results_file.write(json.dumps(result) + "\n")
+
+
+def compare(results, history, threshold=0.1) -> list:
+    """
+        Lines up each result with the most recent result in history for the same benchmark, engine, scale, and machine
+        from a different version or commit
+
+    Args:
+        threshold (float, optional): how much slower (as a fraction) counts as a regression
+
+    Returns:
+        list: a dictionary for each result that has something to compare against - the result, the baseline, the ratio of
+            their wall times, and whether it's a regression
+    """
+    comparisons = []
+    for result in results:
+        key = (result["benchmark"], result["engine"], result["scale"], result["machine"])
+        baselines = [previous for previous in history
+                     if (previous["benchmark"], previous["engine"], previous["scale"], previous["machine"]) == key
+                     and (previous["version"], previous["commit"]) != (result["version"], result["commit"])]
+        if not baselines:
+            continue
+        baseline = max(baselines, key=lambda previous: previous["finished"])
+        ratio = result["wall_seconds"] / baseline["wall_seconds"] if baseline["wall_seconds"] else None
+        comparisons.append({"result": result, "baseline": baseline, "ratio": ratio,
+                            "regression": ratio is not None and ratio > 1 + threshold})
+    return comparisons
+
+
+def print_comparisons(comparisons, out=sys.stdout):
+    for comparison in comparisons:
+        result, baseline = comparison["result"], comparison["baseline"]
+        flag = "  REGRESSION" if comparison["regression"] else ""
+        ratio = f"{comparison['ratio']:.2f}x" if comparison["ratio"] is not None else "n/a"
+        print(f"{result['benchmark']} ({result['engine']}, scale {result['scale']}): {result['wall_seconds']:.3f}s vs "
+              f"{baseline['wall_seconds']:.3f}s in {baseline['version']} ({baseline['commit']}) - {ratio}{flag}", file=out)
@@ -1,3 +1,4 @@
+import argparse
 import sys
 import logging
 
@@ -6,11 +7,17 @@ from . import bunny
 
 
 def main():
-    config.startup()
+    parser = argparse.ArgumentParser(prog="bunnyhop", description="Builds the California city and county boundary layers")
+    parser.add_argument("--resume", action="store_true",
+                        help="pick up the last run at the first stage whose inputs changed or whose outputs are missing")
+    args = parser.parse_args()
+
+    config.startup(resume=args.resume)
     log = logging.getLogger("bunnyhop")
 
     output_folder = config.FOLDER_WORKSPACE
-    bunny.flow(output_folder)
+    bunny.flow(output_folder, resume=args.resume)
 
 
-sys.exit(main())
\ No newline at end of file
+if __name__ == "__main__":  # worker processes import this module too, and they shouldn't start a run of their own
+    sys.exit(main())
@@ -10,150 +10,198 @@
 import logging
 import pathlib
 import os
-import json
 
 from . import config
 from . import retrieve
 from . import coastline
 from . import primary_domain
 from . import census_population
-
-import arcpy
-import arcgis
+from . import change_detection
+from . import derived_fields
+from . import download_cache
+from . import geometry_engine
+from . import parallel
+from . import profiling
+from . import rule_engine
+from . import stages
+
+import numpy
 import pandas
 
+try:
+    import arcpy
+except ImportError:  # the open engine runs without ArcGIS - change detection and the worker processes need arcpy
+    arcpy = None
 
-def process_gnis(local_gnis_table, adjustments=config.GNIS_ADJUSTMENTS, field_names=config.FIELD_NAMES):
-    # copy the GNIS table out of Excel in one shot - we'll get more predictable outputs
-    # this way rather than trying to query/select an Excel table
-    log = logging.getLogger("bunnyhop")
 
-    log.info("Beginning GNIS processing")
-    log.debug("Loading GNIS data into ArcGIS table")
-    gnis_raw_input_table = "gnis_raw_input"
-    arcpy.management.CopyRows(in_rows=local_gnis_table, out_table=gnis_raw_input_table)
+def frame_to_table(df, out_table, in_memory=config.WORKSPACE_TIERED, text_length=255):
+    """
+        Writes a pandas data frame out to a table in the current workspace in a single pass.
+        Text columns are converted to fixed-width unicode so that ArcGIS can build the schema from the array. The width becomes
+        the field's length, and the join fields carry it on to the outputs, so it's at least text_length - otherwise a later
+        adjustment or derived value longer than anything in this data wouldn't fit.
+
+    Args:
+        df (pandas.DataFrame): the data to write
+        out_table (str): name of the table to create in the current workspace. Replaced if it already exists
+        in_memory (bool, optional): write the table to the memory workspace instead - the lookup tables are small and only needed during the run
+        text_length (int, optional): the shortest length to give text fields. Longer values get a field as long as they are.
+
+    Returns:
+        str: the name of the table that was written, or its full path when it's in memory
+    """
+    columns = []
+    for column_name in df.columns:
+        column = df[column_name]
+        if pandas.api.types.is_numeric_dtype(column) and not pandas.api.types.is_bool_dtype(column):
+            if column.hasnans:  # ArcGIS can't take nullable integers in from numpy, so send them as floats instead
+                columns.append(column.to_numpy(dtype="float64", na_value=numpy.nan))
+            else:
+                columns.append(column.to_numpy())
+        else:
+            text = column.astype(object).where(column.notna(), "").astype(str)
+            width = max(int(text.str.len().max()) if len(text) else 0, text_length)
+            columns.append(text.to_numpy(dtype=f"<U{width}"))
 
-    log.debug("Filtering GNIS data to California")
-    gnis_filtered_table = "gnis_filtered"
-    arcpy.analysis.TableSelect(in_table=gnis_raw_input_table, out_table=gnis_filtered_table, where_clause="state_name = 'California' And feature_class = 'Civil' And (census_class_code = 'H1' Or census_class_code = 'C1')")
-
-    log.debug("Adding LEGAL_PLACE_NAME field")
-    arcpy.management.AddField(in_table=gnis_filtered_table, field_name=field_names['legal_place_name'], field_type="Text", field_is_nullable=True)
-    arcpy.management.AddField(in_table=gnis_filtered_table, field_name=field_names['gnis_id'], field_type="LONG", field_is_nullable=True)
-    arcpy.management.AddField(in_table=gnis_filtered_table, field_name="GNIS_JOIN_NAME", field_type="Text", field_is_nullable=True)
-
-    calc_field_code_block = """
-def split_name(classcode, name):
-    if classcode=="C1":
-        return name.split(" ",2)[2]
-    elif classcode == "H1":
-        return name
-    else:
-        return name
+    records = numpy.rec.fromarrays(columns, names=[str(name) for name in df.columns])
+
+    out_path = os.path.join("memory" if in_memory else arcpy.env.workspace, out_table)
+    if arcpy.Exists(out_path):
+        arcpy.management.Delete(out_path)
+    arcpy.da.NumPyArrayToTable(records, out_path)
+
+    return out_path if in_memory else out_table
+
+
+def process_gnis_frame(gnis_df, adjustments=config.GNIS_ADJUSTMENTS, field_names=config.FIELD_NAMES):
     """
+        Does all of the GNIS processing on a data frame with vectorized column operations - filters to California
+        cities and counties, then derives the join name, legal place name, and GNIS ID and applies the hard-coded adjustments.
+
+    Args:
+        gnis_df (pandas.DataFrame): the GNIS Federal Codes data, as loaded by retrieve.retrieve_gnis
+        adjustments (dict, optional): dictionary of field names to dictionaries of values to replace. Defaults to config.GNIS_ADJUSTMENTS.
+        field_names (dict, optional): Defaults to config.FIELD_NAMES.
+
+    Returns:
+        pandas.DataFrame: the filtered data with the new fields added
+    """
+    log = logging.getLogger("bunnyhop")
+
+    log.debug("Filtering GNIS data to California")
+    keep = (gnis_df["state_name"] == "California") & (gnis_df["feature_class"] == "Civil") & (gnis_df["census_class_code"].isin(["H1", "C1"]))
+    gnis_filtered = gnis_df.loc[keep].reset_index(drop=True)
 
     log.debug("Filling in GNIS_JOIN_NAME field")
-    arcpy.management.CalculateField(in_table=gnis_filtered_table,
-                                      field="GNIS_JOIN_NAME",
-                                      expression="split_name(!census_class_code!,!feature_name!)",
-                                      expression_type="PYTHON3",
-                                      code_block=calc_field_code_block
-                                    )
-    
-    log.debug(f"Filling in {field_names['legal_place_name']} field")
-    arcpy.management.CalculateField(in_table=gnis_filtered_table,
-                                      field=field_names['legal_place_name'],
-                                      expression="!feature_name!",
-                                      expression_type="PYTHON3",
-                                    )
-    
-    log.debug(f"Filling in {field_names['gnis_id']} field")
-    arcpy.management.CalculateField(in_table=gnis_filtered_table,
-                                      field=field_names['gnis_id'],
-                                      expression="!feature_id!",
-                                      expression_type="PYTHON3",
-                                    )
-    
+    # cities come in as "City of ..." or "Town of ..." - drop the first two words. Counties get used as-is
+    feature_names = gnis_filtered["feature_name"].astype(str)
+    is_city = gnis_filtered["census_class_code"] == "C1"
+    gnis_filtered["GNIS_JOIN_NAME"] = feature_names.where(~is_city, feature_names.str.split(" ", n=2).str[2])
+
+    log.debug(f"Filling in {field_names['legal_place_name']} and {field_names['gnis_id']} fields")
+    gnis_filtered[field_names['legal_place_name']] = feature_names
+    gnis_filtered[field_names['gnis_id']] = gnis_filtered["feature_id"].astype("int32")  # becomes a LONG field in the geodatabase
+
     log.debug("Postprocessing GNIS with hard-coded adjustments")
-    
-    # ok, so this if funky. We have a dictionary of adjustments we want to use to make one-off changes to fields.
-    # but we need to get that dictionary into ArcGIS's Python *as text* and then into a usable Python object.
-    # so we'll dump it to json, embed that into a string, and then when ArcGIS executes
-    # that Python, it'll have the dictionary representation.
-    for field_name in adjustments:
-        adjustments_json = json.dumps(adjustments[field_name])  # dump the set of adjustments for this field to json
-        adjustments_code_block = f"import json;replacement_dict = json.loads('{adjustments_json}')"  # make a string that, when executed as python, would load that data back into a dict
-        # then add that at the beginning of the code block
-        replacement_code_block = adjustments_code_block + """
-
-def replace_values(field_value):
-    if field_value in replacement_dict:
-        return replacement_dict[field_value]
+    rule_engine.AdjustmentRules.compile(replacements=[adjustments]).apply_to_frame(gnis_filtered)
+
+    return gnis_filtered
+
+
+@profiling.profiled()
+def process_gnis(local_gnis_table, adjustments=config.GNIS_ADJUSTMENTS, field_names=config.FIELD_NAMES):
+    """
+        Processes the GNIS data in memory and writes the result out to the workspace once at the end.
+
+    Args:
+        local_gnis_table (pandas.DataFrame or str): the GNIS data frame from retrieve.retrieve_gnis, or a path to a CSV copy of it
+        adjustments (dict, optional): Defaults to config.GNIS_ADJUSTMENTS.
+        field_names (dict, optional): Defaults to config.FIELD_NAMES.
+
+    Returns:
+        str: name of the processed GNIS table in the current workspace
+    """
+    log = logging.getLogger("bunnyhop")
+
+    log.info("Beginning GNIS processing")
+    if isinstance(local_gnis_table, pandas.DataFrame):
+        gnis_df = local_gnis_table
     else:
-        return field_value
-"""
+        log.debug("Loading GNIS data from CSV")
+        gnis_df = pandas.read_csv(str(local_gnis_table))
 
-        # now run the value replacement for this field
-        arcpy.management.CalculateField(gnis_filtered_table,
-                                        field_name,
-                                        expression=f"replace_values(!{field_name}!)",
-                                        expression_type="PYTHON3",
-                                        code_block=replacement_code_block)
+    gnis_filtered = process_gnis_frame(gnis_df, adjustments=adjustments, field_names=field_names)
+    profiling.record_input("gnis", features=len(gnis_df))
+    profiling.record_output("gnis_table", features=len(gnis_filtered))
+
+    log.debug("Writing GNIS table")
+    gnis_filtered_table = frame_to_table(gnis_filtered, "gnis_filtered")
 
     log.info("GNIS processing complete")
     return gnis_filtered_table
 
-def process_census(local_census_table, field_names=config.FIELD_NAMES):
-    # copy the GNIS table out of Excel in one shot - we'll get more predictable outputs
-    # this way rather than trying to query/select an Excel table
+def process_census_frame(census_df, field_names=config.FIELD_NAMES):
+    """
+        Derives the place type, place name, and GEOID fields on the California Census data with vectorized string operations
 
+    Args:
+        census_df (pandas.DataFrame): California records from the Census all-geocodes file, as returned by retrieve.retrieve_census
+        field_names (dict, optional): Defaults to config.FIELD_NAMES.
+
+    Returns:
+        pandas.DataFrame: the Census data with the new fields added
+    """
     log = logging.getLogger("bunnyhop")
-    log.info("Beginning Census processing")
-    log.debug("Loading Census data into ArcGIS table")
-    census_input_table = "census_input"
-    arcpy.management.CopyRows(in_rows=str(local_census_table), out_table=census_input_table)
 
-    log.debug("Adding Census fields")
-    arcpy.management.AddField(in_table=census_input_table, field_name=field_names['place_type'], field_type="Text", field_is_nullable=True)
-    arcpy.management.AddField(in_table=census_input_table, field_name=field_names['place_name'], field_type="Text", field_is_nullable=True)
-    arcpy.management.AddField(in_table=census_input_table, field_name=field_names['geoid'], field_type="Text", field_is_nullable=True)
+    census = census_df.reset_index(drop=True)
+    area_names = census["Area_Name"].astype(str)
 
     log.debug(f"Calculating {field_names['place_type']}")
-    arcpy.management.CalculateField(in_table=census_input_table,
-                                    field=field_names['place_type'],
-                                    expression="!Area_Name!.split()[-1].capitalize()",
-                                    expression_type="PYTHON3")
-    
-    place_name_code_block = """def place_name(area, type):
-    if type == "County":
-        return area
-    else:
-        return area.rsplit(" ", 1)[0]   
-    """
-    
+    place_type = area_names.str.split().str[-1].str.capitalize()
+    census[field_names['place_type']] = place_type
+
     log.debug(f"Calculating {field_names['place_name']}")
-    arcpy.management.CalculateField(in_table=census_input_table,
-                                    field=field_names['place_name'],
-                                    expression=f"place_name(!Area_Name!, !{field_names['place_type']}!)",
-                                    expression_type="PYTHON3",
-                                    code_block=place_name_code_block
-                                )
-    
-    type_id_code_block = """def type_id(ptype, state, county, place):
-    if ptype=="County":
-        return f"{state:02}{county:03}"
-    elif ptype == "Town" or ptype == "City":
-        return f"{state:02}{place:05}"
-    """
+    is_county = place_type == "County"
+    census[field_names['place_name']] = area_names.where(is_county, area_names.str.rsplit(" ", n=1).str[0])
 
     log.debug("Calculating Census GEOID")
-    arcpy.management.CalculateField(in_table=census_input_table,
-                                    field=field_names['geoid'],
-                                    expression=f"type_id(!{field_names['place_type']}!, !State_FIPS_Code!,!County_FIPS_Code!,!Place_FIPS_Code!)",
-                                    expression_type="PYTHON3",
-                                    code_block=type_id_code_block
-                                )
-    
+    state = census["State_FIPS_Code"].astype(str).str.zfill(2)
+    county = census["County_FIPS_Code"].astype(str).str.zfill(3)
+    place = census["Place_FIPS_Code"].astype(str).str.zfill(5)
+    is_city = place_type.isin(["Town", "City"])
+    geoid = pandas.Series(None, index=census.index, dtype=object)
+    census[field_names['geoid']] = geoid.mask(is_county, state + county).mask(is_city, state + place)  # anything else (CDPs, etc) gets no GEOID
+
+    return census
+
+
+@profiling.profiled()
+def process_census(local_census_table, field_names=config.FIELD_NAMES):
+    """
+        Processes the Census data in memory and writes the result out to the workspace once at the end.
+
+    Args:
+        local_census_table (pandas.DataFrame or str): the California Census data frame from retrieve.retrieve_census, or a path to a CSV copy of it
+        field_names (dict, optional): Defaults to config.FIELD_NAMES.
+
+    Returns:
+        str: name of the processed Census table in the current workspace
+    """
+    log = logging.getLogger("bunnyhop")
+    log.info("Beginning Census processing")
+    if isinstance(local_census_table, pandas.DataFrame):
+        census_df = local_census_table
+    else:
+        log.debug("Loading Census data from CSV")
+        census_df = pandas.read_csv(str(local_census_table), dtype=str)  # keep the leading zeros on the FIPS codes
+
+    census = process_census_frame(census_df, field_names=field_names)
+    profiling.record_input("census", features=len(census_df))
+    profiling.record_output("census_table", features=len(census))
+
+    log.debug("Writing Census table")
+    census_input_table = frame_to_table(census, "census_input")
+
     log.info("Census processing complete")
 
     return census_input_table
@@ -174,17 +222,31 @@ class CDTFARetrieve:
                   reproject_to=config.REPROJECT_TO,
                   calculate_area_in_crs=config.CALCULATE_AREA_IN_CRS,
                   calculate_area_units_user=config.CALCULATE_AREA_UNITS_USER,
-                  calculate_area_units=config.CALCULATE_AREA_UNITS):
+                  calculate_area_units=config.CALCULATE_AREA_UNITS,
+                  detect_changes=config.CDTFA_CHANGE_DETECTION,
+                  partition_by_county=config.CDTFA_PARTITION_BY_COUNTY,
+                  engine=None):
         self.layer_url = source_layer
         self.log = logging.getLogger("bunnyhop")
+        self.engine = engine or geometry_engine.get_engine()
         self.adjustments=adjustments
+        self.adjustment_rules = rule_engine.AdjustmentRules.compile(conditional=adjustments)
 
         self.cdtfa_input_path = None
 
         self.cities_output_path = None
         self.counties_output_path = None
+        self.unincorporated_output_path = None
         self.merged_output_path = None
 
+        # change detection and county partitioning keep their data in geodatabases, so they only work with the arcpy engine
+        self.detect_changes = detect_changes and self.engine.supports_worker_processes
+        self.partition_by_county = partition_by_county and self.engine.supports_worker_processes
+        self.run_state = change_detection.RunState()
+        self.fingerprint = None
+        self.rebuild_counties = None  # when set, only these counties are rebuilt and the rest come from the last successful run
+        self.unchanged = False  # set when nothing changed since the last successful run and we reused its outputs
+
         self.census_table = None
         self.gnis_table = None
         self.dla_source_table = None
@@ -195,58 +257,300 @@ class CDTFARetrieve:
         self.calculate_area_units_user = calculate_area_units_user
         self.calculate_area_units=calculate_area_units
 
+    @profiling.profiled()
     def retrieve_and_process(self, census_table, gnis_table, dla_source_table):
         self.census_table = census_table
         self.gnis_table = gnis_table
         self.dla_source_table = dla_source_table
 
         self.log.info("Beginning CDTFA Layer processing")
+        stages.StageRunner(self, self.engine).run(self.stages())
+
+    def stages(self) -> list:
+        """
+            The CDTFA processing chain as stages for stages.StageRunner. Once we find nothing changed since the last successful run,
+            the stages after the retrieval don't run.
+        """
+        outputs = ("cities_output_path", "counties_output_path", "unincorporated_output_path", "merged_output_path")
+        changed = lambda: not self.unchanged
+        return [
+            stages.Stage("retrieve_cdtfa_layer", self.retrieve_and_check_for_changes,
+                         inputs=("census_table", "gnis_table", "dla_source_table"),
+                         outputs=("cdtfa_input_path", "fingerprint", "rebuild_counties", "unchanged") + outputs,
+                         datasets=("cdtfa_input_path",) + outputs,
+                         settings=lambda: {"layer_url": self.layer_url, "edit_date": download_cache.layer_edit_date(self.layer_url),
+                                           "field_map": config.CDTFA_FIELD_MAP, "detect_changes": self.detect_changes}),
+            stages.Stage("process_cdtfa_layer", self.process_cdtfa_layer, when=changed,
+                         inputs=("cdtfa_input_path", "rebuild_counties"),
+                         outputs=("cdtfa_input_path", "cities_output_path", "counties_output_path"),
+                         datasets=("cities_output_path", "counties_output_path"),
+                         settings=lambda: {"field_names": self.field_names, "field_map": config.CDTFA_FIELD_MAP, "engine": self.engine.name}),
+            stages.Stage("run_joins", self.run_joins, when=changed,
+                         inputs=("cities_output_path", "counties_output_path", "census_table", "gnis_table", "dla_source_table"),
+                         outputs=("cities_output_path", "counties_output_path"),
+                         datasets=("cities_output_path", "counties_output_path"),
+                         settings=lambda: {"field_names": self.field_names, "adjustments": self.adjustments}),
+            stages.Stage("coastal_cut", self.add_fields_and_reproject_both, when=changed,
+                         inputs=("cities_output_path", "counties_output_path"),
+                         outputs=("cities_output_path", "counties_output_path"),
+                         datasets=("cities_output_path", "counties_output_path"),
+                         settings=self._coastal_settings),
+            stages.Stage("unincorporated", self.generate_unincorporated_areas, when=changed,
+                         inputs=("cities_output_path", "counties_output_path"),
+                         outputs=("unincorporated_output_path",),
+                         datasets=("unincorporated_output_path",),
+                         settings=lambda: {"area": [geometry_engine.spatial_reference_text(self.calculate_area_in_crs), self.calculate_area_units]}),
+            stages.Stage("merge", self.finish, when=changed,
+                         inputs=outputs[:3] + ("rebuild_counties", "fingerprint"),
+                         outputs=outputs,
+                         datasets=outputs),
+        ]
+
+    def _coastal_settings(self):
+        settings = self._branch_settings()
+        settings.pop("memory_budget_bytes")
+        settings.update({
+            "layer_url": config.COASTLINE_LAYER_URL,
+            "cities_exclude": config.COASTLINE_CITIES_EXCLUDE,
+            "counties_exclude": config.COASTLINE_COUNTIES_EXCLUDE,
+            "sliver_fix": config.COASTLINE_SLIVER_FIX,
+            "sliver_threshold": config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS,
+            "targeted_overlay": config.COASTLINE_TARGETED_OVERLAY,
+        })
+        return settings
+
+    @profiling.profiled()
+    def retrieve_and_check_for_changes(self):
+        """
+            Retrieves the CDTFA layer, and when change detection is on, reuses the last successful run's outputs if nothing changed since then
+        """
         self.retrieve_cdtfa_layer()
-        self.process_cdtfa_layer()
-        self.run_joins()
-        self.add_fields_and_reproject_both()
-        self.generate_unincorporated_areas()
+
+        self.unchanged = self.detect_changes and not self.check_for_changes()
+        if self.unchanged:
+            self.restore_previous_outputs()
+
+    @profiling.profiled()
+    def finish(self):
+        """
+            Builds the final cities, counties, and unincorporated areas from the earlier stages' outputs (adding in the unchanged
+            counties from the last successful run when we only rebuilt some), merges the cities and counties, writes the outputs
+            to the workspace geodatabase, and records the run for change detection. The final outputs are new datasets, so
+            running this again doesn't change what the earlier stages made.
+        """
+        final_names = self.final_names()
+        if self.rebuild_counties is not None:
+            self.splice_previous_outputs(final_names)
+        else:
+            for output_type, name in final_names.items():
+                self.engine.copy(self.outputs[output_type], name)
+
+        self.cities_output_path = final_names["cities"]
+        self.counties_output_path = final_names["counties"]
+        self.unincorporated_output_path = final_names["unincorporated"]
+
         self.merge()
+        self.export_outputs()
+
+        if self.detect_changes:
+            self.run_state.save(self.fingerprint, self.outputs)
+
+    @property
+    def outputs(self):
+        return {
+            "cities": self.cities_output_path,
+            "counties": self.counties_output_path,
+            "unincorporated": self.unincorporated_output_path,
+            "merged": self.merged_output_path,
+        }
+
+    @profiling.profiled()
+    def check_for_changes(self):
+        """
+            Fingerprints the CDTFA layer and the lookup tables and compares them to the last successful run. If only a few
+            counties changed, sets self.rebuild_counties so that only those get processed.
+
+        Returns:
+            bool: False if nothing changed since the last successful run, otherwise True
+        """
+        self.log.debug("Checking CDTFA layer for changes")
+        previous_state = self.run_state.load()
+        previous = previous_state["fingerprint"] if previous_state else None
+
+        edit_date = download_cache.layer_edit_date(self.layer_url)
+        inputs_hash = change_detection.fingerprint_inputs([self.census_table, self.gnis_table, self.dla_source_table],
+                                                          settings={"cdtfa_adjust": self.adjustments,
+                                                                    "gnis_adjustments": config.GNIS_ADJUSTMENTS,
+                                                                    "census_adjustments": config.CENSUS_ADJUSTMENTS,
+                                                                    "field_names": self.field_names,
+                                                                    "reproject_to": geometry_engine.epsg_code(self.reproject_to)})
+
+        if previous and edit_date is not None and previous["edit_date"] == edit_date:
+            # the layer hasn't been edited, so we don't need to hash it again
+            features = {"count": previous["count"], "partitions": previous["partitions"]}
+        else:
+            features = change_detection.fingerprint_features(str(self.cdtfa_input_path), self._source_field_name(self.field_names['county']))
+        self.fingerprint = dict(features, edit_date=edit_date, inputs=inputs_hash)
+
+        if previous is None:
+            self.log.info("No previous run to compare against - processing the full CDTFA layer")
+            return True
+        if previous["inputs"] != inputs_hash:
+            self.log.info("Lookup tables or settings changed since the last successful run - processing the full CDTFA layer")
+            return True
+
+        changed_counties = change_detection.changed_partitions(previous, self.fingerprint)
+        if not changed_counties:
+            self.log.info("Nothing changed since the last successful run")
+            return False
+
+        if len(changed_counties) > config.CDTFA_INCREMENTAL_MAX_COUNTIES:
+            self.log.info(f"{len(changed_counties)} counties changed since the last successful run - processing the full CDTFA layer")
+        else:
+            self.log.info(f"Only rebuilding changed counties: {', '.join(sorted(changed_counties))}")
+            self.rebuild_counties = sorted(changed_counties)
+        return True
+
+    @profiling.profiled()
+    def restore_previous_outputs(self):
+        """
+            Copies the outputs of the last successful run into the workspace and points this run's outputs at them
+        """
+        self.log.info("Reusing outputs from the last successful run")
+        previous_outputs = self.run_state.load()["outputs"]
+        for name in previous_outputs.values():
+            arcpy.management.Copy(self.run_state.output_path(name), os.path.join(self.engine.workspace, name))
+
+        self.cities_output_path = previous_outputs["cities"]
+        self.counties_output_path = previous_outputs["counties"]
+        self.unincorporated_output_path = previous_outputs["unincorporated"]
+        self.merged_output_path = previous_outputs["merged"]
+
+    def final_names(self) -> dict:
+        """
+            The names of the final cities, counties, and unincorporated areas - the cities and counties get the code of the
+            CRS we reproject them into
+        """
+        suffix = f"_{geometry_engine.epsg_code(self.reproject_to)}" if self.reproject_to is not None else ""
+        return {
+            "cities": f"cities_final{suffix}",
+            "counties": f"counties_final{suffix}",
+            "unincorporated": "unincorporated_final_3310",
+        }
+
+    @profiling.profiled()
+    def splice_previous_outputs(self, final_names):
+        """
+            After rebuilding only the changed counties, merges them with every other county from the last successful run's
+            outputs into final_names. The merged output gets built from the spliced cities and counties afterward.
+        """
+        self.log.info("Adding unchanged counties from the last successful run")
+        previous_outputs = self.run_state.load()["outputs"]
+        for output_type, name in final_names.items():
+            unchanged = f"{name}_unchanged"
+            self.engine.select(self.run_state.output_path(previous_outputs[output_type]), unchanged,
+                               (self.field_names['county'], "NOT IN", self.rebuild_counties))
+            self.engine.merge([self.outputs[output_type], unchanged], name)
+            self.engine.delete(unchanged)
+
+    def _limit_to_counties(self, counties):
+        self.log.debug("Selecting out changed counties")
+        changed_counties = "cdtfa_changed_counties"
+        self.engine.select(self.cdtfa_input_path, changed_counties, (self._source_field_name(self.field_names['county']), "IN", counties))
+        self.cdtfa_input_path = changed_counties
+
+    def _source_field_name(self, field_name, field_map=config.CDTFA_FIELD_MAP):
+        """
+            Returns the name a CDTFA field has on the source data right now - the original name before the fields get renamed, the new one after
+        """
+        if field_name in self.engine.field_names(self.cdtfa_input_path):
+            return field_name
+        return [source for source, renamed in field_map.items() if renamed == field_name][0]
 
+    @profiling.profiled(outputs=("cdtfa_input_path",))
     def retrieve_cdtfa_layer(self):
         self.log.debug("Retrieving CDTFA Layer")
-        portal = arcgis.GIS("https://arcgis.com")  # not really sure we need this
-        feature_layer = arcgis.features.FeatureLayer(self.layer_url)
-        features = feature_layer.query()
-        features.save(arcpy.env.workspace, "cdtfa_source_data")
+        cdtfa_input_path = pathlib.PurePath(self.engine.workspace) / "cdtfa_source_data"
+        # the checkpoint goes in the folder holding the workspace geodatabase so an interrupted download can be resumed
+        checkpoint_path = os.path.join(os.path.dirname(self.engine.workspace), config.CDTFA_CHECKPOINT_NAME)
+        from_cache = self.engine.fetch_layer(self.layer_url, str(cdtfa_input_path), checkpoint_path=checkpoint_path, field_map=config.CDTFA_FIELD_MAP)
 
-        self.log.debug("CDTFA Layer Retrieved")
-        self.cdtfa_input_path = pathlib.PurePath(arcpy.env.workspace) / "cdtfa_source_data"
+        self.log.debug(f"CDTFA Layer Retrieved{' from cache' if from_cache else ''}")
+        self.cdtfa_input_path = cdtfa_input_path
 
+    @profiling.profiled()
     def process_cdtfa_layer(self, repair_geometry_first=True):
-        
-        # in many situations, we want to start by repairing the geometry - some of the rings may be broken
-        if repair_geometry_first:
-            # operates in place, so we can keep the same path
-            arcpy.management.RepairGeometry(str(self.cdtfa_input_path), delete_null=False)
 
-        if int(arcpy.management.GetCount(str(self.cdtfa_input_path))[0]) < config.CDTFA_FLAG_INCOMPLETE_RECORD_COUNT:
+        if self.engine.count(self.cdtfa_input_path) < config.CDTFA_FLAG_INCOMPLETE_RECORD_COUNT:
             raise ValueError("CDTFA layer has insufficient record count - this typically means they changed the layer IDs on their services and we're now pulling in the wrong data. Find the correct service URL with layer ID and replace it in the configuration.")
 
+        # the repair and the renames change the layer in place, so we work on a copy and leave the retrieved layer as it was
+        if self.rebuild_counties is not None:  # check the count on the full layer before we cut it down
+            self._limit_to_counties(self.rebuild_counties)
+        else:
+            self.engine.copy(self.cdtfa_input_path, "cdtfa_working")
+            self.cdtfa_input_path = "cdtfa_working"
+
+        # in many situations, we want to start by repairing the geometry - some of the rings may be broken
+        if repair_geometry_first:
+            # operates in place on our copy, so we can keep the same path
+            self.engine.repair(self.cdtfa_input_path)
+
         self.rename_cdtfa_fields()
 
-        self.cities_pathway()
-        self.counties_pathway()
+        if self.partition_by_county:
+            self.county_partitioned_pathways()
+        else:
+            self.cities_pathway()
+            self.counties_pathway()
+
+    @profiling.profiled(inputs=("cdtfa_input_path",), outputs=("cities_output_path", "counties_output_path"))
+    def county_partitioned_pathways(self):
+        """
+            Runs the cities and counties pathways separately for each county in worker processes, then merges the results.
+            Each worker writes into its own scratch geodatabase in a "partitions" folder next to the workspace. The layer is split
+            up by county here first, so each worker only reads its own county's features.
+        """
+        county_field = self.field_names['county']
+        counties = sorted(set(row[0] for row in self.engine.rows(self.cdtfa_input_path, [county_field])))
+
+        self.log.info(f"Processing cities and counties for {len(counties)} counties in parallel")
+        scratch_folder = os.path.join(os.path.dirname(self.engine.workspace), "partitions")
+        partitions = [os.path.join(parallel.create_scratch_geodatabase(scratch_folder, f"county_{index}"), "cdtfa_partition")
+                      for index in range(len(counties))]
+        self.engine.split(self.cdtfa_input_path, county_field, dict(zip(counties, partitions)))
+        results = parallel.map_in_processes(_process_county_partition,
+                                            [(partition, index, scratch_folder) for index, partition in enumerate(partitions)])
+
+        self.log.debug("Merging county partitions")
+        cities_dissolved = "cities_dissolved"
+        counties_working = "counties_working"
+        for cities, counties, sections in results:
+            profiling.adopt(sections)
+        self.engine.merge([cities for cities, counties, sections in results], cities_dissolved)
+        self.engine.merge([counties for cities, counties, sections in results], counties_working)
+
+        self.cities_output_path = cities_dissolved
+        self.counties_output_path = counties_working
 
+    @profiling.profiled()
     def rename_cdtfa_fields(self, field_map=config.CDTFA_FIELD_MAP):
         """
-            We want to prefix CDTFA field names. The simplest way in the pipeline is to just do it up front, then delete the old names and use the new ones
-        Returns:
+            We want to prefix CDTFA field names. The simplest way in the pipeline is to just do it up front and use the new names from then on.
+            Normally the fields are already renamed while the layer is downloaded, and otherwise the engine renames them into text fields.
         """
 
+        existing_fields = self.engine.field_names(self.cdtfa_input_path)
         for field in field_map:
             existing_field = field
             new_field = field_map[field]
 
-            arcpy.management.AddField(str(self.cdtfa_input_path), new_field, "TEXT", field_is_nullable=True)
-            arcpy.management.CalculateField(str(self.cdtfa_input_path), new_field, f"!{existing_field}!", "PYTHON")
-            arcpy.management.DeleteField(str(self.cdtfa_input_path), existing_field)
+            if new_field in existing_fields:  # renamed on download
+                continue
+
+            self.engine.rename_field(self.cdtfa_input_path, existing_field, new_field)
 
+    @profiling.profiled(inputs=("cdtfa_input_path",), outputs=("cities_output_path",))
     def cities_pathway(self):
         """
             We want multipart features - one record with possibly many polygons - for each city.
@@ -256,43 +560,19 @@ class CDTFARetrieve:
         self.log.info("Beginning processing cities")
         self.log.debug("Selecting out cities")
         cities_working = "cities_working"
-        arcpy.analysis.Select(in_features=str(self.cdtfa_input_path),
-                                out_feature_class=cities_working,
-                                where_clause=f"{self.field_names['city']} <> 'Unincorporated'"
-        )
+        self.engine.select(self.cdtfa_input_path, cities_working, (self.field_names['city'], "<>", "Unincorporated"))
 
         self.log.debug("Dissolving cities")
         cities_dissolved = "cities_dissolved"
-        arcpy.management.Dissolve(cities_working,
-                                    out_feature_class=cities_dissolved,
-                                    dissolve_field=";".join([self.field_names['city'], self.field_names['copri']]),
-                                    multi_part=True
-        )
+        self.engine.dissolve(cities_working, cities_dissolved, [self.field_names['city'], self.field_names['copri']], multi_part=True)
 
         # Join the county name back on
         self.log.debug("Attaching county name to cities")
-        arcpy.management.JoinField(cities_dissolved,
-                                    in_field=self.field_names['city'],
-                                    join_table=str(self.cdtfa_input_path),
-                                    join_field=self.field_names['city'],
-                                    fields=self.field_names['county'],
-                                    index_join_fields="NEW_INDEXES"
-        )
-
-        self.log.debug(f"Adding {self.field_names['place_name']} field")
-        arcpy.management.AddField(in_table=cities_dissolved,
-                                  field_name=self.field_names['place_name'],
-                                  field_type="Text",
-                                  field_is_nullable=True
-        )
-
-        self.log.debug(f"Calculating {self.field_names['place_name']} field")
-        arcpy.management.CalculateField(cities_dissolved,
-                                        self.field_names['place_name'],
-                                        f"!{self.field_names['city']}!")
+        self.engine.join_field(cities_dissolved, self.field_names['city'], self.cdtfa_input_path, self.field_names['city'], [self.field_names['county']])
 
         self.cities_output_path = cities_dissolved
 
+    @profiling.profiled(inputs=("cdtfa_input_path",), outputs=("counties_output_path",))
     def counties_pathway(self):
         """
             For the counties data, we do two dissolves. The first one dissolves everything in
@@ -304,174 +584,186 @@ class CDTFARetrieve:
 
         self.log.debug("Selecting out counties")
         counties_copri_working = "counties_copri_working"
-        arcpy.analysis.Select(in_features=str(self.cdtfa_input_path),
-                                out_feature_class=counties_copri_working,
-                                where_clause=f"{self.field_names['city']} = 'Unincorporated'"
-                            )
+        self.engine.select(self.cdtfa_input_path, counties_copri_working, (self.field_names['city'], "=", "Unincorporated"))
         
         self.log.debug("Dissolving counties to get COPRI IDs")
         counties_copri_ids = "counties_copri_ids"
-        arcpy.management.Dissolve(counties_copri_working,
-                                    out_feature_class=counties_copri_ids,
-                                    dissolve_field=";".join([self.field_names['county'], self.field_names['copri']]),
-                                )
+        self.engine.dissolve(counties_copri_working, counties_copri_ids, [self.field_names['county'], self.field_names['copri']])
         
         self.log.debug("Dissolving counties to get full boundary")
         counties_working = "counties_working"
-        arcpy.management.Dissolve(in_features=str(self.cdtfa_input_path),
-                                    out_feature_class=counties_working,
-                                    dissolve_field=self.field_names['county']
-                                )
+        self.engine.dissolve(self.cdtfa_input_path, counties_working, [self.field_names['county']])
         
         self.log.debug("Attaching county COPRI IDs")
-        arcpy.management.JoinField(
-            in_data=counties_working,
-            in_field=self.field_names['county'],
-            join_table=counties_copri_ids,
-            join_field=self.field_names['county'],
-            fields=self.field_names['copri'],
-            index_join_fields="NEW_INDEXES"
-        )
-        
-        self.log.debug(f"Adding {self.field_names['place_name']} field to county")
-        arcpy.management.AddField(in_table=counties_working,
-                                  field_name=self.field_names['place_name'],
-                                  field_type="Text",
-                                  field_is_nullable=True
-        )
-
-        self.log.debug(f"Calculating County {self.field_names['place_name']} field")
-        arcpy.management.CalculateField(counties_working,
-                                        self.field_names['place_name'],
-                                        f"!{self.field_names['county']}!")
+        self.engine.join_field(counties_working, self.field_names['county'], counties_copri_ids, self.field_names['county'], [self.field_names['copri']])
         
         self.counties_output_path = counties_working
         
+    @profiling.profiled()
     def run_joins(self):
         """
-            Joins the data to both the cities and counties layers
+            Joins the data to copies of the cities and counties layers, leaving the processed layers as they were
         """
         #self.log.debug("Merging DLA Tables")
         #arcpy.Merge_management([self.dla_cities_table, self.dla_counties_table], "dla_merged")
-        self.log.debug("Downloading DLA Table")
-        arcpy.CopyRows_management(self.dla_source_table, "dla_source_data")
+        self.log.debug("Loading lookup tables")
+        lookups = [
+            load_lookup(self.engine, self.census_table, self.field_names['place_name'], [self.field_names['geoid'], self.field_names['place_type']]),
+            load_lookup(self.engine, self.gnis_table, "GNIS_JOIN_NAME", [self.field_names['legal_place_name'], self.field_names['gnis_id']]),
+            load_lookup(self.engine, self.dla_source_table, "CENSUS_PLACE_NAME", [self.field_names['place_abbr'], self.field_names['cnty_abbr']]),
+        ]
 
         self.log.debug("Joining Tables")
-        self._join_individual(self.cities_output_path, dla_table="dla_source_data")
-        self._join_individual(self.counties_output_path, dla_table="dla_source_data")
-        self.add_cdt_name_field()
+        cities_joined = "cities_joined"
+        counties_joined = "counties_joined"
+        self.engine.copy(self.cities_output_path, cities_joined)
+        self.engine.copy(self.counties_output_path, counties_joined)
+        self._join_individual(cities_joined, self.field_names['city'], lookups)
+        self._join_individual(counties_joined, self.field_names['county'], lookups)
 
+        self.cities_output_path = cities_joined
+        self.counties_output_path = counties_joined
+
+    @profiling.profiled(inputs=("cities_output_path", "counties_output_path"), outputs=("cities_output_path", "counties_output_path"))
     def add_fields_and_reproject_both(self):
         """
-            Just controls reprojecting both the cities and counties layers and setting the new output paths,
-            then adding and calculating the area field onto each one. Meant to be used in the main pipeline.
+            Just controls the coastline cut, area field, and reprojection for both the cities and counties layers and setting
+            the new output paths. Meant to be used in the main pipeline. The cities and counties branches don't depend on each
+            other, so with the arcpy engine they run side by side in worker processes, each in its own scratch geodatabase in a
+            "branches" folder next to the workspace, and both results get copied back into the workspace before we build the
+            unincorporated areas. Engines that keep their data in memory run the branches one after the other in this process.
         """
 
         self.log.info("Performing Coastline Cut")
-        cities_output = "cities_final"
-        counties_output = "counties_final"
-        coastline.coastal_cut(self.cities_output_path, cities_output, "cities", log=self.log)
-        coastline.coastal_cut(self.counties_output_path, counties_output, "counties", log=self.log)
-        self.cities_output_path = cities_output
-        self.counties_output_path = counties_output
+        provider = coastline.get_provider()
+        scratch_folder = os.path.join(os.path.dirname(self.engine.workspace), "branches")
+        settings = self._branch_settings()
+
+        tasks = {}
+        for cities_counties, features, exclude, drop_fields in (
+                ("cities", self.cities_output_path, config.COASTLINE_CITIES_EXCLUDE, []),
+                ("counties", self.counties_output_path, config.COASTLINE_COUNTIES_EXCLUDE, [self.field_names['place_abbr']])):
+            if self.engine.supports_worker_processes:
+                features = self.engine.on_disk(features)  # the workers can't see this process's memory workspace
+
+            # get the coastline polygons here so the branches can share them instead of both retrieving them
+            coastal_layer = provider.get(exclude, out_sr=self.engine.spatial_reference_code(features), engine=self.engine)
+            if self.engine.supports_worker_processes:
+                tasks[cities_counties] = parallel.Task(_coastal_branch, (features, cities_counties, coastal_layer, scratch_folder, drop_fields, settings))
+            else:
+                tasks[cities_counties] = self.coastal_branch(features, cities_counties, coastal_layer, drop_fields)
+
+        if self.engine.supports_worker_processes:
+            results = {}
+            self.log.debug("Copying cities and counties back into the workspace")
+            for cities_counties, (branch_output, sections) in parallel.run_graph(tasks).items():
+                profiling.adopt(sections)
+                self.engine.copy(branch_output, os.path.basename(branch_output))
+                results[cities_counties] = branch_output
+        else:
+            results = tasks
+
+        self.cities_output_path = os.path.basename(results["cities"])
+        self.counties_output_path = os.path.basename(results["counties"])
+
+    @profiling.profiled()
+    def coastal_branch(self, features, cities_counties, coastal_layer, drop_fields):
+        """
+            Cuts the coastline out of the cities or counties, then adds the area field and GlobalIDs and reprojects them
+
+        Returns:
+            str: name of the finished features
+        """
+        output = f"{cities_counties}_coastal"
+        coastline.coastal_cut(features, output, cities_counties, log=self.log, coastal_layer=coastal_layer, engine=self.engine)
 
         # note, we're adding the area fields before reprojecting because that way the area field is
         # before the Shape_Length and Shape_Area fields that GIS practitioners commonly associate with being
         # the end of the attributes. This is safe because we explicitly pass the CRS we want to calculate the
         # area in while calculating the area, so we know it's in an equal area projection even if the dataset
         # isn't currently in an equal area projection itself.
-        self.add_and_calculate_area_field(self.cities_output_path)
-        self.add_and_calculate_area_field(self.counties_output_path)
+        self.add_and_calculate_area_field(output)
 
-        self.add_guids()  # we add them, but we don't use them - they're just to make sure offline sync works
+        self.engine.add_global_ids([output])  # we add them, but we don't use them - they're just to make sure offline sync works
 
-        self.cities_output_path = self.reproject(self.cities_output_path)
-        self.counties_output_path = self.reproject(self.counties_output_path)
+        output = self.reproject(output)
+        self.engine.delete_fields(output, drop_fields)
 
-        arcpy.management.DeleteField(self.counties_output_path, [self.field_names['place_abbr']])
+        return output
 
+    def _branch_settings(self):
+        """
+            The settings a worker needs to rebuild this object's area, reprojection, and memory options - spatial references go across
+            as strings, and the two branches split the memory budget
+        """
+        memory = getattr(self.engine, "memory", None)
+        return {
+            "memory_budget_bytes": memory.budget_bytes // 2 if memory is not None else None,
+            "reproject_to": geometry_engine.spatial_reference_text(self.reproject_to),
+            "calculate_area_in_crs": geometry_engine.spatial_reference_text(self.calculate_area_in_crs),
+            "calculate_area_units_user": self.calculate_area_units_user,
+            "calculate_area_units": self.calculate_area_units,
+        }
+
+    @profiling.profiled(inputs=("cities_output_path", "counties_output_path"), outputs=("unincorporated_output_path",))
     def generate_unincorporated_areas(self):
         self.log.info("Generating unincorporated areas")
-        unincorporated_areas = "unincorporated_final_3310"
-        arcpy.analysis.Erase(self.counties_output_path, self.cities_output_path, unincorporated_areas)
-
-        arcpy.management.AddField(unincorporated_areas, self.field_names["city"], "TEXT", field_length=255)  # 255 length to be fully compatible with other CDTFA_CITY fields
-        arcpy.management.CalculateField(unincorporated_areas, self.field_names["city"], "'Unincorporated'")
-        self.add_and_calculate_area_field(unincorporated_areas)  # update the area calculations now that we've erased the cities
+        unincorporated_areas = "unincorporated_areas"
+        self.unincorporated_output_path = unincorporated_areas
+        self.engine.erase(self.counties_output_path, self.cities_output_path, unincorporated_areas)
+
+        self.engine.calculate_fields(unincorporated_areas, [
+            derived_fields.constant(self.field_names["city"], "Unincorporated", length=255),  # 255 length to be fully compatible with other CDTFA_CITY fields
+            self.area_field(),  # update the area calculations now that we've erased the cities
+        ])
         
         #arcpy.management.CalculateField(unincorporated_areas, self.field_names['county'], f"prepend(!{self.field_names['county']}!)", "PYTHON3",
         #                            """def prepend(val): return "Unincorporated " + str(val)""")
 
-    def add_cdt_name_field(self):
-        self.log.debug("Adding CDT Name Field")
-        arcpy.management.AddField(self.cities_output_path, self.field_names["name_short"], "TEXT", field_length=255)
-        arcpy.management.AddField(self.counties_output_path, self.field_names["name_short"], "TEXT", field_length=255)
-
-        field_names_adjustment = """
-def strip_extra(value):
-    value = value.replace('City of ', '')        
-    value = value.replace('Town of ', '')
-    value = value.replace(" County", '')
-    
-    return value
-"""
-
-        arcpy.management.CalculateField(self.cities_output_path, self.field_names["name_short"], f"strip_extra(!{self.field_names['legal_place_name']}!)", "PYTHON3", field_names_adjustment)
-        arcpy.management.CalculateField(self.counties_output_path, self.field_names["name_short"], f"strip_extra(!{self.field_names['legal_place_name']}!)", "PYTHON3", field_names_adjustment)
-
-    def add_guids(self):
-        self.log.debug("Adding GUIDs")
-        arcpy.management.AddGlobalIDs([self.cities_output_path, self.counties_output_path])
-
-    def _join_individual(self, layer, dla_table, counties=False):
+    def _join_individual(self, layer, place_name_source, lookups):
         """
         We do three joins of external data - this will join all three to the appropriate layer
-        based on the matching fields. We could merge the data once beforehand then join these once
-        but then we need to split it back out. I chose this path.
+        based on the matching fields. The lookup tables are small, so rather than running JoinField (which indexes
+        and rewrites the layer each time), we fill in the place name, the joined fields, the adjustments from the config,
+        and the short name in one pass with the engine's calculate_fields.
+        Like JoinField, when a name matches more than one record in a lookup table, the first one wins.
         Args:
             layer (_type_): Path to a feature class for cities or counties - it'll be either self.cities_output_path
                 or self.counties_output_path
+            place_name_source (str): the field to take the place name from - the city field for cities, the county field for counties
+            lookups (list): lookup tables from load_lookup, all keyed on the place name
         """
 
-        arcpy.management.JoinField(
-            layer,
-            in_field=self.field_names['place_name'],
-            join_table=self.census_table,
-            join_field=self.field_names['place_name'],
-            fields=";".join([self.field_names['geoid'],self.field_names['place_type']]),
-            index_join_fields="NEW_INDEXES"
-        )
-
-        arcpy.management.JoinField(
-            layer,
-            in_field=self.field_names['place_name'],
-            join_table=self.gnis_table,
-            join_field="GNIS_JOIN_NAME",
-            fields=";".join([self.field_names['legal_place_name'],self.field_names['gnis_id']]),
-            index_join_fields="NEW_INDEXES"
-        )
-
-        arcpy.management.JoinField(
-            layer,
-            in_field=self.field_names["place_name"],
-            join_table=dla_table,
-            join_field="CENSUS_PLACE_NAME",
-            fields=";".join([self.field_names['place_abbr'],self.field_names['cnty_abbr']]),
-            index_join_fields="NEW_INDEXES"
-        )
-
-        # we need to run this after the joins because it can fix values that are joined in
-        self.fix_individual_values(layer)
-
-        primary_domain.add_primary_domain(layer)
-        census_population.add_population(layer)
+        place_name = self.field_names['place_name']
+        legal_place_name = self.field_names['legal_place_name']
 
+        steps = [derived_fields.copy_of(place_name, place_name_source)]
+        steps += [field for lookup in lookups for field in lookup_fields(lookup, place_name)]
+        steps.append(self.adjustment_rules)  # we need to run this after the joins because it can fix values that are joined in
+        steps.append(derived_fields.DerivedField(self.field_names["name_short"], "TEXT",
+                                                 lambda values: strip_extra(values[legal_place_name]),
+                                                 sources=(legal_place_name,), length=255))
+        self.engine.calculate_fields(layer, steps)
+
+        primary_domain.add_primary_domain(layer, engine=self.engine)
+        census_population.add_population(layer, engine=self.engine)
+
+    @profiling.profiled(outputs=("merged_output_path",))
     def merge(self):
         merged_layer = "cities_counties_merged_3310"
-        arcpy.management.Merge([self.cities_output_path, self.counties_output_path], merged_layer)
+        self.engine.merge([self.cities_output_path, self.counties_output_path], merged_layer)
 
         self.merged_output_path = merged_layer
 
+    @profiling.profiled()
+    def export_outputs(self):
+        """
+            Writes the final outputs into the workspace geodatabase. Intermediates stay wherever the engine keeps them - with the
+            arcpy engine everything is already in the workspace, so this doesn't do anything.
+        """
+        for name in self.outputs.values():
+            self.engine.export(name, os.path.join(self.engine.workspace, name))
+
     def reproject(self, features):
         """
             Reprojects the provided data into the CRS provided in the config
@@ -483,80 +775,172 @@ def strip_extra(value):
             _type_: provided input if self.reproject_to is None, otherwise, the name of a new set of features in the current workspace with the CRS ID (EPSG code) appended to the name
         """
         if self.reproject_to is not None:
-            projection_code = self.reproject_to.factoryCode
+            projection_code = geometry_engine.epsg_code(self.reproject_to)
 
             base_name = os.path.split(features)[1]
             new_name = f"{base_name}_{str(projection_code)}"
             
             # we may want to provide an ability to specify the transformation for
             # the reprojection, but I don't think that's necessary now.
-            arcpy.management.Project(in_dataset=features,
-                                     out_dataset=new_name,
-                                     out_coor_system=self.reproject_to)
+            self.engine.project(features, new_name, self.reproject_to)
             return new_name
         else:
             return features
 
+    def area_field(self):
+        return self.engine.area_field(f"AREA_{self.calculate_area_units_user}".upper(), self.calculate_area_in_crs, self.calculate_area_units)
+
     def add_and_calculate_area_field(self, features):
-        area_field = f"AREA_{self.calculate_area_units_user}".upper()
-        
-        arcpy.management.CalculateGeometryAttributes(in_features=features,
-                                                      geometry_property=[[area_field, "AREA"]],
-                                                      area_unit=self.calculate_area_units,
-                                                      coordinate_system=self.calculate_area_in_crs)
+        self.engine.calculate_fields(features, [self.area_field()])
 
-    def fix_individual_values(self, layer):
-        """
-            Kind of a silly method (really geared toward a data frame), where we use Calculate Field to fix individual values
-        """
 
-        fix_individual_value_code_block = """
-def fix_individual(conditional_field_value, conditional_check_value, update_value, current_value):
-    if conditional_field_value == conditional_check_value:
-        return update_value
-    else:
-        return current_value
+def strip_extra(value):
+    """
+        Makes the short name from the legal place name by dropping "City of", "Town of", and " County"
+    """
+    if value is None:
+        return None
+    value = value.replace('City of ', '')
+    value = value.replace('Town of ', '')
+    value = value.replace(" County", '')
+    return value
 
-"""
 
-        for adjust in self.adjustments:
-            update_field = list(adjust["field"].keys())[0]
-            check_field = list(adjust["where"].keys())[0]
-            check_value = adjust["where"][check_field]
-            update_value = adjust["field"][update_field]
-            arcpy.management.CalculateField(layer,
-                                            field=update_field,
-                                            expression=f'fix_individual(!{check_field}!, "{check_value}", "{update_value}", !{update_field}!)',
-                                            expression_type="PYTHON3",
-                                            code_block=fix_individual_value_code_block)
+def lookup_fields(lookup, key_field):
+    """
+        Returns a DerivedField for each field of a lookup table from load_lookup, filled in by matching on key_field
+    """
+    derived = []
+    for index, definition in enumerate(lookup["field_definitions"]):
+        name, field_type, alias = definition[:3]
+        length = definition[3] if len(definition) > 3 else None
+        derived.append(derived_fields.DerivedField(name, field_type,
+                                                   lambda values, index=index: lookup["rows"].get(values[key_field], lookup["missing"])[index],
+                                                   sources=(key_field,), length=length, alias=alias))
+    return derived
+
+
+def load_lookup(engine, table, key_field, fields):
+    """
+        Reads a lookup table into a dictionary so it can be joined in memory
+
+    Args:
+        engine: the geometry_engine holding the table
+        table (str): path or URL of the table
+        key_field (str): field to key the records on
+        fields (list): fields to keep from each record
+
+    Returns:
+        dict: 'rows' maps each key to a tuple of values for fields (first record wins for duplicate keys), 'fields' has the field names,
+            'missing' is the values to use when there's no match, and 'field_definitions' is what to pass to AddFields to create the fields
+    """
+    field_definitions = engine.field_definitions(table, fields)
+
+    rows = {}
+    for row in engine.rows(table, [key_field] + fields):
+        if row[0] is not None:
+            rows.setdefault(row[0], tuple(row[1:]))
+
+    return {"rows": rows, "fields": fields, "missing": (None,) * len(fields), "field_definitions": field_definitions}
+
+
+def _process_county_partition(partition_features, index, scratch_folder):
+    """
+        Runs in a worker process - runs the cities and counties pathways on one county's CDTFA features, which the parent
+        process already split out into this worker's scratch geodatabase.
+
+    Returns:
+        tuple: full paths to the county's dissolved cities and county features, and the worker's profiling sections
+    """
+    gdb_path = parallel.create_scratch_workspace(scratch_folder, f"county_{index}")
+
+    runner = CDTFARetrieve(detect_changes=False, partition_by_county=False, engine=geometry_engine.ArcpyEngine())
+    runner.cdtfa_input_path = partition_features
+    runner.cities_pathway()
+    runner.counties_pathway()
 
+    return os.path.join(gdb_path, runner.cities_output_path), os.path.join(gdb_path, runner.counties_output_path), profiling.worker_sections()
 
-def flow(output_folder):
+
+def _coastal_branch(features, cities_counties, coastal_layer, scratch_folder, drop_fields, settings):
+    """
+        Runs in a worker process - cuts the coastline out of the cities or counties, then adds the area field and GlobalIDs
+        and reprojects them, all in a scratch geodatabase.
+
+    Returns:
+        tuple: full path to the finished features, and the worker's profiling sections
+    """
+    parallel.create_scratch_workspace(scratch_folder, cities_counties)
+
+    runner = CDTFARetrieve(reproject_to=geometry_engine.spatial_reference_from_text(settings["reproject_to"]),
+                           calculate_area_in_crs=geometry_engine.spatial_reference_from_text(settings["calculate_area_in_crs"]),
+                           calculate_area_units_user=settings["calculate_area_units_user"],
+                           calculate_area_units=settings["calculate_area_units"],
+                           detect_changes=False,
+                           partition_by_county=False,
+                           engine=geometry_engine.ArcpyEngine(memory_budget_bytes=settings["memory_budget_bytes"]))
+
+    output = runner.coastal_branch(features, cities_counties, coastal_layer, drop_fields)
+    return runner.engine.on_disk(output), profiling.worker_sections()
+
+
+def flow_stages(cdtfa_runner):
+    """
+        Every stage of a full run - retrieving and processing the GNIS and Census data, then the CDTFA chain. The GNIS and Census
+        data go straight from the download to processing in memory, and only the processed tables are kept (as the stages'
+        datasets) for resuming.
+    """
     log = logging.getLogger("bunnyhop")
-    
-    # config flags for development
-    if config.GET_GNIS or config.GET_CDTFA:
-        if not config.DEBUG:
-            gnis_file_data: pandas.DataFrame = retrieve.retrieve_gnis(output_folder=output_folder)
-        else:
-            log.warning("Using DEBUG GNIS file.")
-            gnis_file_data = {'csv': config.DEBUG_GNIS_FILE}
 
-        gnis_processed = process_gnis(str(gnis_file_data['csv']))
-    
-    if config.GET_CENSUS or config.GET_CDTFA:
-        if not config.DEBUG:
-            census_data = retrieve.retrieve_census(output_folder=output_folder)
+    def gnis_stage():
+        if config.DEBUG:
+            log.warning("Using DEBUG GNIS file.")
+            gnis_source = config.DEBUG_GNIS_FILE
         else:
+            gnis_source = retrieve.retrieve_gnis()['df']
+        cdtfa_runner.gnis_table = process_gnis(gnis_source)
+
+    def census_stage():
+        if config.DEBUG:
             log.warning("Using DEBUG Census file.")
-            census_data = config.DEBUG_CENSUS_FILE
-        census_processed = process_census(census_data)
+            census_source = config.DEBUG_CENSUS_FILE
+        else:
+            census_source = retrieve.retrieve_census()['df']
+        cdtfa_runner.census_table = process_census(census_source)
+
+    needs_gnis = lambda: config.GET_GNIS or config.GET_CDTFA
+    needs_census = lambda: config.GET_CENSUS or config.GET_CDTFA
+    return [
+        stages.Stage("gnis", gnis_stage, when=needs_gnis,
+                     outputs=("gnis_table",), datasets=("gnis_table",),
+                     settings=lambda: {"source": config.DEBUG_GNIS_FILE if config.DEBUG else config.GNIS_URL, "columns": config.GNIS_COLUMNS,
+                                       "adjustments": config.GNIS_ADJUSTMENTS, "field_names": config.FIELD_NAMES}),
+        stages.Stage("census", census_stage, when=needs_census,
+                     outputs=("census_table",), datasets=("census_table",),
+                     settings=lambda: {"source": config.DEBUG_CENSUS_FILE if config.DEBUG else config.CENSUS_EARLIEST_YEAR,
+                                       "adjustments": config.CENSUS_ADJUSTMENTS, "field_names": config.FIELD_NAMES}),
+    ] + (cdtfa_runner.stages() if config.GET_CDTFA else [])
+
+
+def flow(output_folder, resume=False):
+    """
+        Runs every stage, keeping a manifest of the finished stages in output_folder
 
-    if config.GET_CDTFA:
-        cdtfa_runner = CDTFARetrieve()
-        cdtfa_runner.retrieve_and_process(census_table=census_processed,
-                                        gnis_table=gnis_processed,
-                                        dla_source_table=config.DLA_SOURCE_TABLE_URL
-                                        )
+    Args:
+        output_folder (pathlib.PurePath): the run's workspace folder
+        resume (bool, optional): skip the stages that already finished on the last run with the same inputs
+    """
+    log = logging.getLogger("bunnyhop")
 
-        log.info(f"Finished. See merged output at {os.path.join(arcpy.env.workspace, cdtfa_runner.merged_output_path)}")
\ No newline at end of file
+    cdtfa_runner = CDTFARetrieve()
+    cdtfa_runner.dla_source_table = config.DLA_SOURCE_TABLE_URL
+
+    runner = stages.StageRunner(cdtfa_runner, cdtfa_runner.engine, manifest_path=os.path.join(str(output_folder), config.STAGE_MANIFEST_NAME))
+    try:
+        runner.run(flow_stages(cdtfa_runner), resume=resume)
+    finally:  # a report from a failed run shows how far it got
+        if config.PROFILE_ENABLED and config.PROFILE_REPORT_PATH is not None:
+            profiling.write_report()
+
+    if config.GET_CDTFA:
+        log.info(f"Finished. See merged output at {os.path.join(cdtfa_runner.engine.workspace, cdtfa_runner.merged_output_path)}")
@@ -6,11 +6,11 @@ For now, an empty placeholder that adds the field, and that's it.
 import logging
 
 from .config import FIELD_NAMES
-
-import arcpy
+from . import geometry_engine
 
 log = logging.getLogger("bunnyhop")
 
-def add_population(features):
+def add_population(features, engine=None):
     log.info("Adding Census Population Estimates")
-    arcpy.AddField_management(features, FIELD_NAMES['population'], "LONG")
\ No newline at end of file
+    engine = engine or geometry_engine.ArcpyEngine()
+    engine.add_fields(features, [[FIELD_NAMES['population'], "LONG", FIELD_NAMES['population']]])
\ No newline at end of file
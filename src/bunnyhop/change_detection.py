@@ -0,0 +1,136 @@
+"""
+    Change detection for the CDTFA layer, so that a run where nothing changed upstream can skip the geoprocessing chain.
+
+    A fingerprint has three parts: the layer's last edit date, its record count, and a hash of every feature's
+    geometry and attributes, grouped by county. Each feature is hashed on its own and the per-feature hashes are
+    sorted before being combined, so the fingerprint doesn't depend on the order the features were downloaded in. The
+    lookup tables (Census, GNIS, DLA) and the adjustments in the config get one combined hash, since a change to any
+    of them touches every county.
+
+    The fingerprint from the last successful run is kept in config.CDTFA_STATE_FOLDER along with a copy of that run's
+    outputs, so an unchanged run can just copy them back, and a run where only a few counties changed can rebuild those
+    counties and splice them into the previous outputs.
+"""
+
+from collections import defaultdict
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+from . import __version__
+from . import config
+
+log = logging.getLogger("bunnyhop.change_detection")
+
+STATE_FILE_NAME = "cdtfa_state.json"
+OUTPUTS_GDB_NAME = "last_outputs.gdb"
+
+
+def fingerprint_features(features, partition_field) -> dict:
+    """
+        Hashes the geometry and attributes of every feature, grouped by the value in partition_field
+
+    Returns:
+        dict: the record count as 'count' and a hash per partition value as 'partitions'
+    """
+    fields = [field.name for field in arcpy.ListFields(features)
+              if field.type not in ("OID", "Geometry", "GlobalID") and field.name.lower() not in ("shape_length", "shape_area", "source_objectid")]
+    partition_index = fields.index(partition_field)
+
+    feature_hashes = defaultdict(list)
+    with arcpy.da.SearchCursor(features, fields + ["SHAPE@WKB"]) as cursor:
+        for row in cursor:
+            digest = hashlib.sha256(repr(row[:-1]).encode("utf-8"))
+            digest.update(bytes(row[-1] or b""))
+            feature_hashes[row[partition_index]].append(digest.digest())
+
+    partitions = {}
+    for partition, hashes in feature_hashes.items():
+        combined = hashlib.sha256()
+        for feature_hash in sorted(hashes):  # sorted so download order doesn't matter
+            combined.update(feature_hash)
+        partitions[str(partition)] = combined.hexdigest()
+
+    return {"count": sum(len(hashes) for hashes in feature_hashes.values()), "partitions": partitions}
+
+
+def fingerprint_inputs(tables, settings) -> str:
+    """
+        Returns one hash covering every row of the lookup tables plus any settings (adjustments, field names, etc) that affect the outputs
+    """
+    digest = hashlib.sha256(__version__.encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    for table in tables:
+        fields = [field.name for field in arcpy.ListFields(table) if field.type not in ("OID", "Geometry", "GlobalID")]
+        with arcpy.da.SearchCursor(table, fields) as cursor:
+            for row in sorted(repr(row) for row in cursor):
+                digest.update(row.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def changed_partitions(previous, current) -> set:
+    """
+        Returns the partition values whose hashes differ, including partitions that appeared or disappeared
+    """
+    previous_partitions = previous["partitions"]
+    current_partitions = current["partitions"]
+    return set(partition for partition in set(previous_partitions) | set(current_partitions)
+               if previous_partitions.get(partition) != current_partitions.get(partition))
+
+
+class RunState:
+    """
+        The fingerprint and outputs of the last successful run
+    """
+
+    def __init__(self, folder=config.CDTFA_STATE_FOLDER):
+        self.folder = pathlib.Path(folder)
+        self.state_path = self.folder / STATE_FILE_NAME
+        self.outputs_gdb = self.folder / OUTPUTS_GDB_NAME
+
+    def load(self):
+        """
+            Returns the saved state as a dict with 'fingerprint' and 'outputs' keys, or None if there isn't a usable one
+        """
+        if not self.state_path.exists():
+            return None
+
+        with open(self.state_path, 'r') as state_file:
+            state = json.load(state_file)
+
+        if not all(arcpy.Exists(self.output_path(name)) for name in state["outputs"].values()):
+            log.warning("Outputs from the last successful run are missing - ignoring its fingerprint")
+            return None
+        return state
+
+    def save(self, fingerprint, outputs):
+        """
+            Copies the outputs into the state folder and records them along with the fingerprint
+
+        Args:
+            fingerprint (dict): from the current run
+            outputs (dict): names of the output feature classes in the current workspace, keyed by what they are (cities, counties, etc)
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        if not arcpy.Exists(str(self.outputs_gdb)):
+            arcpy.management.CreateFileGDB(str(self.folder), OUTPUTS_GDB_NAME)
+
+        for name in outputs.values():
+            if arcpy.Exists(self.output_path(name)):
+                arcpy.management.Delete(self.output_path(name))
+            arcpy.management.Copy(os.path.join(arcpy.env.workspace, name), self.output_path(name))
+
+        temp_path = self.state_path.with_suffix(".json.tmp")
+        with open(temp_path, 'w') as state_file:
+            json.dump({"fingerprint": fingerprint, "outputs": outputs}, state_file, indent=2)
+        os.replace(temp_path, self.state_path)  # only swap it in once all the outputs are copied
+
+    def output_path(self, name):
+        return str(self.outputs_gdb / name)
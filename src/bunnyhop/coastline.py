@@ -3,12 +3,79 @@
 # Filter a version for cities and a version for countiesUnion it to the input data
 
 from collections import defaultdict
+import functools
+import hashlib
+import os
 
-import arcpy
-import arcgis
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
 
 from . import config
+from . import derived_fields
+from . import geometry_engine
+from . import profiling
+from . import spatial_index
 
+
+class CoastlineProvider:
+    """
+        Hands out the coastline exclusion polygons, already filtered down to the exclusion values we're cutting out.
+        The filter and the output spatial reference go into the server query, so we only download the polygons we use,
+        in the coordinate system we're going to use them in. The filtered layer goes through the download cache, so it
+        only comes down again when the coastline layer is edited, and within a run each distinct filter is only pulled
+        into the workspace once - the cities and counties cuts share one layer when their exclusion lists match.
+    """
+
+    def __init__(self, url=config.COASTLINE_LAYER_URL, exclusion_field=config.COASTLINE_EXCLUSION_FIELD):
+        self.url = url
+        self.exclusion_field = exclusion_field
+        self._layers = {}  # (engine, workspace, exclusion values, wkid) -> feature class
+
+    def get(self, exclude, out_sr=None, engine=None):
+        """
+            Returns the path to a feature class of the coastline polygons whose exclusion field is in exclude
+
+        Args:
+            exclude (tuple): exclusion field values to keep - they're the areas the cut removes
+            out_sr (int, optional): WKID of the coordinate system to get the polygons in. Defaults to the layer's own.
+            engine (optional): the geometry_engine to load the polygons into. Defaults to arcpy.
+        """
+        engine = engine or geometry_engine.ArcpyEngine()
+        key = (engine.name if engine.supports_worker_processes else id(engine), engine.workspace, tuple(sorted(exclude)), out_sr)
+        if key in self._layers and engine.exists(self._layers[key]):
+            return self._layers[key]
+
+        where = geometry_engine.to_sql((self.exclusion_field, "IN", key[2]))
+        query = f"where={where}&outSR={out_sr}"
+        name = f"coastal_select_{hashlib.sha256(query.encode('utf-8')).hexdigest()[:8]}"
+        out_feature_class = os.path.join(engine.workspace, name) if engine.workspace else name
+
+        engine.fetch_layer(self.url, out_feature_class, where=where, out_sr=out_sr, query=query)
+
+        # the source ObjectIDs are only there for resuming downloads - drop them so they don't end up in the union
+        engine.delete_fields(out_feature_class, [field_name for field_name in engine.field_names(out_feature_class) if field_name.startswith("SOURCE_")])
+
+        self._layers[key] = out_feature_class
+        return out_feature_class
+
+
+_provider = None
+
+
+def get_provider():
+    """
+        Returns the coastline provider shared by every coastal cut in this process
+    """
+    global _provider
+
+    if _provider is None:
+        _provider = CoastlineProvider()
+    return _provider
+
+
+@profiling.profiled()
 def coastal_cut(input_data,
                 output_name,
                 cities_counties,
@@ -17,140 +84,221 @@ def coastal_cut(input_data,
                 exclusion_field=config.COASTLINE_EXCLUSION_FIELD,
                 counties_exclude=config.COASTLINE_COUNTIES_EXCLUDE,
                 cities_exclude=config.COASTLINE_CITIES_EXCLUDE,
-                run_sliver_fix=config.COASTLINE_SLIVER_FIX):
-    
+                run_sliver_fix=config.COASTLINE_SLIVER_FIX,
+                coastal_layer=None,
+                targeted_overlay=config.COASTLINE_TARGETED_OVERLAY,
+                engine=None):
+    """
+        Unions the coastline exclusion polygons into input_data and cleans up the result into output_name.
+        coastal_layer can be the path to already filtered exclusion polygons (from CoastlineProvider.get) - otherwise they're retrieved here.
+
+        With targeted_overlay, only the features that intersect the coastline polygons go through the union and the sliver fix -
+        the inland features can't be changed by them, so they're appended to the output as they are.
+
+        engine is the geometry_engine holding input_data. Defaults to arcpy.
+    """
+    engine = engine or geometry_engine.ArcpyEngine()
+    profiling.record_input(cities_counties, **profiling.count_dataset(engine, input_data))
+
     if cities_counties == "cities":
         exclude = cities_exclude
-        coastal_layer_name = "coastal_select_cities"
     elif cities_counties == "counties":
         exclude = counties_exclude
-        coastal_layer_name = "coastal_select_counties"
     else:
         raise ValueError("parameter cities_counties must be either 'cities' or 'counties'")
-    
-    if len(exclude) > 1:
-        exclude_str = "'" + "','".join(exclude) + "'"
-    else:
-        exclude_str = f"'{exclude[0]}'"
 
-    # download the coastline data
-    coastal_layer = "coastal_full"
-    if not arcpy.Exists(coastal_layer):
-        portal = arcgis.GIS("https://arcgis.com")  # not really sure we need this
-        feature_layer = arcgis.features.FeatureLayer(coastline_data)
-        features = feature_layer.query()
-        features.save(arcpy.env.workspace, coastal_layer)
+    if coastal_layer is None:
+        provider = get_provider()
+        if provider.url != coastline_data or provider.exclusion_field != exclusion_field:
+            provider = CoastlineProvider(coastline_data, exclusion_field)
 
-    # now, filter the coastline data to only have the appropriate exclusion polygons
-    # it's an exclude, but we need to use "in" instead of "not in" because the items to exclude are encapsulated in the polygons.
-    log.debug("Selecting out coastline exclusion polygons")
-    arcpy.analysis.Select(coastal_layer, coastal_layer_name, f"\"{exclusion_field}\" in ({exclude_str})")
+        # get the coastline data, filtered to only have the appropriate exclusion polygons and in the same coordinate system as the input
+        # it's an exclude, but we need to use "in" instead of "not in" because the items to exclude are encapsulated in the polygons.
+        log.debug("Retrieving coastline exclusion polygons")
+        coastal_layer = provider.get(exclude, out_sr=engine.spatial_reference_code(input_data), engine=engine)
+
+    # remove the coastal polygon from the union and remove coastal buffers when all of their geometry has been moved back to the city.
+    keep_where = ("AND",
+                  ("OR",
+                   (config.FIELD_NAMES['legal_place_name'], "<>", ""),
+                   (config.FIELD_NAMES['place_type'], "<>", ""),
+                   (config.FIELD_NAMES['place_name'], "<>", "")),
+                  (geometry_engine.AREA, ">", 1))
+
+    union_input = input_data
+    inland_name = None
+    if targeted_overlay:
+        union_input = f"{output_name}_coastal_input"
+        inland_name = f"{output_name}_inland"
+        coastal_count = engine.select_intersecting(input_data, coastal_layer, union_input, inland_name, remainder_where=keep_where)
+        log.debug(f"{coastal_count} features intersect the coastline polygons")
 
     # run a union to the output path
     log.debug("Running coastline union")
     prelim_name = f"{output_name}_preliminary"
-    arcpy.analysis.Union([input_data, coastal_layer_name], prelim_name)
+    engine.union([union_input, coastal_layer], prelim_name)
 
     if run_sliver_fix:
         log.debug("Fixing coastal slivers")
-        fix_slivers(prelim_name)
+        engine.fix_slivers(prelim_name)
     
     # delete the attached FID fields from the Union - we don't want them in the schema
-    remove_fields = [field.name for field in arcpy.ListFields(prelim_name, "FID_*")]
-    arcpy.management.DeleteField(prelim_name, remove_fields)
+    engine.delete_fields(prelim_name, [field_name for field_name in engine.field_names(prelim_name) if field_name.startswith("FID_")])
 
-    # remove the coastal polygon from the union and remove coastal buffers when all of their geometry has been moved back to the city.
-    arcpy.analysis.Select(prelim_name, output_name, f"({config.FIELD_NAMES['legal_place_name']} <> '' or {config.FIELD_NAMES['place_type']} <> '' or {config.FIELD_NAMES['place_name']} <> '') and Shape_Area > 1")  # remove the large off-coast polygon.
+    engine.select(prelim_name, output_name, keep_where)  # remove the large off-coast polygon.
+
+    if inland_name is not None:
+        _add_union_blanks(engine, inland_name, output_name)
+        engine.append(inland_name, output_name)
 
     # set OFFSHORE to NULL when it's blank so it's more normal.
-    arcpy.management.CalculateField(output_name, config.FIELD_NAMES['coastal'], f"None if !{config.FIELD_NAMES['coastal']}! == '' else !{config.FIELD_NAMES['coastal']}!")
+    coastal_field = config.FIELD_NAMES['coastal']
+    engine.calculate_fields(output_name, [derived_fields.DerivedField(coastal_field, "TEXT", lambda values: None if values[coastal_field] == '' else values[coastal_field],
+                                                                      sources=(coastal_field,))])
+    profiling.record_output(output_name, **profiling.count_dataset(engine, output_name))
 
-def fix_slivers(input, keep_fragment_geoms=config.COASTLINE_KEEP_FRAGMENTS_IN_GEOMS, threshold=config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS):
-    
+
+def _add_union_blanks(engine, dataset, like):
+    """
+        Adds the fields that like has and dataset doesn't to dataset, filled in with the blanks the union gives features that
+        don't overlap anything - empty strings for text and zeros for numbers - so the inland features that skipped the union
+        don't end up with NULLs where the same features would otherwise have blanks
+    """
+    existing = set(engine.field_names(dataset))
+    definitions = engine.field_definitions(like, [field_name for field_name in engine.field_names(like) if field_name not in existing])
+    if not definitions:
+        return
+
+    engine.add_fields(dataset, definitions)
+    blanks = {"TEXT": "", "DATE": None}
+    engine.calculate_fields(dataset, [derived_fields.DerivedField(definition[0], definition[1], lambda values, blank=blanks.get(definition[1], 0): blank)
+                                      for definition in definitions])
+
+
+@functools.lru_cache(maxsize=None)
+def keep_fragment_geometries(sr=config.COASTLINE_CHECK_SR) -> list:
+    """
+        Returns config.COASTLINE_KEEP_FRAGMENTS as arcpy geometries in sr. They're built the first time they're asked for,
+        rather than in config, so that importing the package doesn't need arcpy.
+    """
+    fragments_sr = arcpy.SpatialReference(config.COASTLINE_KEEP_FRAGMENTS_SR)
+    geometries = []
+    for points in config.COASTLINE_KEEP_FRAGMENTS:
+        if len(points) == 1:
+            geometry = arcpy.PointGeometry(arcpy.Point(*points[0]), spatial_reference=fragments_sr)
+        else:
+            geometry = arcpy.Polygon(arcpy.Array([arcpy.Point(*point) for point in points]), spatial_reference=fragments_sr)
+        geometries.append(geometry.projectAs(geometry_engine.arcpy_spatial_reference(sr)))
+    return geometries
+
+
+def fix_slivers(input, keep_fragment_geoms=None, threshold=None):
+    """
+        The union leaves each coastal place split into a land polygon and one or more coastal buffer polygons (ocean, bay, etc),
+        all with the same legal place name, and small fragments of each can end up stranded in the wrong one. For every place
+        name with more than one polygon, reconcile_parts moves each small fragment into the polygon it belongs with.
+        keep_fragment_geoms defaults to keep_fragment_geometries() and threshold to config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS.
+    """
+    if threshold is None:
+        threshold = config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS
+    if keep_fragment_geoms is None:
+        keep_fragment_geoms = keep_fragment_geometries()
     polys_by_name = defaultdict(lambda: [])  # we'll index polygons by name here
+    keep_fragment_index = spatial_index.STRTree([geometry_engine.arcpy_envelope(geom) for geom in keep_fragment_geoms])
 
-    with arcpy.da.UpdateCursor(input, field_names=["SHAPE@", config.FIELD_NAMES['legal_place_name'], "OID@"]) as cursor:
+    with arcpy.da.SearchCursor(input, field_names=["SHAPE@", config.FIELD_NAMES['legal_place_name'], "OID@"]) as cursor:
         for row in cursor:  # pull them out so we can address them by place name
-            polys_by_name[row[1]].append(row)
-
-        for place in polys_by_name:
-            if len(polys_by_name[place]) < 2:
-                continue  # skip any polygon that doesn't have a coastal buffer
-            
-            place1 = polys_by_name[place][0]
-            place2 = polys_by_name[place][1]
-            
-            # check 1 against 2 in both directions
-            place1, place2 = check_parts(place1, place2, keep_fragment_geoms, threshold)
-            place1, place2 = check_parts(place2, place1, keep_fragment_geoms, threshold)
-            
-            # as of this writing, everything but SF is covered by the above, which will be 3 places in the city version.
-            # This code is clearer than a general case though, so leaving it and adding coverage of the rest below
-
-            # if we have two separate coastal buffer multipolygons (e.g. one for bay, one for ocean), then do the pairwise comparisons on all of them
-            if len(polys_by_name[place]) == 3: 
-                place3 = polys_by_name[place][2]
-                
-                # check 1 against 3 in both directions
-                place1, place3 = check_parts(place1, place3, keep_fragment_geoms, threshold)
-                place3, place1 = check_parts(place3, place1, keep_fragment_geoms, threshold)
-
-                # check 2 against 3 in both directions
-                place2, place3 = check_parts(place2, place3, keep_fragment_geoms, threshold)
-                place3, place2 = check_parts(place3, place2, keep_fragment_geoms, threshold)
-                
-                polys_by_name[place][2] = place3
-
-            # set these at the end because the "if" block could modify them
-            polys_by_name[place][0] = place1
-            polys_by_name[place][1] = place2
+            polys_by_name[row[1]].append(list(row))
 
-    with arcpy.da.UpdateCursor(input, field_names=["SHAPE@", config.FIELD_NAMES['legal_place_name'], "OID@"]) as cursor:
-        rows_by_oid = {}
-        for name in polys_by_name:  # index the rows by their OID so we can easily look them up to run the update
-            for row in polys_by_name[name]:
-                oid = row[2]
-                rows_by_oid[oid] = row
+    rows_by_oid = {}  # only the rows that changed
+    for place in polys_by_name:
+        if len(polys_by_name[place]) < 2:
+            continue  # skip any polygon that doesn't have a coastal buffer
 
+        for row in reconcile_parts(polys_by_name[place], keep_fragment_geoms, threshold, keep_fragment_index=keep_fragment_index):
+            rows_by_oid[row[2]] = row
+
+    if not rows_by_oid:
+        return
+
+    with arcpy.da.UpdateCursor(input, field_names=["SHAPE@", config.FIELD_NAMES['legal_place_name'], "OID@"]) as cursor:
         for row in cursor:
-            update_value = rows_by_oid[row[2]]
-            cursor.updateRow(update_value)
+            if row[2] in rows_by_oid:
+                cursor.updateRow(rows_by_oid[row[2]])
+
+
+def reconcile_parts(rows, keep_fragment_geoms, threshold, sr=config.COASTLINE_CHECK_SR, keep_fragment_index=None):
+    """
+        Moves each small part of the polygons for one place into whichever other polygon has the largest large part it
+        touches, unless it's in one of the fragments we keep. Works for any number of polygons (land, ocean, bay, etc).
+
+        Every polygon is split into parts once, and the large parts all go in one bounding box index, so each small part
+        only runs touches against the large parts whose envelopes it meets. The moves are collected first and then
+        applied with at most one union and one difference per polygon.
+
+    Args:
+        rows (list): [geometry, legal place name, OID] lists for the polygons that share a place name. Geometries are updated in place.
+        keep_fragment_geoms (list): small parts that are in any of these stay where they are
+        threshold (float): parts with less area than this (in sr's units) are candidates to move. Parts with at least this much
+            area are large - they stay where they are, and small parts can move into them.
+        keep_fragment_index (spatial_index.STRTree, optional): index of keep_fragment_geoms' envelopes. Built here if not provided - pass
+            it in when calling this repeatedly with the same keep_fragment_geoms.
+
+    Returns:
+        list: the rows whose geometry changed
+    """
+    if keep_fragment_index is None:
+        keep_fragment_index = spatial_index.STRTree([geometry_engine.arcpy_envelope(geom) for geom in keep_fragment_geoms])
+    sr = geometry_engine.arcpy_spatial_reference(sr)
+
+    small_parts = []  # (row index, part)
+    large_parts = []  # (row index, part, area)
+    for row_index, row in enumerate(rows):
+        for part in _split_parts(row[0], sr):
+            area = part.area
+            if area < threshold:
+                small_parts.append((row_index, part))
+            else:  # a part right at the threshold counts as large, so it stays put and small parts can move into it
+                large_parts.append((row_index, part, area))
+    large_index = spatial_index.STRTree([geometry_engine.arcpy_envelope(part) for row_index, part, area in large_parts])
+
+    moves_out = defaultdict(list)  # row index -> parts to remove from it
+    moves_in = defaultdict(list)  # row index -> parts to add to it
+    for row_index, part in small_parts:
+        envelope = geometry_engine.arcpy_envelope(part)
+
+        # check if it's a fragment we need to keep
+        if any(not part.disjoint(keep_fragment_geoms[index]) for index in keep_fragment_index.query(envelope)):
+            continue
+
+        # OK, it's not a fragment to keep and it's small. Find the largest part of another polygon that it touches
+        neighbors = [large_parts[index] for index in large_index.query(envelope) if large_parts[index][0] != row_index]
+        touching = [(area, neighbor_index) for neighbor_index, neighbor, area in neighbors if part.touches(neighbor)]
+        if touching:
+            destination = max(touching)[1]
+            moves_out[row_index].append(part)
+            moves_in[destination].append(part)
+
+    # perform these at the end to not change the geometry while we're iterating over it
+    for row_index, parts in moves_in.items():
+        rows[row_index][0] = rows[row_index][0].union(_combine_parts(parts))
+    for row_index, parts in moves_out.items():
+        rows[row_index][0] = rows[row_index][0].difference(_combine_parts(parts))
+
+    return [rows[row_index] for row_index in sorted(set(moves_in) | set(moves_out))]
+
+
+def _combine_parts(parts):
+    """
+        Combines single part polygons into one multipart polygon. They're unioned rather than reassembled from their point
+        arrays, so holes in the parts come through.
+    """
+    return functools.reduce(lambda combined, part: combined.union(part), parts)
+
+
+def _split_parts(geometry, sr):
+    """
+        Returns each part of a (possibly multipart) polygon as its own polygon
+    """
+    return [arcpy.Polygon(geometry.getPart(part_id), spatial_reference=sr) for part_id in range(geometry.partCount)]
 
-def check_parts(place1, place2, keep_fragment_geoms, threshold, sr=config.COASTLINE_CHECK_SR):
-    
-    place1_parts = place1[0].partCount
-    place2_parts = place2[0].partCount
-    
-    swaps = []
-    for part_id in range(place1_parts):
-        part_array = place1[0].getPart(part_id)  # index 0 is the geometry
-        part = arcpy.Polygon(inputs=part_array, spatial_reference=sr)
-
-        if part.area < threshold:
-            skip = False  # check if it's a fragment we need to keep
-            for geom in keep_fragment_geoms:
-                if not part.disjoint(geom):
-                    skip = True
-            if skip:
-                continue
-        
-            # OK, it's not a fragment to keep and it's small. Check if it touches any of place2's parts
-            for place2_id in range(place2_parts):
-                place2_part_array = place2[0].getPart(place2_id)
-                place2_part = arcpy.Polygon(place2_part_array, spatial_reference=sr)
-                if place2_part.area > threshold and part.touches(place2_part):
-                    swaps.append(part)
-                    break
-
-    for swap in swaps:  # perform these at the end to not change the geometry while we're iterating over it
-        place2[0] = place2[0].union(swap)  # add the part to the other part
-        place1[0] = place1[0].difference(swap)  # remove it from this part
-
-    return place1, place2
-
-    # Find every polygon whose LEGAL PLACE NAME is duplicated - one will be the coastal buffer, one will be the land based items
-    # For each of those polygons:
-    #   for part in polygon:
-    #       if part area below threshold
-    #          check if it's in the keep_fragment_geoms (that it's disjoint) - if it is, then continue
-    #       check if the part touches the land polygon. If so, union it there. Otherwise, if it touches the ocean polygon, union it there
@@ -0,0 +1,203 @@
+"""
+    The open geometry engine's on-disk format - what OpenEngine.save and load read and write, and how it keeps datasets
+    that don't fit in its memory budget, the feature layers in the download cache, and the pages of a download it can
+    resume. The arcpy engine keeps everything in geodatabases and doesn't use it.
+
+    A dataset is a folder. Each attribute column is its own .npy file - numbers and dates as they are, and text as a
+    fixed-width unicode array with a mask for NULLs - so a column is read back memory-mapped and converted in one step
+    instead of value by value. Geometry is stored as one buffer of WKB with an array of offsets into it, and all of it is
+    parsed with a single shapely.from_wkb call.
+
+    The layout of one dataset:
+        meta.json               - format version, record count, coordinate system, and each column's name, kind, and file
+        <n>.npy                 - a column
+        <n>.valid.npy           - which values of a text column aren't NULL
+        geometry.offsets.npy, geometry.wkb         - the geometries, if the dataset has them
+
+    Datasets are written to a temporary folder and moved into place, so a reader never sees a half-written dataset.
+"""
+
+import json
+import os
+import shutil
+
+import numpy
+import pandas
+
+FORMAT_VERSION = 2
+
+
+def _column_kind(column):
+    """
+        Returns how a column gets stored - "numeric", "datetime", or "text" - and the column converted for storing that way
+    """
+    if pandas.api.types.is_datetime64_any_dtype(column):
+        return "datetime", column.astype("datetime64[ns]")
+    if pandas.api.types.is_bool_dtype(column) or pandas.api.types.is_numeric_dtype(column):
+        return "numeric", column
+
+    inferred = pandas.api.types.infer_dtype(column, skipna=True)
+    if inferred in ("integer", "floating", "mixed-integer-float", "decimal"):  # object columns of numbers and NULLs, like calculate_fields leaves
+        numbers = pandas.to_numeric(column)
+        return "numeric", numbers.astype("float64") if column.isna().any() else numbers
+    if inferred in ("datetime", "datetime64", "date"):
+        return "datetime", pandas.to_datetime(column)
+    return "text", column
+
+
+def _write_buffer(folder, prefix, items, extension):
+    """
+        Writes byte strings (or None) as one buffer and an array of offsets, where item i is buffer[offsets[i]:offsets[i + 1]]
+    """
+    lengths = numpy.fromiter((len(item) if item is not None else 0 for item in items), dtype="int64", count=len(items))
+    offsets = numpy.zeros(len(items) + 1, dtype="int64")
+    numpy.cumsum(lengths, out=offsets[1:])
+    numpy.save(os.path.join(folder, f"{prefix}.offsets.npy"), offsets)
+    with open(os.path.join(folder, f"{prefix}.{extension}"), 'wb') as buffer_file:
+        for item in items:
+            if item:
+                buffer_file.write(item)
+
+
+def _read_buffer(folder, prefix, extension):
+    offsets = numpy.load(os.path.join(folder, f"{prefix}.offsets.npy"), mmap_mode="r")
+    path = os.path.join(folder, f"{prefix}.{extension}")
+    data = numpy.memmap(path, dtype="uint8", mode="r") if os.path.getsize(path) else numpy.zeros(0, dtype="uint8")  # empty files can't be mapped
+    return offsets, data
+
+
+def write(folder, attributes, geometry=None, crs=None):
+    """
+        Writes a dataset to folder, replacing anything already there
+
+    Args:
+        folder (str): folder to write the dataset to
+        attributes (pandas.DataFrame): the attributes
+        geometry (numpy.ndarray, optional): shapely geometries (or None), one per record. Leave it out for a table
+        crs (pyproj.CRS, optional): coordinate system of the geometries
+    """
+    temp_folder = f"{folder}.tmp"
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+
+    columns = []
+    for index, name in enumerate(attributes.columns):
+        kind, column = _column_kind(attributes[name])
+        if kind == "text":
+            valid = column.notna().to_numpy()
+            numpy.save(os.path.join(temp_folder, f"{index}.valid.npy"), valid)
+            numpy.save(os.path.join(temp_folder, f"{index}.npy"), column.where(valid, "").to_numpy(dtype=str))
+        else:
+            numpy.save(os.path.join(temp_folder, f"{index}.npy"), column.to_numpy())
+        columns.append({"name": str(name), "kind": kind, "file": str(index)})
+
+    if geometry is not None:
+        import shapely
+        _write_buffer(temp_folder, "geometry", list(shapely.to_wkb(geometry)), "wkb")
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "count": len(attributes),
+        "crs": crs.to_wkt() if crs is not None else None,
+        "columns": columns,
+        "geometry": geometry is not None,
+    }
+    with open(os.path.join(temp_folder, "meta.json"), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(temp_folder, folder)
+
+
+class ColumnarDataset:
+    """
+        A dataset in the columnar format, opened memory-mapped. Nothing is read from disk until a column or the geometry is asked for.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "meta.json"), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"{folder} is in version {self.meta['version']} of the columnar format, but we read version {FORMAT_VERSION}")
+
+        self._columns = {column["name"]: column for column in self.meta["columns"]}
+
+    def __len__(self):
+        return self.meta["count"]
+
+    @property
+    def column_names(self) -> list:
+        return [column["name"] for column in self.meta["columns"]]
+
+    @property
+    def has_geometry(self) -> bool:
+        return self.meta["geometry"]
+
+    @property
+    def crs(self):
+        if self.meta["crs"] is None:
+            return None
+        import pyproj
+        return pyproj.CRS.from_wkt(self.meta["crs"])
+
+    def column(self, name):
+        """
+            Returns one column - numeric and date columns come back as read-only memory-mapped arrays, and text columns as an object array of str and None
+        """
+        column = self._columns[name]
+        values = numpy.load(os.path.join(self.folder, f"{column['file']}.npy"), mmap_mode="r")
+        if column["kind"] != "text":
+            return values
+
+        values = values.astype(object)
+        values[~numpy.load(os.path.join(self.folder, f"{column['file']}.valid.npy"))] = None
+        return values
+
+    def attributes(self, columns=None) -> pandas.DataFrame:
+        columns = self.column_names if columns is None else columns
+        return pandas.DataFrame({name: self.column(name) for name in columns}, columns=columns)
+
+    def wkb(self, position) -> memoryview:
+        """
+            Returns one record's geometry as WKB, straight out of the mapped buffer without copying it
+        """
+        offsets, data = _read_buffer(self.folder, "geometry", "wkb")
+        return memoryview(data[offsets[position]:offsets[position + 1]])
+
+    def geometry(self):
+        """
+            Returns the geometries as a numpy array of shapely geometries, or None if the dataset is a table
+        """
+        if not self.has_geometry:
+            return None
+
+        import shapely
+        offsets, data = _read_buffer(self.folder, "geometry", "wkb")
+        buffer = data.tobytes()  # slicing bytes is much faster than slicing the mapped array one record at a time
+        bounds = offsets.tolist()
+        wkb = numpy.empty(len(self), dtype=object)
+        wkb[:] = [buffer[start:end] if end > start else None for start, end in zip(bounds, bounds[1:])]
+        return shapely.from_wkb(wkb)
+
+
+def read(folder) -> ColumnarDataset:
+    return ColumnarDataset(folder)
+
+
+def exists(folder) -> bool:
+    """
+        Whether there's a dataset in folder that we can read - one written in an older version of the format counts as missing
+    """
+    meta_path = os.path.join(folder, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as meta_file:
+        return json.load(meta_file).get("version") == FORMAT_VERSION
+
+
+def delete(folder):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
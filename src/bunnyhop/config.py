@@ -1,5 +1,5 @@
 import logging.config
-import tempfile
+import shutil
 from typing import Optional
 import pathlib
 import os
@@ -9,7 +9,10 @@ from string import Template
 
 from .logging_and_alerts import *
 
-import arcpy
+try:
+    import arcpy
+except ImportError:  # without ArcGIS, the workspace is only a folder
+    arcpy = None
 
 _current_folder = os.path.dirname(os.path.abspath(__file__))
 
@@ -44,12 +47,16 @@ CDTFA_FIELD_MAP = {
 }
 
 
-# Set REPROJECT_TO to None to disable reprojection
-REPROJECT_TO = arcpy.SpatialReference(3310)
-CALCULATE_AREA_IN_CRS = arcpy.SpatialReference(3310)
+# EPSG codes. Set REPROJECT_TO to None to disable reprojection
+REPROJECT_TO = 3310
+CALCULATE_AREA_IN_CRS = 3310
 CALCULATE_AREA_UNITS_USER = "SqMi"  # for the field name
 CALCULATE_AREA_UNITS = "SQUARE_MILES_INT"  # provided to ArcGIS - we can calculate in Miles even in a CRS that is in meters. The important point is that the CRS is equal area.
 
+### GEOMETRY ENGINE CONFIGS ###
+# which geometry_engine runs the CDTFA geometry stages - "arcpy", or "open" to run them in memory with shapely and pyproj (pip install bunnyhop[open])
+GEOMETRY_ENGINE = "arcpy"
+
 ### COASTLINE CONFIGS ###
 COASTLINE_LAYER_URL: str = "https://services3.arcgis.com/uknczv4rpevve42E/arcgis/rest/services/California_Cartographic_Coastal_Polygons/FeatureServer/31"
 COASTLINE_EXCLUSION_FIELD: str = "OFFSHORE"
@@ -57,21 +64,26 @@ COASTLINE_COUNTIES_EXCLUDE: tuple = ("ocean", "bay")
 COASTLINE_CITIES_EXCLUDE: tuple = ("ocean", "bay")
 
 COASTLINE_CHECK_SIZE_THRESHOLD_METERS= 100000
-COASTLINE_CHECK_SR = arcpy.SpatialReference(3857)
-initial_sr = arcpy.SpatialReference(3310)
-COASTLINE_KEEP_FRAGMENTS_IN_GEOMS = [  # these will be compared against fragments - if a fragment is in here, it'll be kept regardless of size
-    arcpy.Polygon(arcpy.Array([arcpy.Point(-281052, -16085), arcpy.Point(-257873, -16085), arcpy.Point(-257873,-38503), arcpy.Point(-281052,-38503), arcpy.Point(-281052, -16085)]), spatial_reference=initial_sr).projectAs(COASTLINE_CHECK_SR),  # farallons
-    arcpy.PointGeometry(arcpy.Point(-212926, -18383), spatial_reference=initial_sr).projectAs(COASTLINE_CHECK_SR), # alcatraz
-    arcpy.Polygon(arcpy.Array([arcpy.Point(-212938, -14187), arcpy.Point(-211711, -14187), arcpy.Point(-211711, -15762), arcpy.Point(-212938, -15762), arcpy.Point(-212938, -14187)]), spatial_reference=initial_sr).projectAs(COASTLINE_CHECK_SR) # angel island parts
+COASTLINE_CHECK_SR = 3857  # EPSG code of the coordinate system the sliver fix measures areas in
+COASTLINE_KEEP_FRAGMENTS_SR = 3310
+COASTLINE_KEEP_FRAGMENTS = [  # these will be compared against fragments - if a fragment is in here, it'll be kept regardless of size. Rings (or a single point) in COASTLINE_KEEP_FRAGMENTS_SR
+    [(-281052, -16085), (-257873, -16085), (-257873, -38503), (-281052, -38503), (-281052, -16085)],  # farallons
+    [(-212926, -18383)],  # alcatraz
+    [(-212938, -14187), (-211711, -14187), (-211711, -15762), (-212938, -15762), (-212938, -14187)],  # angel island parts
 ]
 
 COASTLINE_SLIVER_FIX = True  # should we actually run the sliver fix?
+COASTLINE_TARGETED_OVERLAY = True  # only union the features that intersect the coastline polygons, and append the inland ones untouched
 
 ### CDTFA CONFIGS ###
 GET_CDTFA = True
 
 # CDTFA layer via https://gis.data.ca.gov/maps/93f73ae0070240fca9a4d3826ddb83cd/about
 CDTFA_LAYER_URL = "https://services6.arcgis.com/snwvZ3EmaoXJiugR/arcgis/rest/services/City_and_County_Boundary_Line_Changes/FeatureServer/0"
+# Cities and counties never cross county lines, so the city and county dissolves can be run for each county separately
+# in worker processes, then merged back together
+CDTFA_PARTITION_BY_COUNTY = True
+MAX_WORKER_PROCESSES = None  # how many worker processes to run at once. None uses the number of processors
 CDTFA_FLAG_INCOMPLETE_RECORD_COUNT = 500  # how many records should the CDTFA layer have? If it has less than this, raise an error. Occasionally they'll change the layer IDs and we'll get the annexations for the year rather than the full layer. This catches that instead of getting a random crash.
 
 # These adjustments are more crude replacements, but they're because of challenges created in the
@@ -99,6 +111,24 @@ adjustment2["field"][FIELD_NAMES['legal_place_name']] = "San Francisco County"
 CDTFA_ADJUST = [adjustment1,adjustment2]
 
 
+### DOWNLOAD CONFIGS ###
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes to read at a time when streaming a download
+DOWNLOAD_SPOOL_MAX_SIZE = 64 * 1024 * 1024  # streamed downloads stay in memory up to this many bytes, then spill to a temporary file on disk
+
+### HTTP CONFIGS ###
+# every request goes through http_client's shared client - pooled connections, timeouts, and retries with backoff
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_READ_TIMEOUT_SECONDS = 120  # how long the server can go quiet in the middle of a response, not how long the whole download can take
+HTTP_RETRIES = 4  # retries after the first try, for connection errors, timeouts, and HTTP_RETRY_STATUSES
+HTTP_BACKOFF_SECONDS = 1  # the longest wait before the first retry - it doubles for each retry after that, and the actual wait is random up to it
+HTTP_BACKOFF_MAX_SECONDS = 60
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_MAX_CONNECTIONS_PER_HOST = 6  # requests in flight to the same server at once, across every thread
+
+### FEATURE SERVICE CONFIGS ###
+FEATURE_SERVICE_PAGE_SIZE = None  # how many features to request at a time when downloading a feature layer. None uses the layer's maxRecordCount
+FEATURE_SERVICE_MAX_WORKERS = 4  # how many pages to download at the same time
+
 ### DLA CONFIGS ###
 DLA_SOURCE_TABLE_URL = "https://services3.arcgis.com/uknczv4rpevve42E/arcgis/rest/services/Place_Abbreviations/FeatureServer/15"
 
@@ -108,6 +138,16 @@ GET_GNIS = True
 GNIS_URL = "https://prd-tnm.s3.amazonaws.com/StagedProducts/GeographicNames/FederalCodes/FedCodes_CA_Text.zip"
 GNIS_ZIP_FILE_PATH = "Text/FederalCodes_CA.txt"  # where is the file we want to extract from the zip file?
 
+# the only GNIS fields the pipeline reads, and their types. Everything else is dropped while the file is parsed.
+# Set to None to load every column.
+GNIS_COLUMNS = {
+    "feature_id": "int64",
+    "feature_name": "str",
+    "feature_class": "category",
+    "census_class_code": "category",
+    "state_name": "category",
+}
+
 # These are processed at the *end* of the GNIS processing code since they make 
 # changes to the GNIS_JOIN_NAME field so that it can properly get merged
 # with the CDTFA data. They make one-off fixes to the join names for jurisdictions
@@ -132,6 +172,7 @@ GET_CENSUS = False
 CENSUS_EARLIEST_YEAR = 2023  # don't check any years earlier (e.g. 2022) than this. If 2023 fails for some reason, just STOP.
 CENSUS_FOLDER_URL = Template("https://www2.census.gov/programs-surveys/popest/geographies/$year/")
 CENSUS_FILE_URL = Template("https://www2.census.gov/programs-surveys/popest/geographies/$year/all-geocodes-v$year.xlsx")
+CENSUS_PROBE_WORKERS = 8  # how many years to check for a Census file at the same time
 
 # these are processed at the end of retrieval of census data before the
 # data really begins being processed - they're effectively treated as errors
@@ -150,32 +191,94 @@ CENSUS_ADJUSTMENTS = {
 IN_ARCGIS_ONLINE_NOTEBOOKS = True if os.getcwd() == "/arcgis" else False  
 FOLDER_WORKSPACE: Optional[pathlib.PurePath] = None
 GDB_WORKSPACE: Optional[pathlib.PurePath] = None
-
-
-
-
-def create_workspace():
+PROFILE_REPORT_PATH: Optional[pathlib.PurePath] = None
+
+# the workspace is recreated each run, so anything we keep between runs needs to live somewhere stable
+if IN_ARCGIS_ONLINE_NOTEBOOKS:
+    STABLE_FOLDER = pathlib.PurePath(os.getcwd()) / "home" / "bunnyhop"
+else:
+    STABLE_FOLDER = pathlib.PurePath(os.path.expanduser("~")) / ".bunnyhop"
+
+### DOWNLOAD CACHE CONFIGS ###
+# Upstream files and feature layers are cached locally between runs. Files are revalidated with conditional
+# requests (ETag/Last-Modified) and feature layers with their lastEditDate, so unchanged sources aren't downloaded again.
+DOWNLOAD_CACHE_ENABLED = True
+DOWNLOAD_CACHE_FOLDER = STABLE_FOLDER / "cache"
+DOWNLOAD_CACHE_MAX_BYTES = 2 * 1024 ** 3  # once the cache is bigger than this, the least recently used items are removed
+DOWNLOAD_CACHE_MAX_AGE_DAYS = 30  # items that haven't been used in this many days are removed
+
+### CHANGE DETECTION CONFIGS ###
+# The CDTFA layer is fingerprinted (edit date, record count, and a hash of each county's features) along with the lookup
+# tables, and compared to the fingerprint from the last successful run. If nothing changed, that run's outputs are reused.
+# If only a few counties changed, only those counties are rebuilt and spliced into the last run's outputs.
+CDTFA_CHANGE_DETECTION = True
+CDTFA_STATE_FOLDER = STABLE_FOLDER / "state"  # keeps the fingerprint and a copy of the outputs from the last successful run
+CDTFA_INCREMENTAL_MAX_COUNTIES = 10  # if more counties than this changed, rebuild everything instead
+
+### WORKSPACE CONFIGS ###
+# Intermediate results go to an in-memory workspace ("memory" for arcpy), and the least recently used ones get moved into the
+# workspace geodatabase once the ones in memory add up to more than the budget. Only the final outputs always get written to the
+# geodatabase. Set WORKSPACE_TIERED to False to write everything to the geodatabase.
+WORKSPACE_TIERED = True
+WORKSPACE_MEMORY_BUDGET_BYTES = 2 * 1024 ** 3
+
+### STAGE CONFIGS ###
+# Runs happen in a stable workspace folder, and each stage that finishes is recorded in a manifest there, so that
+# `python -m bunnyhop --resume` can pick up at the first stage whose inputs changed or whose outputs are missing.
+# A run without --resume deletes the workspace geodatabase, the manifest, the workers' scratch folders, and the CDTFA
+# download checkpoint first. The folder is our own (under STABLE_FOLDER, so /arcgis/home/bunnyhop in ArcGIS Online
+# Notebooks), and nothing else in it gets deleted.
+STAGE_WORKSPACE_FOLDER = STABLE_FOLDER / "workspace"
+STAGE_WORKSPACE_GDB_NAME = "bunnyhop_workspace.gdb"
+STAGE_MANIFEST_NAME = "stage_manifest.json"
+STAGE_SCRATCH_FOLDER_NAMES = ("partitions", "branches")  # the worker processes' scratch geodatabases go in these folders next to the workspace
+CDTFA_CHECKPOINT_NAME = "cdtfa_download_checkpoint.json"  # goes next to the workspace too, with the open engine's pages in a ".pages" folder beside it
+
+### PROFILING CONFIGS ###
+# Each stage, CDTFARetrieve method, and geometry engine operation records its wall time, CPU time, peak memory, and
+# feature counts in a JSON run report next to run_log.txt.
+PROFILE_ENABLED = True
+PROFILE_COUNT_VERTICES = False  # also count vertices - it reads every geometry of each counted dataset, so only turn it on to look into one step
+PROFILE_REPORT_NAME = "run_report.json"
+
+
+
+
+def create_workspace(resume=False):
     """
         Ensures that we have a workspace to write outputs to - sets it to both the default and scratch workspaces for everything els
-        By default, creates a file geodatabase. When it detects it's in ArcGIS Online Notebooks, it places this
-        geodatabase in the /arcgis/home folder. Otherwise, it generates a folder path with the tempfile package
+        By default, creates a file geodatabase in STAGE_WORKSPACE_FOLDER - in the /arcgis/home/bunnyhop folder when it detects it's
+        in ArcGIS Online Notebooks. A new run deletes the geodatabase, the stage manifest, the workers' scratch folders, and
+        the CDTFA download checkpoint from the last run first (and leaves everything else in the folder alone), and a resumed
+        run picks them back up. Since the workspace can outlive a run, tools are allowed to overwrite what's in it.
+
+    Args:
+        resume (bool, optional): keep the workspace from the last run so it can be resumed
 
     Returns:
         pathlib.PurePath: The full path to the file geodatabase workspace
     """
-    workspace_directory: Optional[pathlib.PurePath] = None
-
-    if IN_ARCGIS_ONLINE_NOTEBOOKS:
-        workspace_directory = pathlib.PurePath(os.getcwd()) / "home" / "workspace"
-    else:
-        workspace_directory = pathlib.PurePath(tempfile.mkdtemp(prefix="bunnyhop_workspace"))
-
-    gdb_name = "bunnyhop_workspace.gdb"
+    workspace_directory: pathlib.PurePath = STAGE_WORKSPACE_FOLDER
+    gdb_name = STAGE_WORKSPACE_GDB_NAME
     gdb_path = workspace_directory / gdb_name
-    arcpy.management.CreateFileGDB(str(workspace_directory), gdb_name)
-
-    arcpy.env.workspace = str(gdb_path)
-    arcpy.env.scratchWorkspace = str(gdb_path)
+    manifest_path = workspace_directory / STAGE_MANIFEST_NAME
+    checkpoint_path = workspace_directory / CDTFA_CHECKPOINT_NAME
+    if not resume:
+        for folder in [gdb_path, workspace_directory / f"{CDTFA_CHECKPOINT_NAME}.pages"] + [workspace_directory / name for name in STAGE_SCRATCH_FOLDER_NAMES]:
+            if os.path.isdir(str(folder)):
+                shutil.rmtree(str(folder))
+        for file_path in (manifest_path, checkpoint_path):
+            if os.path.exists(str(file_path)):
+                os.remove(str(file_path))
+    os.makedirs(str(workspace_directory), exist_ok=True)
+
+    if arcpy is not None:
+        if not arcpy.Exists(str(gdb_path)):
+            arcpy.management.CreateFileGDB(str(workspace_directory), gdb_name)
+
+        arcpy.env.workspace = str(gdb_path)
+        arcpy.env.scratchWorkspace = str(gdb_path)
+        arcpy.env.overwriteOutput = True  # a resumed stage, or a cache hit, can land on a dataset from an earlier run
 
     return workspace_directory, gdb_path
 
@@ -190,16 +293,17 @@ def config_logging(config):
     log.info("Logging configured")
 
 
-def startup():
-    global FOLDER_WORKSPACE, GDB_WORKSPACE, LOG_FILE_PATH, LOGGING_CONFIG
+def startup(resume=False):
+    global FOLDER_WORKSPACE, GDB_WORKSPACE, LOG_FILE_PATH, LOGGING_CONFIG, PROFILE_REPORT_PATH
 
-    workspace_dir, gdb_path = create_workspace()
+    workspace_dir, gdb_path = create_workspace(resume=resume)
     log_dir = workspace_dir / "logs"
     log_path = log_dir / "run_log.txt"
 
     FOLDER_WORKSPACE = workspace_dir
     GDB_WORKSPACE = gdb_path
     LOG_FILE_PATH = log_path
+    PROFILE_REPORT_PATH = log_dir / PROFILE_REPORT_NAME
     LOGGING_CONFIG["handlers"]["file_logger"]["filename"] = str(log_path)
     
     config_logging(config=LOGGING_CONFIG)
@@ -0,0 +1,109 @@
+"""
+    Fills in attributes we derive from other attributes (or from the geometry) in a single pass over a feature class.
+
+    Each derived field is declared once as a DerivedField - its name, type, and a function that calculates its value
+    from the record's other values. calculate_fields adds every field that doesn't exist yet with one AddFields call,
+    then runs the steps in order for each record in one UpdateCursor pass, so every step sees the values the steps
+    before it produced. Besides DerivedFields, a step can be anything with `fields` and `apply(values)`, like
+    rule_engine.AdjustmentRules.
+"""
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+class DerivedField:
+
+    def __init__(self, name, field_type, calculate, sources=(), length=None, alias=None):
+        """
+        Args:
+            name (str): name of the field to fill in
+            field_type (str): field type as AddField takes it (TEXT, LONG, DOUBLE, etc)
+            calculate (callable): called with a dictionary of the record's values (keyed by field name) and returns this field's value
+            sources (tuple, optional): fields calculate reads - include "SHAPE@" to get the geometry
+            length (int, optional): field length for TEXT fields
+            alias (str, optional): field alias. Defaults to the name
+        """
+        self.name = name
+        self.field_type = field_type
+        self.calculate = calculate
+        self.sources = tuple(sources)
+        self.length = length
+        self.alias = alias or name
+
+    @property
+    def fields(self) -> tuple:
+        return self.sources + (self.name,)
+
+    @property
+    def definition(self) -> list:
+        """
+            The field definition to pass to AddFields
+        """
+        definition = [self.name, self.field_type, self.alias]
+        if self.length is not None:
+            definition.append(self.length)
+        return definition
+
+    def apply(self, values):
+        values[self.name] = self.calculate(values)
+
+
+def constant(name, value, field_type="TEXT", length=255):
+    """
+        A field that gets the same value on every record
+    """
+    return DerivedField(name, field_type, lambda values: value, length=length)
+
+
+def copy_of(name, source, field_type="TEXT", length=255):
+    """
+        A field that gets the value of another field
+    """
+    return DerivedField(name, field_type, lambda values: values[source], sources=(source,), length=length)
+
+
+def area(name, spatial_reference, square_meters):
+    """
+        A field with the area of the geometry, calculated in spatial_reference (which should be an equal area projection)
+
+    Args:
+        name (str): name of the area field
+        spatial_reference (arcpy.SpatialReference): coordinate system to calculate the area in
+        square_meters (float): square meters in the area unit to report the area in - see geometry_engine's area_field
+    """
+
+    def calculate(values):
+        shape = values["SHAPE@"]
+        if shape is None:
+            return None
+        return shape.projectAs(spatial_reference).getArea("PLANAR", "SQUAREMETERS") / square_meters
+
+    return DerivedField(name, "DOUBLE", calculate, sources=("SHAPE@",))
+
+
+def calculate_fields(features, steps):
+    """
+        Adds any derived fields that don't exist yet, then runs the steps for every record in one cursor pass
+
+    Args:
+        features (str): path to the feature class or table
+        steps (list): DerivedFields, or other objects with `fields` and `apply(values)`, in the order they should run
+    """
+    existing_fields = set(field.name for field in arcpy.ListFields(features))
+    new_fields = [step for step in steps if isinstance(step, DerivedField) and step.name not in existing_fields]
+    if new_fields:
+        arcpy.management.AddFields(features, [step.definition for step in new_fields])
+
+    available_fields = existing_fields | set(step.name for step in new_fields) | {"SHAPE@"}
+    steps = [step.for_fields(available_fields) if hasattr(step, "for_fields") else step for step in steps]
+
+    cursor_fields = list(dict.fromkeys(field_name for step in steps for field_name in step.fields))
+    with arcpy.da.UpdateCursor(features, cursor_fields) as cursor:
+        for row in cursor:
+            values = dict(zip(cursor_fields, row))
+            for step in steps:
+                step.apply(values)
+            cursor.updateRow([values[field_name] for field_name in cursor_fields])
@@ -0,0 +1,361 @@
+"""
+    A local cache for the upstream data sources, so that a scheduled run where nothing changed upstream doesn't
+    download everything again.
+
+    Files (the GNIS zip, the Census workbook) are stored by the SHA-256 of their contents in an objects folder. An
+    index.json keeps each source URL's validators (ETag and Last-Modified) along with the hash of the content they
+    belong to. Every request sends the validators back as If-None-Match/If-Modified-Since, and when the server
+    answers 304 Not Modified, we hand back the cached copy.
+
+    Feature layers don't answer conditional requests, so for those we read the layer's last edit date and its fields
+    from its service definition instead and keep a copy of the downloaded features keyed on them - in a file geodatabase
+    for the arcpy engine, or in the columnar_store format for the open engine.
+
+    Items that haven't been used in config.DOWNLOAD_CACHE_MAX_AGE_DAYS are removed, then the least recently used
+    items are removed until the cache fits in config.DOWNLOAD_CACHE_MAX_BYTES.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+from . import config
+from . import feature_service
+from . import http_client
+
+log = logging.getLogger("bunnyhop.download_cache")
+
+STALE_DOWNLOAD_SECONDS = 24 * 60 * 60  # temporary download files older than this are from a run that was interrupted
+
+
+class DownloadCache:
+
+    def __init__(self,
+                 folder=config.DOWNLOAD_CACHE_FOLDER,
+                 max_bytes=config.DOWNLOAD_CACHE_MAX_BYTES,
+                 max_age_days=config.DOWNLOAD_CACHE_MAX_AGE_DAYS,
+                 chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+        self.folder = pathlib.Path(folder)
+        self.objects_folder = self.folder / "objects"
+        self.layers_folder = self.folder / "layers"
+        self.index_path = self.folder / "index.json"
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+
+        os.makedirs(self.objects_folder, exist_ok=True)
+        os.makedirs(self.layers_folder, exist_ok=True)
+        self.index = self._load_index()
+
+    def fetch(self, url) -> pathlib.Path:
+        """
+            Returns the path to a local copy of the file at url, downloading it only if the server says it
+            changed since we last retrieved it. The returned file is owned by the cache - don't modify or delete it.
+        """
+        return self._fetch(url)[0]
+
+    def open(self, url, spool_max_size=config.DOWNLOAD_SPOOL_MAX_SIZE):
+        """
+            Opens the file at url for reading as a binary file. When the cached copy is current, that's what gets opened.
+            Otherwise the download goes into the cache and into a spooled temporary file at the same time, and the spooled
+            copy is handed back, so it's read from memory (up to spool_max_size) instead of back off of the disk.
+
+        Returns:
+            file object: works as a context manager, and should be closed by the caller
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_max_size, prefix="bunnyhop_download")
+        try:
+            object_path, downloaded = self._fetch(url, copy_to=spool)
+        except Exception:
+            spool.close()
+            raise
+
+        if not downloaded:
+            spool.close()
+            return open(object_path, 'rb')
+        spool.seek(0)
+        return spool
+
+    def _fetch(self, url, copy_to=None, conditional=True):
+        """
+            Does the work of fetch, also writing a new download to copy_to as it arrives
+
+        Args:
+            conditional (bool, optional): send the cached copy's validators, if there is a cached copy
+
+        Returns:
+            tuple: the path to the cached copy, and whether it had to be downloaded
+        """
+        with self._lock:
+            entry = self.index["files"].get(url)
+
+        headers = {}
+        if conditional and entry and (self.objects_folder / entry["sha256"]).exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        with http_client.get_client().stream(url, headers=headers) as response:
+            if response.status_code == 304:
+                if not headers:
+                    raise RuntimeError(f"{url} answered 304 Not Modified to a request without validators")
+
+                object_path = self.objects_folder / entry["sha256"]
+                if object_path.exists():
+                    log.debug(f"{url} not modified - using cached copy")
+                    with self._lock:
+                        entry["last_used"] = time.time()
+                        self._save_index()
+                    return object_path, False
+                log.debug(f"{url} not modified, but the cached copy is gone - downloading it again")
+            else:
+                response.raise_for_status()
+                return self._store(url, response, copy_to), True
+
+        return self._fetch(url, copy_to=copy_to, conditional=False)  # after the first response is closed, so it gives up its slot
+
+    def _store(self, url, response, copy_to=None) -> pathlib.Path:
+        """
+            Downloads the body of response into the cache as the content for url, also writing it to copy_to as it arrives
+
+        Returns:
+            pathlib.Path: the path to the cached copy
+        """
+        log.debug(f"Downloading {url} into the cache")
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.objects_folder, prefix="download_", delete=False) as outf:
+            try:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    outf.write(chunk)
+                    if copy_to is not None:
+                        copy_to.write(chunk)
+            except BaseException:
+                outf.close()
+                os.unlink(outf.name)  # don't leave a partial download behind
+                raise
+
+        sha256 = digest.hexdigest()
+        object_path = self.objects_folder / sha256
+        os.replace(outf.name, object_path)  # if the content is identical to something we already have, this just replaces it with itself
+
+        with self._lock:
+            self.index["files"][url] = {
+                "sha256": sha256,
+                "size": size,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "last_used": time.time(),
+            }
+            self._evict(keep=url)
+            self._save_index()
+
+        return object_path
+
+    def fetch_layer(self, url, out_feature_class, download, query=None, store=None) -> bool:
+        """
+            Writes the features from the layer at url to out_feature_class, copying them out of the cache if the layer's
+            data and fields haven't changed since we last downloaded it.
+
+        Args:
+            url (str): URL of the feature layer
+            out_feature_class (str): full path of the feature class to create
+            download (callable): called with out_feature_class when the layer needs to be downloaded. Should write the layer's features there.
+            query (str, optional): describes what download asks the server for and how it writes it (a where clause, an output spatial
+                reference, renamed fields, etc) when it doesn't download the whole layer as is. Each query of the same layer is cached separately.
+            store (optional): how cached copies are written and read - an object with a suffix for their names and exists(path),
+                save(features, path), and load(path, out_feature_class) methods. Defaults to GeodatabaseStore.
+
+        Returns:
+            bool: True if the features came out of the cache
+        """
+        store = store or GeodatabaseStore()
+        info = layer_info(url)
+        edit_date = feature_service.layer_edit_date(info)
+        if edit_date is None:  # no way to tell if it changed, so don't cache it
+            log.debug(f"{url} doesn't report an edit date - downloading without the cache")
+            download(out_feature_class)
+            return False
+
+        cache_id = url if query is None else f"{url}?{query}"
+        fields = json.dumps([[field["name"], field["type"]] for field in info.get("fields", [])])  # a schema change alone doesn't always move the data edit date
+        key = hashlib.sha256(f"{cache_id}|{edit_date}|{fields}".encode("utf-8")).hexdigest()
+        cached_path = self.layers_folder / f"{key}{store.suffix}"
+
+        with self._lock:
+            entry = self.index["layers"].get(cache_id)
+
+        if entry and entry["key"] == key and _layer_name(entry) == cached_path.name and store.exists(str(cached_path)):
+            log.debug(f"{cache_id} not edited since {datetime.datetime.fromtimestamp(edit_date / 1000, tz=datetime.UTC)} - using cached copy")
+            store.load(str(cached_path), out_feature_class)
+            with self._lock:
+                entry["last_used"] = time.time()
+                self._save_index()
+            return True
+
+        download(out_feature_class)
+
+        log.debug(f"Storing {cache_id} in the cache")
+        store.save(out_feature_class, str(cached_path))
+
+        with self._lock:
+            self.index["layers"][cache_id] = {
+                "key": key,
+                "name": cached_path.name,
+                "size": _folder_size(cached_path),
+                "last_used": time.time(),
+            }
+            self._evict(keep=cache_id)
+            self._save_index()
+
+        return False
+
+    def _evict(self, keep=None):
+        """
+            Removes stale entries, then the least recently used entries until the cache is under max_bytes. Expects the lock to be held.
+
+        Args:
+            keep (str, optional): URL of an entry that must stay, even if on its own it's bigger than max_bytes - the one we're about to hand back
+        """
+        now = time.time()
+        entries = [(kind, url, entry) for kind in ("files", "layers") for url, entry in self.index[kind].items() if url != keep]
+        entries.sort(key=lambda item: item[2]["last_used"])  # oldest first
+
+        # files are content-addressed, so two URLs could share one - count each object (and each layer copy) once
+        stored = {(kind, _stored_name(kind, entry)): entry["size"] for kind in ("files", "layers") for entry in self.index[kind].values()}
+        total_size = sum(stored.values())
+        for kind, url, entry in entries:
+            if now - entry["last_used"] < self.max_age_seconds and total_size <= self.max_bytes:
+                break
+
+            log.debug(f"Evicting {url} from the cache")
+            del self.index[kind][url]
+            name = _stored_name(kind, entry)
+            if not any(_stored_name(kind, other) == name for other in self.index[kind].values()):
+                total_size -= entry["size"]
+
+        # now clean up anything on disk that isn't referenced anymore, including downloads an interrupted run left behind
+        referenced_objects = set(entry["sha256"] for entry in self.index["files"].values())
+        for object_path in self.objects_folder.iterdir():
+            if object_path.name.startswith("download_"):
+                if now - object_path.stat().st_mtime > STALE_DOWNLOAD_SECONDS:  # one still being written has been touched recently
+                    object_path.unlink(missing_ok=True)
+            elif object_path.name not in referenced_objects:
+                object_path.unlink()
+
+        referenced_layers = set(_layer_name(entry) for entry in self.index["layers"].values())
+        for layer_path in self.layers_folder.iterdir():
+            if layer_path.name not in referenced_layers:
+                shutil.rmtree(layer_path, ignore_errors=True)
+
+    def _load_index(self):
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as index_file:
+                return json.load(index_file)
+        return {"files": {}, "layers": {}}
+
+    def _save_index(self):
+        temp_path = self.index_path.with_suffix(".json.tmp")
+        with open(temp_path, 'w') as index_file:
+            json.dump(self.index, index_file, indent=2)
+        os.replace(temp_path, self.index_path)  # swap it in all at once so an interrupted run can't leave a partial index
+
+
+class GeodatabaseStore:
+    """
+        Keeps cached feature layers as feature classes in file geodatabases, for the arcpy engine
+    """
+
+    suffix = ".gdb"
+
+    def exists(self, path) -> bool:
+        return arcpy.Exists(os.path.join(path, "features"))
+
+    def save(self, features, path):
+        if not arcpy.Exists(path):
+            folder, name = os.path.split(path)
+            arcpy.management.CreateFileGDB(folder, name)
+        arcpy.management.Copy(features, os.path.join(path, "features"))
+
+    def load(self, path, out_feature_class):
+        if arcpy.Exists(out_feature_class):  # left from an earlier run in a kept workspace
+            arcpy.management.Delete(out_feature_class)
+        arcpy.management.Copy(os.path.join(path, "features"), out_feature_class)
+
+
+def layer_info(url) -> dict:
+    """
+        Returns the layer's service definition
+    """
+    response = http_client.get_client().get(url, params={"f": "json"})
+    response.raise_for_status()
+    return response.json()
+
+
+def layer_edit_date(url):
+    """
+        Returns the layer's last edit date (milliseconds since the epoch) from its service definition, or None if it doesn't have one
+    """
+    return feature_service.layer_edit_date(layer_info(url))
+
+
+def _stored_name(kind, entry):
+    """
+        The name of what an index entry points to on disk - entries can share it
+    """
+    return entry["sha256"] if kind == "files" else _layer_name(entry)
+
+
+def _layer_name(entry):
+    """
+        The name of a cached layer copy in the layers folder. Entries from before there was more than one kind of copy don't record it.
+    """
+    return entry.get("name", f"{entry['key']}.gdb")
+
+
+def _folder_size(folder):
+    return sum(path.stat().st_size for path in pathlib.Path(folder).rglob("*") if path.is_file())
+
+
+_cache = None
+
+
+def get_cache():
+    """
+        Returns the shared cache for this process, or None if caching is disabled in the config
+    """
+    global _cache
+
+    if not config.DOWNLOAD_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = DownloadCache()
+    return _cache
+
+
+def fetch_layer(url, out_feature_class, download, query=None, store=None):
+    """
+        Convenience wrapper around DownloadCache.fetch_layer that just calls download when caching is disabled
+    """
+    cache = get_cache()
+    if cache is None:
+        download(out_feature_class)
+        return False
+    return cache.fetch_layer(url, out_feature_class, download, query=query, store=store)
@@ -0,0 +1,272 @@
+"""
+    Paged downloads of ArcGIS feature layers through their REST endpoints.
+
+    FeatureLayer.query() pulls an entire layer into memory as one FeatureSet before anything is written. For the
+    parcel-level CDTFA layer, that's a lot. Instead, we ask the layer for its ObjectIDs, split them into ObjectID range
+    pages no bigger than the layer's maxRecordCount, fetch the pages with a small pool of threads, and insert each page
+    into the output feature class as it arrives. A checkpoint file records the pages that have been written, so
+    an interrupted download picks up where it left off instead of starting over.
+
+    The reading side (PagedLayerReader) only speaks HTTP, so it can be tested against a local stand-in server. The
+    writing side (download_layer) is what puts the features into a geodatabase.
+"""
+
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import os
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+from . import config
+from . import http_client
+
+log = logging.getLogger("bunnyhop.feature_service")
+
+# ArcGIS REST field types mapped to the field types AddField takes. Anything not in here (OIDs, geometry, GlobalIDs,
+# and the service's own Shape__Area/Shape__Length) isn't copied - the geodatabase manages those itself
+FIELD_TYPES = {
+    "esriFieldTypeString": "TEXT",
+    "esriFieldTypeSmallInteger": "SHORT",
+    "esriFieldTypeInteger": "LONG",
+    "esriFieldTypeBigInteger": "BIGINTEGER",
+    "esriFieldTypeSingle": "FLOAT",
+    "esriFieldTypeDouble": "DOUBLE",
+    "esriFieldTypeDate": "DATE",
+    "esriFieldTypeGUID": "GUID",
+}
+
+GEOMETRY_TYPES = {
+    "esriGeometryPolygon": "POLYGON",
+    "esriGeometryPolyline": "POLYLINE",
+    "esriGeometryPoint": "POINT",
+    "esriGeometryMultipoint": "MULTIPOINT",
+}
+
+
+class PagedLayerReader:
+    """
+        Reads a feature layer's features in ObjectID range pages, fetching several pages at once.
+    """
+
+    def __init__(self, url, where="1=1", out_sr=None, page_size=config.FEATURE_SERVICE_PAGE_SIZE, max_workers=config.FEATURE_SERVICE_MAX_WORKERS):
+        self.url = url.rstrip("/")
+        self.where = where
+        self.out_sr = out_sr
+        self.max_workers = max_workers
+        self.client = http_client.get_client()
+
+        self.info = self._get(self.url, {})
+        self.oid_field = self.info["objectIdField"]
+        self.page_size = page_size or self.info.get("maxRecordCount", 1000)
+
+    def object_ids(self) -> list:
+        ids = self._get(f"{self.url}/query", {"where": self.where, "returnIdsOnly": "true"}).get("objectIds") or []
+        return sorted(ids)
+
+    def plan_pages(self, object_ids=None) -> list:
+        """
+            Splits the layer's ObjectIDs into pages of at most page_size IDs.
+
+        Returns:
+            list: [first ObjectID, last ObjectID] pairs, inclusive. There can be gaps in the IDs, so a range can be wider than the page size
+        """
+        if object_ids is None:
+            object_ids = self.object_ids()
+
+        return [[object_ids[start], object_ids[min(start + self.page_size, len(object_ids)) - 1]]
+                for start in range(0, len(object_ids), self.page_size)]
+
+    def fetch_page(self, page) -> list:
+        """
+            Returns the features (as Esri JSON dictionaries) with ObjectIDs in the page's range
+        """
+        where = f"({self.where}) AND {self.oid_field} >= {page[0]} AND {self.oid_field} <= {page[1]}"
+        params = {"where": where, "outFields": "*", "returnGeometry": "true"}
+        if self.out_sr is not None:
+            params["outSR"] = self.out_sr
+
+        result = self._get(f"{self.url}/query", params)
+        if result.get("exceededTransferLimit"):
+            raise RuntimeError(f"Page {page} of {self.url} returned more records than the server allows - use a smaller page size")
+        return result.get("features", [])
+
+    def iter_pages(self, pages):
+        """
+            Fetches the pages concurrently and yields (page, features) for each one as it arrives - not necessarily in order.
+            Only a couple of pages per worker are requested ahead of the caller, so memory use stays bounded.
+        """
+        pages = iter(pages)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {executor.submit(self.fetch_page, page): page for page in itertools.islice(pages, self.max_workers * 2)}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    page = pending.pop(future)
+                    yield page, future.result()
+
+                    next_page = next(pages, None)
+                    if next_page is not None:
+                        pending[executor.submit(self.fetch_page, next_page)] = next_page
+
+    def _get(self, url, params):
+        response = self.client.get(url, params=dict(params, f="json"))
+        response.raise_for_status()
+        result = response.json()
+        if "error" in result:  # the REST API reports errors with a 200 status
+            raise RuntimeError(f"Request to {url} failed: {result['error']}")
+        return result
+
+
+class PageCheckpoint:
+    """
+        Keeps track of which pages of a download have been written, in a JSON file next to the workspace
+    """
+
+    def __init__(self, path, url, pages, completed=None, edit_date=None):
+        self.path = path
+        self.url = url
+        self.pages = pages
+        self.completed = completed or []
+        self.edit_date = edit_date
+
+    @classmethod
+    def load(cls, path, url, edit_date):
+        """
+            Returns the checkpoint at path if it's for the same layer and the layer hasn't been edited since, otherwise None
+        """
+        if path is None or not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as checkpoint_file:
+            data = json.load(checkpoint_file)
+        if data["url"] != url or data["edit_date"] != edit_date:
+            return None
+        return cls(path, url, data["pages"], data["completed"], edit_date)
+
+    @property
+    def remaining(self) -> list:
+        return [page for page in self.pages if page not in self.completed]
+
+    def mark_complete(self, page):
+        self.completed.append(page)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump({"url": self.url, "edit_date": self.edit_date, "pages": self.pages, "completed": self.completed}, checkpoint_file)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def download_layer(url, out_feature_class, where="1=1", out_sr=None, checkpoint_path=None, field_map=None,
+                   page_size=config.FEATURE_SERVICE_PAGE_SIZE, max_workers=config.FEATURE_SERVICE_MAX_WORKERS):
+    """
+        Downloads a feature layer into out_feature_class page by page. If checkpoint_path is provided and has a checkpoint from an
+        interrupted download of the same layer, only the pages that weren't finished are downloaded.
+
+        The source ObjectID of each feature is kept in a SOURCE_<ObjectID field> field, which is how we clear out a page that was
+        only partially written before an interruption.
+
+    Args:
+        url (str): URL of the feature layer
+        out_feature_class (str): full path of the feature class to write
+        where (str, optional): only download features matching this where clause. Defaults to everything.
+        out_sr (int, optional): WKID of the spatial reference to request the features in. Defaults to the layer's own.
+        checkpoint_path (str, optional): where to keep the checkpoint file. Defaults to no checkpoint.
+        field_map (dict, optional): source field names mapped to the names to give them in out_feature_class. Mapped fields are
+            written as text. Renaming while we write saves rewriting the whole table to rename them afterward.
+    """
+    field_map = field_map or {}
+    reader = PagedLayerReader(url, where=where, out_sr=out_sr, page_size=page_size, max_workers=max_workers)
+    edit_date = layer_edit_date(reader.info)
+    source_oid_field = f"SOURCE_{reader.oid_field}"
+
+    checkpoint = PageCheckpoint.load(checkpoint_path, url, edit_date)
+    if checkpoint is not None and arcpy.Exists(out_feature_class):
+        log.info(f"Resuming download of {url} - {len(checkpoint.completed)} of {len(checkpoint.pages)} pages already written")
+        _delete_pages(out_feature_class, source_oid_field, checkpoint.remaining)
+    else:
+        checkpoint = PageCheckpoint(checkpoint_path, url, reader.plan_pages(), edit_date=edit_date)
+        checkpoint.save()
+        _create_feature_class(out_feature_class, reader.info, source_oid_field, out_sr, field_map)
+
+    spatial_reference = {"wkid": out_sr} if out_sr is not None else reader.info.get("extent", {}).get("spatialReference")
+    fields = [field for field in reader.info["fields"] if field["type"] in FIELD_TYPES and not field["name"].startswith("Shape__")]
+    cursor_fields = ["SHAPE@", source_oid_field] + [field_map.get(field["name"], field["name"]) for field in fields]
+
+    total_pages = len(checkpoint.pages)
+    for page, features in reader.iter_pages(checkpoint.remaining):
+        with arcpy.da.InsertCursor(out_feature_class, cursor_fields) as cursor:
+            for feature in features:
+                attributes = feature["attributes"]
+                geometry = feature.get("geometry")
+                shape = arcpy.AsShape(dict(geometry, spatialReference=spatial_reference), True) if geometry else None
+                cursor.insertRow([shape, attributes[reader.oid_field]] + [_convert_value(attributes.get(field["name"]), field["type"], field["name"] in field_map) for field in fields])
+
+        checkpoint.mark_complete(page)
+        log.debug(f"Wrote page {len(checkpoint.completed)} of {total_pages} from {url}")
+
+    checkpoint.remove()
+
+
+def layer_edit_date(info):
+    """
+        Returns when a layer's data was last edited (milliseconds since the epoch) from its service definition, or None if it doesn't
+        say. dataLastEditDate only changes when features do, so it's preferred over lastEditDate, which changes with the schema too.
+    """
+    editing_info = info.get("editingInfo", {})
+    return editing_info.get("dataLastEditDate", editing_info.get("lastEditDate"))
+
+
+def _create_feature_class(out_feature_class, info, source_oid_field, out_sr, field_map):
+    if arcpy.Exists(out_feature_class):
+        arcpy.management.Delete(out_feature_class)
+
+    spatial_reference = out_sr or info.get("extent", {}).get("spatialReference", {}).get("latestWkid") or info.get("extent", {}).get("spatialReference", {}).get("wkid")
+    workspace, name = os.path.split(out_feature_class)
+    arcpy.management.CreateFeatureclass(workspace, name,
+                                        geometry_type=GEOMETRY_TYPES[info["geometryType"]],
+                                        spatial_reference=arcpy.SpatialReference(spatial_reference))
+
+    field_definitions = [[source_oid_field, "LONG"]]
+    for field in info["fields"]:
+        if field["type"] not in FIELD_TYPES or field["name"].startswith("Shape__"):
+            continue
+        if field["name"] in field_map:
+            definition = [field_map[field["name"]], "TEXT", field_map[field["name"]], 255]
+        else:
+            definition = [field["name"], FIELD_TYPES[field["type"]], field.get("alias") or field["name"]]
+            if field["type"] == "esriFieldTypeString":
+                definition.append(field.get("length", 255))
+        field_definitions.append(definition)
+    arcpy.management.AddFields(out_feature_class, field_definitions)
+
+
+def _delete_pages(out_feature_class, source_oid_field, pages):
+    """
+        Clears out anything already written for pages that weren't marked complete - at most one page will have been partially written
+    """
+    for page in pages:
+        with arcpy.da.UpdateCursor(out_feature_class, [source_oid_field], where_clause=f"{source_oid_field} >= {page[0]} AND {source_oid_field} <= {page[1]}") as cursor:
+            for row in cursor:
+                cursor.deleteRow()
+
+
+def _convert_value(value, field_type, as_text=False):
+    if value is not None and field_type == "esriFieldTypeDate":  # dates come across as milliseconds since the epoch
+        value = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=value)
+    if value is not None and as_text:
+        value = str(value)
+    return value
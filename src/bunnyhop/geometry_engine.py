@@ -0,0 +1,1255 @@
+"""
+    Geometry engines - the geoprocessing operations the CDTFA pipeline runs, behind one interface so that the heavy
+    geometry stages aren't tied to arcpy.
+
+    ArcpyEngine runs them with arcpy tools against feature classes in the current workspace, the same way the pipeline
+    always has. OpenEngine runs them in memory on NumPy coordinate arrays with shapely and pyproj (install them with
+    `pip install bunnyhop[open]`), so those stages can be run and benchmarked on Linux machines without ArcGIS. OpenEngine
+    keeps its datasets in a dictionary and refers to them by name like feature classes in a workspace - a full path is
+    reduced to its last part. Its intermediates never touch a geodatabase - they can be saved in the columnar_store
+    format, and only the final outputs get written out to a geodatabase with export.
+
+    Filters for select are small tuples instead of SQL, so each engine can translate them its own way:
+        (field, operator, value) - operator is one of =, <>, <, >, IN, NOT IN. Like SQL, a NULL never matches.
+        ("AND", filter, filter, ...) and ("OR", filter, filter, ...)
+    Use AREA as the field to compare against the area of the geometry in its own coordinate system's units.
+"""
+
+import functools
+import itertools
+import json
+import logging
+import os
+import tempfile
+import uuid
+
+import numpy
+import pandas
+
+try:
+    import arcpy
+except ImportError:  # OpenEngine runs without ArcGIS - only ArcpyEngine and OpenEngine.export need arcpy
+    arcpy = None
+
+from . import columnar_store
+from . import config
+from . import derived_fields
+from . import download_cache
+from . import feature_service
+from . import memory_tier
+from . import profiling
+from . import spatial_index
+
+log = logging.getLogger("bunnyhop.geometry_engine")
+
+AREA = "@AREA"
+_SIZE_SAMPLE_ROWS = 100  # how many geometries ArcpyEngine reads to estimate a dataset's size for the memory budget
+
+# ArcGIS field types as reported by ListFields, mapped to the types AddField takes
+_ADD_FIELD_TYPES = {
+    "String": "TEXT",
+    "SmallInteger": "SHORT",
+    "Integer": "LONG",
+    "BigInteger": "BIGINTEGER",
+    "Single": "FLOAT",
+    "Double": "DOUBLE",
+    "Date": "DATE",
+    "GUID": "GUID",
+}
+
+# square meters in each of the area units CalculateGeometryAttributes takes
+_SQUARE_METERS = {
+    "SQUARE_METERS": 1,
+    "SQUARE_KILOMETERS": 1000 ** 2,
+    "HECTARES": 100 ** 2,
+    "ACRES": 4046.8564224,
+    "ACRES_US": 43560 * (1200 / 3937) ** 2,
+    "SQUARE_FEET_INT": 0.3048 ** 2,
+    "SQUARE_MILES_INT": 1609.344 ** 2,
+    "SQUARE_FEET_US": (1200 / 3937) ** 2,
+    "SQUARE_MILES_US": (5280 * 1200 / 3937) ** 2,
+}
+
+
+def to_sql(where) -> str:
+    """
+        Translates a filter into a where clause for arcpy
+    """
+    if where is None:
+        return None
+
+    if where[0] in ("AND", "OR"):
+        return f" {where[0]} ".join(f"({to_sql(condition)})" for condition in where[1:])
+
+    field_name, operator, value = where
+    field_name = "Shape_Area" if field_name == AREA else field_name
+    if operator in ("IN", "NOT IN"):
+        return f"{field_name} {operator} ({','.join(_sql_value(item) for item in value)})" if value else ("1=0" if operator == "IN" else "1=1")
+    return f"{field_name} {operator} {_sql_value(value)}"
+
+
+def _sql_value(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+class ArcpyEngine:
+    """
+        Runs the operations with arcpy tools against feature classes and tables in the current workspace.
+
+        With a memory budget, datasets created by name go to the in-memory workspace instead, and the least recently used
+        ones get moved into the workspace geodatabase once they add up to more than the budget. Datasets given as full paths
+        are always read and written where the path says.
+    """
+
+    name = "arcpy"
+    supports_worker_processes = True  # workers can each get a scratch geodatabase and hand back paths
+
+    def __init__(self, memory_budget_bytes=None):
+        if arcpy is None:
+            raise ImportError("The arcpy geometry engine needs ArcGIS Pro's arcpy - use the open engine without it")
+        self.memory = memory_tier.MemoryTier(memory_budget_bytes, self._memory_size, self._spill) if memory_budget_bytes else None
+
+    def _path(self, dataset) -> str:
+        """
+            Returns where a dataset actually is - in the memory workspace, or the name or path we were given
+        """
+        dataset = str(dataset)
+        if self.memory is not None and dataset in self.memory:
+            self.memory.touch(dataset)
+            return os.path.join("memory", dataset)
+        return dataset
+
+    def _output(self, name) -> str:
+        """
+            Returns where to write a new dataset - in memory if we have a budget and name isn't a full path
+        """
+        name = str(name)
+        if self.memory is None or os.path.dirname(name):
+            return name
+        return os.path.join("memory", name)
+
+    @property
+    def workspace(self) -> str:
+        """
+            The geodatabase datasets named without a path are written to
+        """
+        return arcpy.env.workspace
+
+    def _created(self, name):
+        name = str(name)
+        if self.memory is not None and not os.path.dirname(name):
+            self.memory.track(name)
+
+    def _memory_size(self, name) -> int:
+        """
+            Estimates how much memory a dataset takes - a fixed size for each attribute value, plus the geometries' size as
+            WKB, going by the first few geometries. This runs every time an operation creates a dataset, so it only reads a
+            sample instead of every geometry.
+        """
+        path = os.path.join("memory", name)
+        description = arcpy.da.Describe(path)
+        count = self.count(path)
+        fields = [field for field in description["fields"] if field.type not in ("Geometry", "OID")]
+        size = sum(field.length if field.type == "String" else 8 for field in fields) * count
+        if description.get("shapeFieldName"):
+            with arcpy.da.SearchCursor(path, ["SHAPE@WKB"]) as cursor:
+                sample = [len(row[0]) for row in itertools.islice(cursor, _SIZE_SAMPLE_ROWS) if row[0] is not None]
+            if sample:
+                size += sum(sample) * count // len(sample)
+        return size
+
+    def _spill(self, name):
+        """
+            Moves a dataset from the memory workspace into the workspace geodatabase, keeping its name
+        """
+        arcpy.management.Copy(os.path.join("memory", name), os.path.join(arcpy.env.workspace, name))
+        arcpy.management.Delete(os.path.join("memory", name))
+
+    def on_disk(self, dataset) -> str:
+        """
+            Returns the full path of a dataset in the workspace geodatabase, moving it there first if it's in memory. Use it
+            before handing a dataset to another process, since each process has its own memory workspace.
+        """
+        dataset = str(dataset)
+        if self.memory is not None and dataset in self.memory:
+            self._spill(dataset)
+            self.memory.forget(dataset)
+        elif os.path.dirname(dataset) == "memory":  # written straight to memory, like the lookup tables from bunny.frame_to_table
+            path = os.path.join(arcpy.env.workspace, os.path.basename(dataset))
+            arcpy.management.Copy(dataset, path)
+            arcpy.management.Delete(dataset)
+            return path
+        return dataset if os.path.dirname(dataset) else os.path.join(arcpy.env.workspace, dataset)
+
+    def exists(self, dataset) -> bool:
+        return arcpy.Exists(self._path(dataset))
+
+    def delete(self, dataset):
+        path = self._path(dataset)
+        if arcpy.Exists(path):
+            arcpy.management.Delete(path)
+        if self.memory is not None:
+            self.memory.forget(str(dataset))
+
+    def count(self, dataset) -> int:
+        return int(arcpy.management.GetCount(self._path(dataset))[0])
+
+    def vertex_count(self, dataset):
+        """
+            Returns the total number of vertices in a dataset's geometries, or None if it's a table
+        """
+        path = self._path(dataset)
+        if not hasattr(arcpy.Describe(path), "shapeFieldName"):
+            return None
+        with arcpy.da.SearchCursor(path, ["SHAPE@"]) as cursor:
+            return sum(row[0].pointCount for row in cursor if row[0] is not None)
+
+    def field_names(self, dataset) -> list:
+        return [field.name for field in arcpy.ListFields(self._path(dataset))]
+
+    def field_definitions(self, dataset, fields) -> list:
+        """
+            Returns what to pass to add_fields to create fields like these ones
+        """
+        dataset_fields = {field.name: field for field in arcpy.ListFields(self._path(dataset))}
+        definitions = []
+        for field_name in fields:
+            field = dataset_fields[field_name]
+            definition = [field_name, _ADD_FIELD_TYPES[field.type], field.aliasName or field_name]
+            if field.type == "String":
+                definition.append(field.length)
+            definitions.append(definition)
+        return definitions
+
+    def rows(self, dataset, fields, where=None):
+        with arcpy.da.SearchCursor(self._path(dataset), fields, where_clause=to_sql(where)) as cursor:
+            for row in cursor:
+                yield row
+
+    def spatial_reference_code(self, dataset):
+        """
+            Returns the WKID of the dataset's coordinate system, or None if it doesn't have one
+        """
+        return arcpy.Describe(self._path(dataset)).spatialReference.factoryCode or None
+
+    @profiling.profiled()
+    def fetch_layer(self, url, out_feature_class, where="1=1", out_sr=None, checkpoint_path=None, field_map=None, query=None) -> bool:
+        """
+            Downloads a feature layer with feature_service.download_layer, through the download cache. out_feature_class should
+            be a full path, since the cache copies the features there. The field map goes into the cache's query along with the
+            filter and spatial reference, since it changes the fields that get written.
+
+        Returns:
+            bool: True if the features came out of the cache
+        """
+        download = functools.partial(feature_service.download_layer, url, where=where, out_sr=out_sr, checkpoint_path=checkpoint_path, field_map=field_map)
+        return download_cache.fetch_layer(url, str(out_feature_class), download=download, query=_layer_query(where, out_sr, field_map, query))
+
+    @profiling.profiled()
+    def repair(self, dataset):
+        arcpy.management.RepairGeometry(self._path(dataset), delete_null=False)
+
+    def rename_field(self, dataset, field_name, new_name):
+        """
+            Renames a field, making it a text field. Text fields are renamed in place, which doesn't touch the data,
+            and only fields of other types get copied into a new text field.
+        """
+        path = self._path(dataset)
+        existing_fields = {field.name: field for field in arcpy.ListFields(path)}
+        if existing_fields[field_name].type == "String":
+            arcpy.management.AlterField(path, field_name, new_name, new_name)
+        else:
+            arcpy.management.AddField(path, new_name, "TEXT", field_is_nullable=True)
+            arcpy.management.CalculateField(path, new_name, f"!{field_name}!", "PYTHON")
+            arcpy.management.DeleteField(path, field_name)
+
+    def add_fields(self, dataset, definitions):
+        arcpy.management.AddFields(self._path(dataset), definitions)
+
+    def delete_fields(self, dataset, fields):
+        if fields:
+            arcpy.management.DeleteField(self._path(dataset), fields)
+
+    @profiling.profiled()
+    def select(self, source, output, where=None):
+        arcpy.analysis.Select(self._path(source), self._output(output), to_sql(where))
+        self._created(output)
+
+    @profiling.profiled()
+    def split(self, source, field, outputs):
+        """
+            Writes the features with each value of field out to their own dataset. The field gets an attribute index first, so
+            each value's Select only reads its own features instead of scanning the whole source.
+
+        Args:
+            outputs (dict): value -> the dataset to write its features to
+        """
+        path = self._path(source)
+        if not any(index.fields[0].name == field for index in arcpy.ListIndexes(path) if index.fields):
+            arcpy.management.AddIndex(path, [field], f"{field}_split_index")
+        for value, output in outputs.items():
+            self.delete(output)
+            arcpy.analysis.Select(path, self._output(output), to_sql((field, "=", value)))
+            self._created(output)
+
+    @profiling.profiled()
+    def select_intersecting(self, source, other, output, remainder_output, remainder_where=None) -> int:
+        """
+            Splits source into the features that intersect other and the ones that don't. Features whose envelopes don't meet any
+            of other's envelopes are sorted without an exact check, and the rest get an exact one with SelectLayerByLocation.
+
+        Args:
+            remainder_where (filter, optional): only keep the features that don't intersect other if they match this filter
+
+        Returns:
+            int: number of features that intersect other
+        """
+        source_path = self._path(source)
+        other_path = self._path(other)
+        with arcpy.da.SearchCursor(other_path, ["SHAPE@"]) as cursor:
+            other_index = spatial_index.STRTree([arcpy_envelope(row[0]) for row in cursor if row[0] is not None])
+
+        with arcpy.da.SearchCursor(source_path, ["OID@", "SHAPE@"]) as cursor:
+            candidates = [row[0] for row in cursor if row[1] is not None and other_index.query(arcpy_envelope(row[1]))]
+
+        oid_field = arcpy.Describe(source_path).OIDFieldName
+        intersecting = []
+        if candidates:
+            candidates_layer = arcpy.management.MakeFeatureLayer(source_path, "intersect_candidates", to_sql((oid_field, "IN", candidates)))
+            arcpy.management.SelectLayerByLocation(candidates_layer, "INTERSECTS", other_path)
+            with arcpy.da.SearchCursor(candidates_layer, ["OID@"]) as cursor:  # only returns the selected features
+                intersecting = [row[0] for row in cursor]
+            arcpy.management.Delete(candidates_layer)
+
+        remainder = (oid_field, "NOT IN", intersecting)
+        arcpy.analysis.Select(source_path, self._output(output), to_sql((oid_field, "IN", intersecting)))
+        self._created(output)
+        arcpy.analysis.Select(source_path, self._output(remainder_output), to_sql(("AND", remainder, remainder_where) if remainder_where else remainder))
+        self._created(remainder_output)
+
+        return len(intersecting)
+
+    @profiling.profiled()
+    def dissolve(self, source, output, fields, multi_part=True):
+        arcpy.management.Dissolve(self._path(source), out_feature_class=self._output(output), dissolve_field=";".join(fields), multi_part=multi_part)
+        self._created(output)
+
+    @profiling.profiled()
+    def join_field(self, target, key_field, join_table, join_key, fields):
+        """
+            Joins fields from join_table onto target in place - the first matching record wins
+        """
+        target_path = self._path(target)
+        join_path = self._path(join_table)
+        in_memory = target_path.startswith("memory") or join_path.startswith("memory")  # the memory workspace can't hold attribute indexes
+        arcpy.management.JoinField(target_path, in_field=key_field, join_table=join_path, join_field=join_key,
+                                   fields=fields, index_join_fields="NO_INDEXES" if in_memory else "NEW_INDEXES")
+
+    @profiling.profiled()
+    def union(self, inputs, output):
+        arcpy.analysis.Union([self._path(dataset) for dataset in inputs], self._output(output))
+        self._created(output)
+
+    @profiling.profiled()
+    def erase(self, source, eraser, output):
+        arcpy.analysis.Erase(self._path(source), self._path(eraser), self._output(output))
+        self._created(output)
+
+    @profiling.profiled()
+    def merge(self, inputs, output):
+        arcpy.management.Merge([self._path(dataset) for dataset in inputs], self._output(output))
+        self._created(output)
+
+    @profiling.profiled()
+    def append(self, source, target):
+        arcpy.management.Append(self._path(source), self._path(target), schema_type="NO_TEST")
+        if self.memory is not None and str(target) in self.memory:
+            self.memory.track(str(target))  # it grew
+
+    @profiling.profiled()
+    def copy(self, source, output):
+        arcpy.management.Copy(self._path(source), self._output(output))
+        self._created(output)
+
+    @profiling.profiled()
+    def project(self, source, output, spatial_reference):
+        arcpy.management.Project(in_dataset=self._path(source), out_dataset=self._output(output), out_coor_system=arcpy_spatial_reference(spatial_reference))
+        self._created(output)
+
+    @profiling.profiled()
+    def add_global_ids(self, datasets):
+        # GlobalIDs are a geodatabase feature, so anything still in memory goes to the workspace geodatabase first
+        arcpy.management.AddGlobalIDs([self.on_disk(dataset) for dataset in datasets])
+
+    @profiling.profiled()
+    def calculate_fields(self, dataset, steps):
+        derived_fields.calculate_fields(self._path(dataset), steps)
+
+    def area_field(self, name, spatial_reference, units):
+        return derived_fields.area(name, arcpy_spatial_reference(spatial_reference), _SQUARE_METERS[units])
+
+    @profiling.profiled()
+    def fix_slivers(self, dataset):
+        from . import coastline
+        coastline.fix_slivers(self._path(dataset))
+
+    @profiling.profiled()
+    def export(self, dataset, out_feature_class):
+        """
+            Writes a dataset out to a geodatabase feature class. A dataset in memory is moved there, and one that's already on
+            disk is only copied when out_feature_class is somewhere else.
+        """
+        path = self._path(dataset)
+        if self.memory is not None and str(dataset) in self.memory:
+            arcpy.management.Copy(path, str(out_feature_class))
+            arcpy.management.Delete(path)
+            self.memory.forget(str(dataset))
+        elif os.path.normcase(os.path.join(arcpy.env.workspace, path)) != os.path.normcase(str(out_feature_class)):
+            arcpy.management.Copy(path, str(out_feature_class))
+
+
+def arcpy_envelope(geometry):
+    extent = geometry.extent
+    return extent.XMin, extent.YMin, extent.XMax, extent.YMax
+
+
+class _Dataset:
+
+    def __init__(self, attributes, geometry=None, crs=None):
+        self.attributes = attributes.reset_index(drop=True)
+        self.geometry = geometry  # numpy array of shapely geometries, or None for a table
+        self.crs = crs
+
+
+class _Shape:
+    """
+        What OpenEngine hands to derived fields as SHAPE@ - the geometry along with its coordinate system
+    """
+
+    def __init__(self, geometry, crs):
+        self.geometry = geometry
+        self.crs = crs
+
+    def area_in(self, crs, square_meters):
+        import shapely
+        projected = shapely.transform(self.geometry, _transformer(self.crs, crs))
+        return float(shapely.area(projected)) / square_meters
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer_for(source_crs, target_crs):
+    import pyproj
+    transformer = pyproj.Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    return lambda coordinates: numpy.column_stack(transformer.transform(coordinates[:, 0], coordinates[:, 1]))
+
+
+def _transformer(source_crs, target_crs):
+    """
+        Returns a function that reprojects an (N, 2) array of coordinates, for shapely.transform
+    """
+    return _transformer_for(_crs(source_crs).to_wkt(), _crs(target_crs).to_wkt())
+
+
+def epsg_code(spatial_reference):
+    """
+        Returns the EPSG code (WKID) of an EPSG code, an arcpy.SpatialReference, or anything pyproj.CRS.from_user_input
+        accepts, or None if it doesn't have one
+    """
+    if spatial_reference is None or isinstance(spatial_reference, int):
+        return spatial_reference
+    if hasattr(spatial_reference, "factoryCode"):
+        return spatial_reference.factoryCode or None
+    return _crs(spatial_reference).to_epsg()
+
+
+def spatial_reference_text(spatial_reference):
+    """
+        Returns a spatial reference as text for settings and for sending to worker processes - an EPSG code as its digits, and
+        an arcpy.SpatialReference as its exportToString. spatial_reference_from_text turns it back into one.
+    """
+    if spatial_reference is None:
+        return None
+    if hasattr(spatial_reference, "exportToString"):
+        return spatial_reference.exportToString()
+    return str(spatial_reference)
+
+
+def spatial_reference_from_text(text):
+    if text is None:
+        return None
+    if text.isdigit():
+        return int(text)
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(text)
+    return spatial_reference
+
+
+def _crs(spatial_reference):
+    import pyproj
+    if hasattr(spatial_reference, "factoryCode"):  # an arcpy.SpatialReference
+        if spatial_reference.factoryCode:
+            return pyproj.CRS.from_epsg(spatial_reference.factoryCode)
+        return pyproj.CRS.from_wkt(spatial_reference.exportToString().split(";")[0])
+    if isinstance(spatial_reference, int):
+        return pyproj.CRS.from_epsg(spatial_reference)
+    return pyproj.CRS.from_user_input(spatial_reference)
+
+
+def arcpy_spatial_reference(spatial_reference):
+    """
+        Returns an arcpy.SpatialReference for an EPSG code or a pyproj.CRS. An arcpy.SpatialReference (or None) comes back as is.
+    """
+    if spatial_reference is None or hasattr(spatial_reference, "factoryCode"):
+        return spatial_reference
+    if isinstance(spatial_reference, int):
+        return arcpy.SpatialReference(spatial_reference)
+
+    crs = _crs(spatial_reference)
+    if crs.to_epsg() is not None:
+        return arcpy.SpatialReference(crs.to_epsg())
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(crs.to_wkt("WKT1_ESRI"))
+    return spatial_reference
+
+
+class OpenEngine:
+    """
+        Runs the operations in memory on NumPy coordinate arrays with shapely and pyproj. Datasets are loaded with
+        from_frame, fetch_layer, or load and read back with to_frame, save, or export. fetch_layer goes through the
+        download_cache like ArcpyEngine's does, keeping the layers it caches in the columnar_store format, and can resume
+        from a checkpoint, with the pages it has saved kept beside it.
+
+        With a memory budget, the least recently used datasets get saved in the columnar_store format in spill_folder once
+        the ones in memory add up to more than the budget, and are read back the next time something uses them.
+    """
+
+    name = "open"
+    supports_worker_processes = False  # datasets live in this process's memory
+
+    def __init__(self, memory_budget_bytes=None, spill_folder=None):
+        """
+        Args:
+            memory_budget_bytes (int, optional): how many bytes of datasets to hold in memory. Defaults to no limit
+            spill_folder (str, optional): where to save datasets that don't fit in the budget. Defaults to a new temporary folder
+        """
+        try:
+            import shapely  # noqa: F401
+            import pyproj  # noqa: F401
+        except ImportError as error:
+            raise ImportError("The open geometry engine needs shapely and pyproj - install them with `pip install bunnyhop[open]`") from error
+
+        self.datasets = {}
+        self.spilled = {}  # dataset name -> columnar_store folder, for datasets moved out of memory
+        self.spill_folder = spill_folder
+        self.memory = memory_tier.MemoryTier(memory_budget_bytes, self._memory_size, self._spill) if memory_budget_bytes else None
+
+        if spill_folder is not None and os.path.isdir(spill_folder):  # pick up datasets an earlier run moved to disk, so a run can be resumed
+            for name in os.listdir(spill_folder):
+                if columnar_store.exists(os.path.join(spill_folder, name)):
+                    self.spilled[name] = os.path.join(spill_folder, name)
+
+    @staticmethod
+    def _name(dataset):
+        return os.path.basename(str(dataset))
+
+    @property
+    def workspace(self) -> str:
+        """
+            The geodatabase export writes the outputs to - the run's workspace geodatabase, or None before config.startup
+        """
+        return str(config.GDB_WORKSPACE) if config.GDB_WORKSPACE is not None else None
+
+    def _get(self, dataset) -> _Dataset:
+        name = self._name(dataset)
+        if name in self.spilled:
+            stored = columnar_store.read(self.spilled.pop(name))
+            self.datasets[name] = _Dataset(stored.attributes(), stored.geometry(), stored.crs)
+            if self.memory is not None:
+                self.memory.track(name, make_room=False)  # the caller may still be holding other datasets, so only make room in _put
+
+        try:
+            data = self.datasets[name]
+        except KeyError:
+            raise ValueError(f"Dataset {name} doesn't exist") from None
+        if self.memory is not None:
+            self.memory.touch(name)
+        return data
+
+    def _put(self, name, attributes, geometry=None, crs=None):
+        name = self._name(name)
+        self.datasets[name] = _Dataset(attributes, geometry, crs)
+        self.spilled.pop(name, None)
+        if self.memory is not None:
+            self.memory.track(name)
+
+    def _memory_size(self, name) -> int:
+        import shapely
+        data = self.datasets[name]
+        size = int(data.attributes.memory_usage(deep=True).sum())
+        if data.geometry is not None:
+            size += int(shapely.get_num_coordinates(data.geometry).sum()) * 16  # two doubles per coordinate
+        return size
+
+    def _spill(self, name):
+        if self.spill_folder is None:
+            self.spill_folder = tempfile.mkdtemp(prefix="bunnyhop_spill")
+        folder = os.path.join(self.spill_folder, name)
+        data = self.datasets.pop(name)
+        columnar_store.write(folder, data.attributes, data.geometry, data.crs)
+        self.spilled[name] = folder
+
+    def from_frame(self, name, df, geometry=None, crs=None):
+        """
+            Adds a dataset from a data frame of attributes and, for features, a matching sequence of shapely geometries
+
+        Args:
+            crs (optional): anything pyproj.CRS.from_user_input accepts, or an arcpy.SpatialReference
+        """
+        geometry = numpy.asarray(geometry, dtype=object) if geometry is not None else None
+        self._put(name, df.copy(), geometry, _crs(crs) if crs is not None else None)
+
+    def save(self, dataset, folder):
+        """
+            Writes a dataset to folder in the columnar_store format
+        """
+        data = self._get(dataset)
+        columnar_store.write(folder, data.attributes, data.geometry, data.crs)
+
+    def load(self, folder, name=None):
+        """
+            Adds a dataset from a folder in the columnar_store format, named after the folder unless name is provided
+        """
+        stored = columnar_store.read(folder)
+        self._put(name or folder, stored.attributes(), stored.geometry(), stored.crs)
+
+    @profiling.profiled()
+    def export(self, dataset, out_feature_class):
+        """
+            Writes a dataset out to a geodatabase feature class (or table, if it has no geometry) with arcpy
+        """
+        if arcpy is None:
+            raise ImportError("Exporting to a geodatabase needs arcpy - without it, keep datasets in the columnar_store format with save")
+        data = self._get(dataset)
+        workspace, name = os.path.split(str(out_feature_class))
+        if arcpy.Exists(str(out_feature_class)):
+            arcpy.management.Delete(str(out_feature_class))
+
+        if data.geometry is None:
+            arcpy.management.CreateTable(workspace, name)
+        else:
+            arcpy.management.CreateFeatureclass(workspace, name, geometry_type="POLYGON", spatial_reference=arcpy_spatial_reference(data.crs))
+        fields = list(data.attributes.columns)
+        if fields:
+            arcpy.management.AddFields(str(out_feature_class), self.field_definitions(dataset, fields))
+
+        import shapely
+        cursor_fields = fields + (["SHAPE@"] if data.geometry is not None else [])
+        spatial_reference = arcpy_spatial_reference(data.crs)
+        with arcpy.da.InsertCursor(str(out_feature_class), cursor_fields) as cursor:
+            for position, row in enumerate(self.rows(dataset, fields)):
+                if data.geometry is not None:
+                    geometry = data.geometry[position]
+                    row += (arcpy.FromWKB(bytearray(shapely.to_wkb(geometry)), spatial_reference) if geometry is not None and not shapely.is_empty(geometry) else None,)
+                cursor.insertRow(row)
+
+    def to_frame(self, dataset):
+        """
+            Returns a copy of a dataset's attributes, and its geometries as an array (None for tables)
+        """
+        data = self._get(dataset)
+        return data.attributes.copy(), (data.geometry.copy() if data.geometry is not None else None)
+
+    def on_disk(self, dataset) -> str:
+        """
+            Saves a dataset to the spill folder in the columnar_store format (it's read back the next time something uses it)
+            and returns the folder it's in
+        """
+        name = self._name(dataset)
+        if name in self.datasets:
+            self._spill(name)
+            if self.memory is not None:
+                self.memory.forget(name)
+        return self.spilled[name]
+
+    def exists(self, dataset) -> bool:
+        return self._name(dataset) in self.datasets or self._name(dataset) in self.spilled
+
+    def delete(self, dataset):
+        name = self._name(dataset)
+        self.datasets.pop(name, None)
+        if name in self.spilled:
+            columnar_store.delete(self.spilled.pop(name))
+        if self.memory is not None:
+            self.memory.forget(name)
+
+    def count(self, dataset) -> int:
+        return len(self._get(dataset).attributes)
+
+    def vertex_count(self, dataset):
+        """
+            Returns the total number of vertices in a dataset's geometries, or None if it's a table
+        """
+        import shapely
+        geometry = self._get(dataset).geometry
+        return int(shapely.get_num_coordinates(geometry).sum()) if geometry is not None else None
+
+    def field_names(self, dataset) -> list:
+        return list(self._get(dataset).attributes.columns)
+
+    def field_definitions(self, dataset, fields) -> list:
+        attributes = self._get(dataset).attributes
+        definitions = []
+        for field_name in fields:
+            column = attributes[field_name]
+            if pandas.api.types.is_bool_dtype(column):
+                definitions.append([field_name, "SHORT", field_name])
+            elif pandas.api.types.is_integer_dtype(column):
+                definitions.append([field_name, "LONG", field_name])
+            elif pandas.api.types.is_float_dtype(column):
+                definitions.append([field_name, "DOUBLE", field_name])
+            elif pandas.api.types.is_datetime64_any_dtype(column):
+                definitions.append([field_name, "DATE", field_name])
+            else:
+                definitions.append([field_name, "TEXT", field_name, 255])
+        return definitions
+
+    def rows(self, dataset, fields, where=None):
+        attributes = self._get(dataset).attributes
+        if where is not None:
+            attributes = attributes[self._mask(self._get(dataset), where)]
+        for row in attributes[fields].astype(object).itertuples(index=False, name=None):
+            yield tuple(None if _is_missing(value) else value for value in row)
+
+    def spatial_reference_code(self, dataset):
+        crs = self._get(dataset).crs
+        return crs.to_epsg() if crs is not None else None
+
+    @profiling.profiled()
+    def fetch_layer(self, url, out_feature_class, where="1=1", out_sr=None, checkpoint_path=None, field_map=None, query=None) -> bool:
+        """
+            Reads a feature layer into memory page by page with feature_service.PagedLayerReader, through the download cache like
+            the arcpy engine - the cached copies are kept in the columnar_store format. With checkpoint_path, each page is saved to
+            a folder next to the checkpoint as it arrives, so an interrupted download picks up where it left off.
+
+        Returns:
+            bool: True if the features came out of the cache
+        """
+        download = functools.partial(self._download_layer, url, where=where, out_sr=out_sr, checkpoint_path=checkpoint_path, field_map=field_map)
+        return download_cache.fetch_layer(url, self._name(out_feature_class), download=download,
+                                          query=_layer_query(where, out_sr, field_map, query), store=_ColumnarLayerStore(self))
+
+    def _download_layer(self, url, name, where="1=1", out_sr=None, checkpoint_path=None, field_map=None):
+        import shapely
+
+        field_map = field_map or {}
+        reader = feature_service.PagedLayerReader(url, where=where, out_sr=out_sr)
+        fields = [field for field in reader.info["fields"] if field["type"] in feature_service.FIELD_TYPES and not field["name"].startswith("Shape__")]
+        columns = [field_map.get(field["name"], field["name"]) for field in fields]
+        spatial_reference = out_sr or reader.info.get("extent", {}).get("spatialReference", {}).get("latestWkid") or reader.info.get("extent", {}).get("spatialReference", {}).get("wkid")
+        crs = _crs(spatial_reference) if spatial_reference is not None else None
+
+        edit_date = feature_service.layer_edit_date(reader.info)
+        pages_folder = f"{checkpoint_path}.pages" if checkpoint_path is not None else None
+        checkpoint = feature_service.PageCheckpoint.load(checkpoint_path, url, edit_date)
+        if checkpoint is not None and os.path.isdir(pages_folder):
+            log.info(f"Resuming download of {url} - {len(checkpoint.completed)} of {len(checkpoint.pages)} pages already written")
+        else:
+            checkpoint = feature_service.PageCheckpoint(checkpoint_path, url, reader.plan_pages(), edit_date=edit_date)
+            checkpoint.save()
+            if pages_folder is not None:
+                columnar_store.delete(pages_folder)
+                os.makedirs(pages_folder)
+
+        downloaded = {}  # page -> (attributes, geometry), for the pages we didn't put on disk
+        for page, features in reader.iter_pages(checkpoint.remaining):
+            records = []
+            geometries = []
+            for feature in features:
+                attributes = feature["attributes"]
+                records.append([feature_service._convert_value(attributes.get(field["name"]), field["type"], field["name"] in field_map) for field in fields])
+                geometries.append(_esri_polygon(feature["geometry"]["rings"]) if feature.get("geometry") else shapely.Polygon())
+
+            page_data = (pandas.DataFrame.from_records(records, columns=columns), numpy.array(geometries, dtype=object))
+            if pages_folder is not None:
+                columnar_store.write(os.path.join(pages_folder, _page_name(page)), *page_data, crs)
+            else:
+                downloaded[_page_name(page)] = page_data
+            checkpoint.mark_complete(page)
+
+        pieces = []
+        for page in checkpoint.pages:  # put the pages back in ObjectID order, however they arrived
+            if pages_folder is not None:
+                stored = columnar_store.read(os.path.join(pages_folder, _page_name(page)))
+                pieces.append((stored.attributes(), stored.geometry()))
+            else:
+                pieces.append(downloaded[_page_name(page)])
+
+        attributes = pandas.concat([piece[0] for piece in pieces], ignore_index=True) if pieces else pandas.DataFrame(columns=columns)
+        geometry = numpy.concatenate([piece[1] for piece in pieces]) if pieces else numpy.array([], dtype=object)
+        self._put(name, attributes, geometry, crs)
+
+        checkpoint.remove()
+        if pages_folder is not None:
+            columnar_store.delete(pages_folder)
+
+    @profiling.profiled()
+    def repair(self, dataset):
+        import shapely
+        data = self._get(dataset)
+        data.geometry = _polygonal(shapely.make_valid(data.geometry))
+
+    def rename_field(self, dataset, field_name, new_name):
+        attributes = self._get(dataset).attributes
+        column = attributes[field_name]
+        attributes[field_name] = column.astype(object).where(column.isna(), column.astype(str))
+        attributes.rename(columns={field_name: new_name}, inplace=True)
+
+    def add_fields(self, dataset, definitions):
+        attributes = self._get(dataset).attributes
+        for definition in definitions:
+            if definition[0] not in attributes.columns:
+                attributes[definition[0]] = None
+
+    def delete_fields(self, dataset, fields):
+        self._get(dataset).attributes.drop(columns=list(fields), inplace=True)
+
+    def _mask(self, data, where):
+        if where[0] in ("AND", "OR"):
+            masks = [self._mask(data, condition) for condition in where[1:]]
+            combined = masks[0]
+            for mask in masks[1:]:
+                combined = (combined & mask) if where[0] == "AND" else (combined | mask)
+            return combined
+
+        import shapely
+        field_name, operator, value = where
+        column = pandas.Series(shapely.area(data.geometry)) if field_name == AREA else data.attributes[field_name]
+        if operator == "=":
+            mask = column == value
+        elif operator == "<>":
+            mask = column != value
+        elif operator == "<":
+            mask = column < value
+        elif operator == ">":
+            mask = column > value
+        elif operator == "IN":
+            mask = column.isin(list(value))
+        elif operator == "NOT IN":
+            mask = ~column.isin(list(value))
+        else:
+            raise ValueError(f"Unsupported filter operator {operator}")
+        return (mask & column.notna()).to_numpy()
+
+    @profiling.profiled()
+    def select(self, source, output, where=None):
+        data = self._get(source)
+        mask = self._mask(data, where) if where is not None else numpy.ones(len(data.attributes), dtype=bool)
+        self._put(output, data.attributes[mask].copy(), data.geometry[mask] if data.geometry is not None else None, data.crs)
+
+    @profiling.profiled()
+    def split(self, source, field, outputs):
+        """
+            Writes the features with each value of field out to their own dataset, grouping the source in one pass
+
+        Args:
+            outputs (dict): value -> the dataset to write its features to
+        """
+        data = self._get(source)
+        positions = data.attributes.groupby(field, sort=False).indices
+        for value, output in outputs.items():
+            keep = positions.get(value, numpy.array([], dtype=int))
+            self._put(output, data.attributes.iloc[keep].copy(), data.geometry[keep] if data.geometry is not None else None, data.crs)
+
+    @profiling.profiled()
+    def select_intersecting(self, source, other, output, remainder_output, remainder_where=None) -> int:
+        import shapely
+        data = self._get(source)
+        tree = shapely.STRtree(self._get(other).geometry)
+        source_indexes, _ = tree.query(data.geometry, predicate="intersects")  # checks envelopes first, then runs the exact predicate
+
+        intersecting = numpy.zeros(len(data.attributes), dtype=bool)
+        intersecting[source_indexes] = True
+        remainder = ~intersecting
+        if remainder_where is not None:
+            remainder &= self._mask(data, remainder_where)
+
+        self._put(output, data.attributes[intersecting].copy(), data.geometry[intersecting], data.crs)
+        self._put(remainder_output, data.attributes[remainder].copy(), data.geometry[remainder], data.crs)
+        return int(intersecting.sum())
+
+    @profiling.profiled()
+    def dissolve(self, source, output, fields, multi_part=True):
+        import shapely
+        data = self._get(source)
+        groups = data.attributes.groupby(list(fields), dropna=False, sort=True).indices
+
+        keys = []
+        geometries = []
+        for key, positions in groups.items():
+            dissolved = shapely.union_all(data.geometry[positions])
+            parts = [dissolved] if multi_part else list(shapely.get_parts(dissolved))
+            keys.extend([key if isinstance(key, tuple) else (key,)] * len(parts))
+            geometries.extend(parts)
+
+        self._put(output, pandas.DataFrame(keys, columns=list(fields)), numpy.asarray(geometries, dtype=object), data.crs)
+
+    @profiling.profiled()
+    def join_field(self, target, key_field, join_table, join_key, fields):
+        attributes = self._get(target).attributes
+        lookup = self._get(join_table).attributes.dropna(subset=[join_key]).drop_duplicates(join_key).set_index(join_key)  # first record wins
+        for field_name in fields:
+            new_name = field_name if field_name not in attributes.columns else f"{field_name}_1"
+            attributes[new_name] = attributes[key_field].map(lookup[field_name])
+
+    @profiling.profiled()
+    def union(self, inputs, output):
+        """
+            Overlays polygon datasets like arcpy's Union - every area gets the attributes of each input that covers it, and blanks
+            (empty strings and zeros) for the attributes of the inputs that don't, with -1 in their FID fields. Fields that share a
+            name with a field from an earlier input get a _1, _2, etc suffix for the input they came from.
+
+            Unlike arcpy's Union, overlaps within one input aren't split up - each input's own polygons should already be disjoint,
+            the way dissolved cities and counties are.
+        """
+        import shapely
+
+        if not inputs:
+            raise ValueError("union needs at least one input")
+        crs = self._get(inputs[0]).crs
+        attributes, geometry = None, None
+        for index, dataset in enumerate(inputs):
+            data = self._get(dataset)
+            data_geometry = data.geometry
+            if data.crs is not None and crs is not None and data.crs != crs:
+                data_geometry = shapely.transform(data_geometry, _transformer(data.crs, crs))
+
+            data_attributes = data.attributes
+            if attributes is not None:
+                data_attributes = data_attributes.rename(columns={column: f"{column}_{index}" for column in data_attributes.columns if column in attributes.columns})
+            data_attributes = data_attributes.copy()
+            data_attributes.insert(0, f"FID_{self._name(dataset)}", numpy.arange(1, len(data_attributes) + 1))
+
+            if attributes is None:
+                attributes, geometry = data_attributes, data_geometry
+            else:  # each overlay splits everything so far into disjoint pieces, so the next one can treat it as one input
+                attributes, geometry = _overlay(attributes, geometry, data_attributes, data_geometry)
+
+        self._put(output, attributes, geometry, crs)
+
+    @profiling.profiled()
+    def erase(self, source, eraser, output):
+        import shapely
+        data = self._get(source)
+        eraser_data = self._get(eraser)
+        eraser_geometry = shapely.union_all(eraser_data.geometry)
+        if eraser_data.crs is not None and data.crs is not None and eraser_data.crs != data.crs:
+            eraser_geometry = shapely.transform(eraser_geometry, _transformer(eraser_data.crs, data.crs))
+
+        shapely.prepare(eraser_geometry)
+        geometry = data.geometry.copy()
+        touched = shapely.intersects(geometry, eraser_geometry)
+        geometry[touched] = _polygonal(shapely.difference(geometry[touched], eraser_geometry))
+
+        keep = ~shapely.is_empty(geometry)
+        self._put(output, data.attributes[keep].copy(), geometry[keep], data.crs)
+
+    @profiling.profiled()
+    def merge(self, inputs, output):
+        import shapely
+        datasets = [self._get(dataset) for dataset in inputs]
+        crs = datasets[0].crs
+        geometries = [data.geometry if data.crs is None or crs is None or data.crs == crs else shapely.transform(data.geometry, _transformer(data.crs, crs))
+                      for data in datasets]
+        self._put(output, pandas.concat([data.attributes for data in datasets], ignore_index=True), numpy.concatenate(geometries), crs)
+
+    @profiling.profiled()
+    def append(self, source, target):
+        source_data = self._get(source)
+        target_data = self._get(target)
+        attributes = source_data.attributes.reindex(columns=target_data.attributes.columns)  # fields are matched by name
+        self._put(target, pandas.concat([target_data.attributes, attributes], ignore_index=True),
+                  numpy.concatenate([target_data.geometry, source_data.geometry]), target_data.crs)
+
+    @profiling.profiled()
+    def copy(self, source, output):
+        data = self._get(source)
+        self._put(output, data.attributes.copy(), data.geometry.copy() if data.geometry is not None else None, data.crs)
+
+    @profiling.profiled()
+    def project(self, source, output, spatial_reference):
+        import shapely
+        data = self._get(source)
+        crs = _crs(spatial_reference)
+        self._put(output, data.attributes.copy(), shapely.transform(data.geometry, _transformer(data.crs, crs)), crs)
+
+    @profiling.profiled()
+    def add_global_ids(self, datasets):
+        for dataset in datasets:
+            attributes = self._get(dataset).attributes
+            attributes["GlobalID"] = [f"{{{str(uuid.uuid4()).upper()}}}" for _ in range(len(attributes))]
+
+    @profiling.profiled()
+    def calculate_fields(self, dataset, steps):
+        """
+            Runs derived_fields steps for every record. SHAPE@ is handed over as an object with the geometry and its coordinate system.
+
+            The steps are arbitrary Python functions of a record's values, so like arcpy's UpdateCursor this runs them one record
+            at a time - it isn't vectorized, and takes time in proportion to the records times the steps. The pipeline only runs
+            it on dissolved cities and counties (a few thousand records), so keep it off of parcel-level datasets.
+        """
+        data = self._get(dataset)
+        attributes = data.attributes
+        for step in steps:
+            if isinstance(step, derived_fields.DerivedField) and step.name not in attributes.columns:
+                attributes[step.name] = None
+
+        available_fields = set(attributes.columns) | {"SHAPE@"}
+        steps = [step.for_fields(available_fields) if hasattr(step, "for_fields") else step for step in steps]
+        uses_shape = any("SHAPE@" in step.fields for step in steps)
+
+        records = attributes.astype(object).where(attributes.notna(), None).to_dict("records")
+        for position, values in enumerate(records):
+            if uses_shape:
+                values["SHAPE@"] = _Shape(data.geometry[position], data.crs)
+            for step in steps:
+                step.apply(values)
+            values.pop("SHAPE@", None)
+
+        data.attributes = pandas.DataFrame.from_records(records, columns=attributes.columns)
+
+    def area_field(self, name, spatial_reference, units):
+        square_meters = _SQUARE_METERS[units]
+        return derived_fields.DerivedField(name, "DOUBLE", lambda values: values["SHAPE@"].area_in(spatial_reference, square_meters), sources=("SHAPE@",))
+
+    @profiling.profiled()
+    def fix_slivers(self, dataset, keep_fragment_geoms=None, threshold=None, place_field=None):
+        """
+            Same as coastline.fix_slivers - moves each small part of the polygons that share a place name into the polygon with the
+            largest large part it touches, unless it's in one of the fragments we keep. Parts with at least threshold area are large
+            and stay put. keep_fragment_geoms are shapely geometries in the dataset's coordinate system, and default to
+            config.COASTLINE_KEEP_FRAGMENTS. threshold and place_field default to config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS and
+            the legal place name field.
+        """
+        import shapely
+
+        threshold = config.COASTLINE_CHECK_SIZE_THRESHOLD_METERS if threshold is None else threshold
+        place_field = place_field or config.FIELD_NAMES['legal_place_name']
+
+        data = self._get(dataset)
+        if keep_fragment_geoms is None:
+            keep_geometry = _keep_fragment_geometry(data.crs)
+        else:
+            keep_geometry = shapely.union_all([shapely.from_wkt(geom.WKT) if hasattr(geom, "WKT") else geom for geom in keep_fragment_geoms])
+        shapely.prepare(keep_geometry)
+
+        for place, positions in data.attributes.groupby(place_field, sort=False).indices.items():
+            if len(positions) < 2:
+                continue  # skip any polygon that doesn't have a coastal buffer
+
+            parts = [(position, part) for position in positions for part in shapely.get_parts(data.geometry[position])]
+            areas = numpy.array([shapely.area(part) for position, part in parts])
+            large = [index for index, area in enumerate(areas) if area >= threshold]
+            if not large:
+                continue
+            tree = shapely.STRtree([parts[index][1] for index in large])
+
+            moves_in = {}
+            moves_out = {}
+            for index, (position, part) in enumerate(parts):
+                if areas[index] >= threshold or shapely.intersects(part, keep_geometry):
+                    continue
+                neighbors = [large[neighbor] for neighbor in tree.query(part, predicate="touches") if parts[large[neighbor]][0] != position]
+                if neighbors:
+                    destination = parts[max(neighbors, key=lambda neighbor: areas[neighbor])][0]
+                    moves_in.setdefault(destination, []).append(part)
+                    moves_out.setdefault(position, []).append(part)
+
+            for position, moved in moves_in.items():
+                data.geometry[position] = shapely.union(data.geometry[position], shapely.union_all(moved))
+            for position, moved in moves_out.items():
+                data.geometry[position] = _polygonal(shapely.difference(data.geometry[position], shapely.union_all(moved)))
+
+
+def _keep_fragment_geometry(crs):
+    """
+        Returns config.COASTLINE_KEEP_FRAGMENTS as one shapely geometry in crs
+    """
+    import shapely
+    fragments = shapely.union_all([shapely.Point(points[0]) if len(points) == 1 else shapely.Polygon(points) for points in config.COASTLINE_KEEP_FRAGMENTS])
+    if crs is None:
+        return fragments
+    return shapely.transform(fragments, _transformer(config.COASTLINE_KEEP_FRAGMENTS_SR, crs))
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and numpy.isnan(value))
+
+
+def _blanks(attributes, count):
+    """
+        Rows of blank values for attributes' columns - empty strings for text, -1 for FID fields, and zeros for other numbers - like Union fills in
+    """
+    blanks = {}
+    for column in attributes.columns:
+        if column.startswith("FID_"):
+            blanks[column] = numpy.full(count, -1)
+        elif pandas.api.types.is_numeric_dtype(attributes[column]) and not pandas.api.types.is_bool_dtype(attributes[column]):
+            blanks[column] = numpy.zeros(count, dtype=attributes[column].dtype)
+        else:
+            blanks[column] = [""] * count
+    return pandas.DataFrame(blanks, columns=attributes.columns)
+
+
+def _overlay(first_attributes, first_geometry, second_attributes, second_geometry):
+    """
+        Overlays two sets of features for union - the pieces where they overlap, then the rest of each one, with blanks for the
+        attributes of the side that doesn't cover a piece
+
+    Returns:
+        tuple: the attributes and geometry of the pieces
+    """
+    import shapely
+
+    first_indexes, second_indexes = shapely.STRtree(second_geometry).query(first_geometry, predicate="intersects")
+    overlaps = _polygonal(shapely.intersection(first_geometry[first_indexes], second_geometry[second_indexes]))
+    keep = ~shapely.is_empty(overlaps) & (shapely.area(overlaps) > 0)
+
+    first_remainders = _remainders(first_geometry, first_indexes, second_geometry, second_indexes)
+    second_remainders = _remainders(second_geometry, second_indexes, first_geometry, first_indexes)
+    first_keep = ~shapely.is_empty(first_remainders)
+    second_keep = ~shapely.is_empty(second_remainders)
+
+    pieces = [
+        pandas.concat([first_attributes.iloc[first_indexes[keep]].reset_index(drop=True),
+                       second_attributes.iloc[second_indexes[keep]].reset_index(drop=True)], axis=1),
+        pandas.concat([first_attributes[first_keep].reset_index(drop=True),
+                       _blanks(second_attributes, int(first_keep.sum()))], axis=1),
+        pandas.concat([_blanks(first_attributes, int(second_keep.sum())),
+                       second_attributes[second_keep].reset_index(drop=True)], axis=1),
+    ]
+    geometry = numpy.concatenate([overlaps[keep], first_remainders[first_keep], second_remainders[second_keep]])
+    return pandas.concat(pieces, ignore_index=True), geometry
+
+
+def _remainders(geometry, indexes, other_geometry, other_indexes):
+    """
+        Returns each geometry minus everything in other_geometry that overlaps it, given the overlapping pairs of indexes
+    """
+    import shapely
+    remainders = geometry.copy()
+    if len(indexes) == 0:
+        return remainders
+
+    order = numpy.argsort(indexes, kind="stable")
+    sorted_indexes = indexes[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_indexes[1:] != sorted_indexes[:-1]])
+    for start, end in zip(starts, numpy.r_[starts[1:], len(sorted_indexes)]):
+        index = sorted_indexes[start]
+        overlapping = shapely.union_all(other_geometry[other_indexes[order[start:end]]])
+        remainders[index] = _polygonal(shapely.difference(geometry[index], overlapping))
+    return remainders
+
+
+def _polygonal(geometry):
+    """
+        Drops anything that isn't a polygon (stray lines and points from overlays and repairs) out of geometries
+    """
+    import shapely
+
+    def keep_polygons(item):
+        if shapely.get_type_id(item) != 7:  # not a geometry collection
+            return item if shapely.get_type_id(item) in (3, 6) else shapely.Polygon()
+        polygons = [part for part in shapely.get_parts(item) if shapely.get_type_id(part) in (3, 6)]
+        return shapely.union_all(polygons) if polygons else shapely.Polygon()
+
+    if isinstance(geometry, numpy.ndarray):
+        return numpy.array([keep_polygons(item) for item in geometry], dtype=object)
+    return keep_polygons(geometry)
+
+
+class _ColumnarLayerStore:
+    """
+        Keeps the download cache's copies of feature layers in the columnar_store format, for the open engine
+    """
+
+    suffix = ".columnar"
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def exists(self, path) -> bool:
+        return columnar_store.exists(path)
+
+    def save(self, features, path):
+        self.engine.save(features, path)
+
+    def load(self, path, out_feature_class):
+        self.engine.load(path, self.engine._name(out_feature_class))
+
+
+def _layer_query(where, out_sr, field_map, query=None):
+    """
+        Describes a fetch_layer call for the download cache - the filter, spatial reference, and field map, since each of them
+        changes what gets written. Returns query as is when it's provided and there's no field map.
+    """
+    if query is None and (where != "1=1" or out_sr is not None):
+        query = f"where={where}&outSR={out_sr}"
+    if field_map:
+        query = "&".join(part for part in (query, f"fieldMap={json.dumps(field_map, sort_keys=True)}") if part)
+    return query
+
+
+def _page_name(page):
+    return f"{page[0]}_{page[1]}"
+
+
+def _esri_polygon(rings):
+    """
+        Converts the rings of an Esri JSON polygon to a shapely geometry - in Esri JSON, clockwise rings are shells and counterclockwise rings are holes
+    """
+    import shapely
+
+    shells = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        linear_ring = shapely.linearrings([point[:2] for point in ring])
+        (holes if shapely.is_ccw(linear_ring) else shells).append(linear_ring)
+
+    polygons = [[shell, []] for shell in shells]
+    for hole in holes:
+        point = shapely.Point(shapely.get_coordinates(hole)[0])
+        for polygon in polygons:
+            if shapely.Polygon(polygon[0]).covers(point):
+                polygon[1].append(hole)
+                break
+
+    polygons = [shapely.Polygon(shell, polygon_holes) for shell, polygon_holes in polygons]
+    if not polygons:
+        return shapely.Polygon()
+    return polygons[0] if len(polygons) == 1 else shapely.MultiPolygon(polygons)
+
+
+def get_engine(name=None, memory_budget_bytes=None):
+    """
+        Returns a new engine by name - "arcpy" or "open". The defaults are read from the config when this is called, so they
+        pick up any changes made to it at runtime.
+
+    Args:
+        name (str, optional): Defaults to config.GEOMETRY_ENGINE
+        memory_budget_bytes (int, optional): how many bytes of intermediates to hold in memory before moving some to disk. 0 writes
+            everything to disk. Defaults to config.WORKSPACE_MEMORY_BUDGET_BYTES when config.WORKSPACE_TIERED is on, and 0 otherwise.
+    """
+    name = name or config.GEOMETRY_ENGINE
+    if memory_budget_bytes is None:
+        memory_budget_bytes = config.WORKSPACE_MEMORY_BUDGET_BYTES if config.WORKSPACE_TIERED else 0
+
+    if name == "arcpy":
+        return ArcpyEngine(memory_budget_bytes=memory_budget_bytes)
+    if name == "open":
+        spill_folder = os.path.join(str(config.FOLDER_WORKSPACE), "spill") if config.FOLDER_WORKSPACE is not None else None
+        return OpenEngine(memory_budget_bytes=memory_budget_bytes, spill_folder=spill_folder)
+    raise ValueError(f"Unknown geometry engine {name} - use 'arcpy' or 'open'")
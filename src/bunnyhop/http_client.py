@@ -0,0 +1,151 @@
+"""
+    One HTTP client for every request the package makes - the GNIS and Census downloads, the download cache, and the
+    feature layer pages - so they all share a pool of keep-alive connections instead of opening a new one each time.
+
+    Every request gets a connect and read timeout, so a dead connection fails instead of hanging the run. Connection
+    errors, timeouts, and the statuses in config.HTTP_RETRY_STATUSES are retried with exponential backoff and full
+    jitter (a random wait between zero and the backoff), honoring the server's Retry-After when it sends one. Responses
+    are requested gzipped and decompressed as they're read. A per-host limit caps how many requests are in flight to
+    the same server at once, across all of the threads sharing the client.
+
+    Streamed downloads hold their slot of the per-host limit until the response is closed, so use them through the
+    stream context manager. A download that fails partway through the body isn't retried here - only getting the
+    response is.
+"""
+
+import contextlib
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from . import config
+
+log = logging.getLogger("bunnyhop.http_client")
+
+
+class HttpClient:
+
+    def __init__(self,
+                 connect_timeout=config.HTTP_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout=config.HTTP_READ_TIMEOUT_SECONDS,
+                 retries=config.HTTP_RETRIES,
+                 backoff=config.HTTP_BACKOFF_SECONDS,
+                 backoff_max=config.HTTP_BACKOFF_MAX_SECONDS,
+                 retry_statuses=config.HTTP_RETRY_STATUSES,
+                 max_connections_per_host=config.HTTP_MAX_CONNECTIONS_PER_HOST):
+        """
+        Args:
+            connect_timeout (float, optional): seconds to wait for a connection
+            read_timeout (float, optional): seconds to wait for the server between bytes of the response
+            retries (int, optional): how many times to retry a request after the first try
+            backoff (float, optional): the longest wait before the first retry, in seconds - it doubles for each retry after that
+            backoff_max (float, optional): the longest wait before any retry, in seconds
+            retry_statuses (tuple, optional): HTTP statuses that get retried
+            max_connections_per_host (int, optional): how many requests can be in flight to one host at once
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_statuses = set(retry_statuses)
+        self.max_connections_per_host = max_connections_per_host
+
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections_per_host)  # keeps one idle connection per slot of the per-host limit
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, url) -> threading.BoundedSemaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_limits[host]
+
+    def _wait_before_retry(self, attempt, response=None) -> float:
+        """
+            Returns how long to wait before retry number attempt (starting at 0) - the server's Retry-After if it sent one,
+            otherwise a random time up to the exponential backoff
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _send(self, method, url, **kwargs) -> requests.Response:
+        """
+            Sends a request, retrying it as configured. The caller needs to hold the host's slot.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == self.retries:
+                    raise
+                problem = str(error)
+            else:
+                if response.status_code not in self.retry_statuses or attempt == self.retries:
+                    return response
+                problem = f"status {response.status_code}"
+                response.close()
+
+            wait = self._wait_before_retry(attempt, response)
+            log.debug(f"{method} {url} failed ({problem}) - retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """
+            Sends a request and reads the whole response. Takes the same keyword arguments as requests.Session.request,
+            except stream - use the stream method for that.
+        """
+        with self._host_limit(url):
+            response = self._send(method, url, **kwargs)
+            response.content  # read the body while we hold the host's slot
+            return response
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, url, method="GET", **kwargs):
+        """
+            Sends a request for a download to read a chunk at a time with iter_content. The response is closed, and the host's
+            slot released, at the end of the with block.
+
+        Yields:
+            requests.Response: the response, with its body not read yet
+        """
+        with self._host_limit(url):
+            response = self._send(method, url, stream=True, **kwargs)
+            with response:
+                yield response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    """
+        Returns the client shared by everything in this process
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
@@ -0,0 +1,66 @@
+"""
+    Keeps track of which intermediate datasets are held in memory, and moves the least recently used ones to disk once
+    the ones in memory add up to more than a budget.
+
+    The tier doesn't know how datasets are stored - the geometry engine that owns it hands over a function that estimates
+    a dataset's size in bytes and one that moves a dataset to disk, and tells the tier whenever it creates, reads, or
+    deletes a dataset.
+"""
+
+import collections
+import logging
+
+log = logging.getLogger("bunnyhop.memory_tier")
+
+
+class MemoryTier:
+
+    def __init__(self, budget_bytes, measure, spill):
+        """
+        Args:
+            budget_bytes (int): how many bytes of datasets to hold in memory before moving some to disk
+            measure (callable): called with a dataset name, returns its estimated size in bytes
+            spill (callable): called with a dataset name, moves it from memory to disk
+        """
+        self.budget_bytes = budget_bytes
+        self.measure = measure
+        self.spill = spill
+        self.sizes = collections.OrderedDict()  # dataset name -> estimated bytes, least recently used first
+
+    def __contains__(self, name):
+        return name in self.sizes
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def track(self, name, make_room=True):
+        """
+            Records a dataset that was just created (or changed) in memory, then spills the least recently used datasets until
+            we're back under the budget. The dataset we just recorded is never spilled here, since something is about to use it.
+
+        Args:
+            make_room (bool, optional): set to False to record the dataset without spilling anything, for when the engine is
+                in the middle of an operation that still holds other datasets
+        """
+        self.sizes[name] = self.measure(name)
+        self.sizes.move_to_end(name)
+
+        while make_room and len(self.sizes) > 1 and self.total_bytes > self.budget_bytes:
+            oldest = next(iter(self.sizes))
+            log.debug(f"Moving {oldest} to disk - {self.total_bytes} bytes in memory is over the budget of {self.budget_bytes}")
+            self.spill(oldest)
+            del self.sizes[oldest]
+
+    def touch(self, name):
+        """
+            Marks a dataset as just used, so it's the last to be spilled
+        """
+        if name in self.sizes:
+            self.sizes.move_to_end(name)
+
+    def forget(self, name):
+        """
+            Stops tracking a dataset that was deleted or moved out of memory by its engine
+        """
+        self.sizes.pop(name, None)
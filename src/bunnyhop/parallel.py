@@ -0,0 +1,127 @@
+"""
+    Helpers for running parts of the pipeline in separate worker processes.
+
+    arcpy isn't safe to share between threads, and a file geodatabase doesn't like several processes writing to it
+    at once, so each worker gets its own scratch geodatabase to write into. The caller then merges whatever the
+    workers wrote back into the main workspace.
+
+    Workers are always started with the "spawn" method (the only one available on Windows anyway), which means they
+    import bunnyhop fresh - they see the values in config.py, not anything changed on it at runtime.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+from . import config
+
+
+def map_in_processes(function, arguments, max_workers=config.MAX_WORKER_PROCESSES):
+    """
+        Calls function(*args) for each tuple in arguments in a pool of worker processes. function needs to be defined
+        at the top level of a module so the workers can find it.
+
+    Returns:
+        list: the return values, in the same order as arguments
+    """
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        futures = [executor.submit(function, *args) for args in arguments]
+        return [future.result() for future in futures]
+
+
+class Task:
+    """
+        One step for run_graph - function(*args) runs in a worker process once the tasks named in depends_on have finished.
+        Any Result in args is replaced with the return value of the task it names.
+    """
+
+    def __init__(self, function, args=(), depends_on=()):
+        self.function = function
+        self.args = tuple(args)
+        self.depends_on = set(depends_on) | set(arg.task for arg in args if isinstance(arg, Result))
+
+
+class Result:
+    """
+        Placeholder in a Task's args for the return value of another task
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+
+def run_graph(tasks, max_workers=config.MAX_WORKER_PROCESSES):
+    """
+        Runs a set of tasks that depend on each other in a pool of worker processes, starting each one as soon as
+        everything it depends on has finished, so independent branches run side by side.
+
+    Args:
+        tasks (dict): Tasks keyed by name
+
+    Returns:
+        dict: the return value of each task, keyed by name
+    """
+    for name, task in tasks.items():
+        missing = task.depends_on - set(tasks)
+        if missing:
+            raise ValueError(f"Task {name} depends on tasks that don't exist: {', '.join(sorted(missing))}")
+
+    results = {}
+    waiting = dict(tasks)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        running = {}
+        while waiting or running:
+            ready = [name for name, task in waiting.items() if task.depends_on <= set(results)]
+            if not ready and not running:
+                raise ValueError(f"Tasks have circular dependencies: {', '.join(sorted(waiting))}")
+
+            for name in ready:
+                task = waiting.pop(name)
+                args = [results[arg.task] if isinstance(arg, Result) else arg for arg in task.args]
+                running[executor.submit(task.function, *args)] = name
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+
+def create_scratch_geodatabase(folder, name):
+    """
+        Creates a file geodatabase for a worker, unless it's already there. The parent process can use this to put a worker's
+        inputs in place before it starts.
+
+    Returns:
+        str: full path to the geodatabase
+    """
+    os.makedirs(folder, exist_ok=True)
+    gdb_name = f"{name}.gdb"
+    gdb_path = os.path.join(folder, gdb_name)
+    if not arcpy.Exists(gdb_path):
+        arcpy.management.CreateFileGDB(folder, gdb_name)
+    return gdb_path
+
+
+def create_scratch_workspace(folder, name):
+    """
+        Creates a file geodatabase for a worker (or picks up the one create_scratch_geodatabase made) and makes it that
+        process's workspace
+
+    Returns:
+        str: full path to the geodatabase
+    """
+    gdb_path = create_scratch_geodatabase(folder, name)
+
+    arcpy.env.workspace = gdb_path
+    arcpy.env.scratchWorkspace = gdb_path
+    arcpy.env.overwriteOutput = True  # a rerun can land on an old scratch geodatabase
+
+    return gdb_path
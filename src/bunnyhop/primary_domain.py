@@ -6,11 +6,11 @@ For now, an empty placeholder that adds the field, and that's it.
 import logging
 
 from .config import FIELD_NAMES
-
-import arcpy
+from . import geometry_engine
 
 log = logging.getLogger("bunnyhop")
 
-def add_primary_domain(features):
+def add_primary_domain(features, engine=None):
     log.info("Adding primary domain")
-    arcpy.AddField_management(features, FIELD_NAMES['primary_domain'], "TEXT", field_length=255)
\ No newline at end of file
+    engine = engine or geometry_engine.ArcpyEngine()
+    engine.add_fields(features, [[FIELD_NAMES['primary_domain'], "TEXT", FIELD_NAMES['primary_domain'], 255]])
\ No newline at end of file
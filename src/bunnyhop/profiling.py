@@ -0,0 +1,286 @@
+"""
+    Records where a run spends its time and memory, so we can tell which steps dominate a slow run.
+
+    Wrap a step with the profile context manager, or decorate a function or method with profiled. Each step becomes a
+    section in the run report with its wall time, CPU time, the process's peak memory (RSS) when it finished, and the
+    feature counts of its inputs and outputs (and vertex counts, with config.PROFILE_COUNT_VERTICES). Sections started while another one is running are nested in it,
+    so the report reads as a tree - stages, then the CDTFARetrieve methods they run, then the geometry engine operations
+    those call. write_report saves the tree as JSON, along with a summary of the total time spent in each kind of section.
+
+    Peak RSS is the high-water mark of the whole process, not just the section - a section that pushed it up shows a
+    bigger number than the one before it. It's read with the resource module, or psutil on Windows when it's installed,
+    and left out otherwise.
+
+    Worker processes record their own sections. They hand them back with worker_sections and the parent process nests
+    them in its report with adopt.
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+from . import __version__
+from . import config
+
+log = logging.getLogger("bunnyhop.profiling")
+
+_sections = []  # the finished top-level sections of this process
+_sections_lock = threading.Lock()
+_local = threading.local()  # each thread's stack of running sections
+_started = datetime.datetime.now()
+
+
+class Section:
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.started = datetime.datetime.now()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_bytes = None
+        self.inputs = {}  # label -> {"features": int, "vertices": int or None}
+        self.outputs = {}
+        self.error = None
+        self.children = []
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(),
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "inputs": self.inputs,
+            "outputs": self.outputs,
+            "error": self.error,
+            "children": [child.as_dict() if isinstance(child, Section) else child for child in self.children],
+        }
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """
+        Returns the innermost running section in this thread, or None
+    """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def peak_rss_bytes():
+    """
+        Returns the most memory this process has held at once, in bytes, or None if we can't tell on this platform
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes everywhere but macOS
+
+
+@contextlib.contextmanager
+def profile(name, enabled=None):
+    """
+        Records the code in the with block as a section of the run report
+
+    Args:
+        name (str): what to call the section in the report
+        enabled (bool, optional): Defaults to config.PROFILE_ENABLED
+
+    Yields:
+        Section: the section, or None when profiling is turned off
+    """
+    if not (config.PROFILE_ENABLED if enabled is None else enabled):
+        yield None
+        return
+
+    stack = _stack()
+    section = Section(name, parent=stack[-1] if stack else None)
+    stack.append(section)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield section
+    except BaseException as error:
+        section.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        section.wall_seconds = time.perf_counter() - wall_start
+        section.cpu_seconds = time.process_time() - cpu_start
+        section.peak_rss_bytes = peak_rss_bytes()
+        stack.pop()
+        if section.parent is not None:
+            section.parent.children.append(section)
+        else:
+            with _sections_lock:
+                _sections.append(section)
+        log.debug(f"{name} took {section.wall_seconds:.2f}s ({section.cpu_seconds:.2f}s CPU)")
+
+
+def profiled(name=None, inputs=(), outputs=()):
+    """
+        Decorator that records each call of a function or method as a section of the run report
+
+    Args:
+        name (str, optional): what to call the section. Defaults to the function's qualified name
+        inputs (tuple, optional): for methods of objects with an engine attribute, like CDTFARetrieve - attributes holding datasets
+            to count before the call
+        outputs (tuple, optional): attributes holding datasets to count after the call
+    """
+    def decorator(function):
+        section_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not config.PROFILE_ENABLED:
+                return function(*args, **kwargs)
+
+            with profile(section_name):
+                if inputs:
+                    _record_attributes(args[0], inputs, record_input)
+                result = function(*args, **kwargs)
+                if outputs:
+                    _record_attributes(args[0], outputs, record_output)
+                return result
+        return wrapper
+    return decorator
+
+
+def _record_attributes(instance, attributes, record):
+    for attribute in attributes:
+        dataset = getattr(instance, attribute, None)
+        if dataset is not None:
+            record(attribute, **count_dataset(instance.engine, dataset))
+
+
+def count_dataset(engine, dataset) -> dict:
+    """
+        Counts the features and vertices in a dataset with a geometry_engine. Counting never fails a run - anything we can't count comes back as None.
+
+    Returns:
+        dict: "features" and "vertices" (None for tables, or when config.PROFILE_COUNT_VERTICES is off)
+    """
+    counts = {"features": None, "vertices": None}
+    try:
+        counts["features"] = engine.count(dataset)
+        if config.PROFILE_COUNT_VERTICES:
+            counts["vertices"] = engine.vertex_count(dataset)
+    except Exception as error:  # profiling shouldn't stop a run, and engines raise all kinds of things for a dataset that's gone
+        log.debug(f"Couldn't count {dataset}: {error}")
+    return counts
+
+
+def record_input(label, features=None, vertices=None):
+    """
+        Adds the counts of one of the current section's inputs. Does nothing outside of a section.
+    """
+    section = current()
+    if section is not None:
+        section.inputs[label] = {"features": features, "vertices": vertices}
+
+
+def record_output(label, features=None, vertices=None):
+    """
+        Adds the counts of one of the current section's outputs. Does nothing outside of a section.
+    """
+    section = current()
+    if section is not None:
+        section.outputs[label] = {"features": features, "vertices": vertices}
+
+
+def worker_sections() -> list:
+    """
+        Returns the sections this process has finished, as dictionaries that can be sent back to the parent process, and clears them
+    """
+    with _sections_lock:
+        sections = [dict(section.as_dict(), process=os.getpid()) for section in _sections]
+        _sections.clear()
+    return sections
+
+
+def adopt(sections):
+    """
+        Nests sections from worker_sections in the current section (or at the top level of the report outside of one)
+    """
+    section = current()
+    if section is not None:
+        section.children.extend(sections)
+    else:
+        with _sections_lock:
+            _sections.extend(sections)
+
+
+def report() -> dict:
+    with _sections_lock:
+        sections = [section.as_dict() for section in _sections]
+    return {
+        "bunnyhop_version": __version__,
+        "started": _started.isoformat(),
+        "finished": datetime.datetime.now().isoformat(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "summary": summarize(sections),
+        "sections": sections,
+    }
+
+
+def summarize(sections) -> list:
+    """
+        Totals the wall time, CPU time, and calls of each section name across the tree, slowest first. Nested sections count
+        toward their own names too, so the totals of a parent and its children overlap.
+    """
+    totals = {}
+
+    def add(section):
+        total = totals.setdefault(section["name"], {"name": section["name"], "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+        total["calls"] += 1
+        total["wall_seconds"] += section["wall_seconds"] or 0
+        total["cpu_seconds"] += section["cpu_seconds"] or 0
+        for child in section["children"]:
+            add(child)
+
+    for section in sections:
+        add(section)
+    return sorted(totals.values(), key=lambda total: total["wall_seconds"], reverse=True)
+
+
+def write_report(path=None):
+    """
+        Writes the run report as JSON
+
+    Args:
+        path (str, optional): Defaults to config.PROFILE_REPORT_PATH - next to the run log
+    """
+    path = str(path or config.PROFILE_REPORT_PATH)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as report_file:
+        json.dump(report(), report_file, indent=2, default=str)
+    log.info(f"Run report written to {path}")
+
+
+def reset():
+    """
+        Forgets every finished section, for starting a new run in the same process
+    """
+    global _started
+    with _sections_lock:
+        _sections.clear()
+    _started = datetime.datetime.now()
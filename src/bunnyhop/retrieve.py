@@ -1,135 +1,270 @@
 from . import config
+from . import download_cache
+from . import http_client
+from . import profiling
+from . import rule_engine
 
 from typing import Optional
+import concurrent.futures
 import pathlib
 import zipfile
 import tempfile
 import datetime
 import logging
-import requests
+import openpyxl
 import pandas
 
 
+# how many digits each of the Census codes has - a handful of them are stored as numbers in the workbook, so we pad them back out
+_CENSUS_CODE_WIDTHS = {
+    "Summary Level": 3,
+    "State FIPS Code": 2,
+    "County FIPS Code": 3,
+    "County Subdivision FIPS Code": 5,
+    "Place FIPS Code": 5,
+    "Consolidated City FIPS Code": 5,
+}
 
-def retrieve_gnis(source=config.GNIS_URL, output_folder: Optional[pathlib.PurePath]=None) -> pandas.DataFrame:
+
+@profiling.profiled()
+def retrieve_gnis(source=config.GNIS_URL, output_folder: Optional[pathlib.PurePath]=None, columns: Optional[dict]=config.GNIS_COLUMNS) -> dict:
     """Retrieves, decompresses, and loads the GNIS data into a pandas data frame, which it retuns to the callers
 
+    The zip file is streamed into a spooled buffer and read straight from there, so reading it only touches the disk if it's
+    larger than config.DOWNLOAD_SPOOL_MAX_SIZE. With the download cache enabled, the download is also saved in the cache as it
+    arrives, and when the cached copy is current, that's read instead.
+
     Args:
         source (str, optional): string URL to download the GNIS data. Defaults to config.GNIS_URL.
+        output_folder (pathlib.PurePath, optional): when provided, a copy of the data is written there as gnis_raw_input_data.csv
+        columns (dict, optional): the columns to keep, mapped to their data types. Defaults to config.GNIS_COLUMNS. None loads every column.
 
     Returns:
-        pandas.DataFrame: text version of GNIS data loaded into a pandas dataframe
+        dict: text version of GNIS data loaded into a pandas dataframe as 'df' and the path to the CSV copy as 'csv' (None if no output folder was provided)
     """
 
     log = logging.getLogger("bunnyhop.retrieve")
 
-    log.debug("Downloading GNIS data")
-    zip_local = download_file(source, extension="zip")
+    read_options = {}
+    if columns:
+        read_options = {"usecols": list(columns.keys()), "dtype": columns}
+
+    log.debug("Downloading and extracting GNIS data")
+    with open_source(source) as zip_buffer:
+        with zipfile.ZipFile(file=zip_buffer) as zipf:  # now load the zipfile, get the text file from it, and read it into a data frame. Libraries doing the heavy lifting here
+            
+            # return the data as a data frame - another function can load it into an arcgis data structure if needed
+            with zipf.open(name=config.GNIS_ZIP_FILE_PATH) as gnis_data:
+                gnis_df: pandas.DataFrame = pandas.read_csv(filepath_or_buffer=gnis_data, sep="|", **read_options)
 
-    # this is maybe an odd patter - why load the CSV in Python from the zip and then write it ourself?
-    # I was hoping we could load the data straight from the DF into ArcGIS. There's probably a way, but it's not that nice
-    # so we write it to a CSV. This code may be able to be simplified.
-    log.debug("Extracting GNIS Data")
-    with zipfile.ZipFile(file=zip_local) as zipf:  # now load the zipfile, get the text file from it, and read it into a CSV. Libraries doing the heavy lifting here
-        
-        # return the data as a data frame - another function can load it into an arcgis data structure if needed
-        with zipf.open(name=config.GNIS_ZIP_FILE_PATH) as gnis_data:
-            gnis_df: pandas.DataFrame = pandas.read_csv(filepath_or_buffer=gnis_data, sep="|")
+    profiling.record_output("gnis", features=len(gnis_df))
 
-    log.debug("Writing GNIS CSV")
     output_csv: Optional[pathlib.PurePath] = None
     if output_folder:
+        log.debug("Writing GNIS CSV")
         output_csv = output_folder/"gnis_raw_input_data.csv"
-        print(f"OUTPUT CSV: {output_csv}")
         gnis_df.to_csv(str(output_csv), index=False)
 
     log.info("GNIS retrieval complete")
     return {'df': gnis_df, 'csv': output_csv} 
 
 
-def download_file(source, extension):
-    
-    file_local: str = tempfile.mktemp(suffix=f".{extension}", prefix="bunnyhop_gnis")  # we could probably do this all in memory, but lets not and avoid a class of bugs
-    with requests.get(source, stream=True) as response:
+def open_source(source):
+    """
+        Opens the data at source for reading as a binary file - streamed into memory, and through the download cache when it's enabled
+
+    Returns:
+        file object: works as a context manager, and should be closed by the caller
+    """
+    cache = download_cache.get_cache()
+    if cache is not None:
+        return cache.open(source)
+    return stream_file(source)
+
+
+def stream_file(source, chunk_size=config.DOWNLOAD_CHUNK_SIZE, spool_max_size=config.DOWNLOAD_SPOOL_MAX_SIZE):
+    """
+        Streams a download into a spooled temporary file - it stays in memory unless it grows past spool_max_size,
+        at which point it spills over to disk. The caller is responsible for closing it (it works as a context manager).
+
+    Returns:
+        tempfile.SpooledTemporaryFile: the downloaded data, rewound to the beginning
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_size, prefix="bunnyhop_download")
+    try:
+        with http_client.get_client().stream(source) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                buffer.write(chunk)
+    except Exception:
+        buffer.close()
+        raise
+
+    buffer.seek(0)
+    return buffer
+
+
+def download_file(source, extension, chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+    """
+        Downloads the file at source and returns a local path to it. When the download cache is enabled, the path
+        is to the cached copy, which belongs to the cache - read it, but don't modify or delete it.
+    """
+    cache = download_cache.get_cache()
+    if cache is not None:
+        return str(cache.fetch(source))
+
+    file_local: str = tempfile.mktemp(suffix=f".{extension}", prefix="bunnyhop_download")  # we could probably do this all in memory, but lets not and avoid a class of bugs
+    with http_client.get_client().stream(source) as response:
         response.raise_for_status()
         with open(file=file_local, mode='wb') as outf:  # write out the file's data into a tempfile by chunk
-            for chunk in response.iter_content(chunk_size=4096):
+            for chunk in response.iter_content(chunk_size=chunk_size):
                 outf.write(chunk)
     return file_local 
 
     
-def retrieve_census(output_folder):
+@profiling.profiled()
+def retrieve_census(output_folder: Optional[pathlib.PurePath]=None) -> dict:
     """
         The census retrieval may be a bit funky. We need to find the most recent year of data that has a particular file, then ensure that the file
         has the needed columns existing (and maybe even populated? Check with Liana)
+
+    Args:
+        output_folder (pathlib.PurePath, optional): when provided, a copy of the California data is written there as census_FIPS.csv. The pipeline
+            itself uses the returned data frame directly, so this is only for keeping a record of the inputs.
+
+    Returns:
+        dict: the California Census data frame as 'df' and the path to the CSV copy as 'csv' (None if no output folder was provided)
     """
     log = logging.getLogger("bunnyhop")
 
-    output_csv = output_folder / "census_FIPS.csv"
-
     current_year = datetime.datetime.now(tz=datetime.UTC).year
-    check_year = current_year
-    while check_year >= config.CENSUS_EARLIEST_YEAR:
-        log.debug(f"Checking for Census data for year {check_year}")
-        found = _check_for_year_census_file(check_year, filepath_on_success=output_csv)
-        if found:
+    candidate_years = list(range(current_year, config.CENSUS_EARLIEST_YEAR - 1, -1))  # newest first
+
+    # find out which years have a file all at once, then only download the newest ones until one validates
+    for check_year in _probe_census_years(candidate_years):
+        log.debug(f"Checking Census data for year {check_year}")
+        california = _check_for_year_census_file(check_year)
+        if california is not None:
             log.debug(f"Census data found for year {check_year}")
             break
-        log.debug("Data not found or missing required information. Trying next")
-        check_year -= 1
+        log.debug("Data missing required information. Trying next")
     else:  # if we don't break, the else block runs, in which case, we couldn't retrieve data
         log.error(f"Couldn't retrieve correct Census data. Tried years from {config.CENSUS_EARLIEST_YEAR} - {current_year}. Check that their URL structure hasn't changed")
         raise RuntimeError(f"Couldn't retrieve correct Census data. Tried years from {config.CENSUS_EARLIEST_YEAR} - {current_year}. Check that their URL structure hasn't changed")
 
-    log.info(f"Census data written out to {str(output_csv)}")
-    # if we make it here, we've downloaded the census data into this file
-    return output_csv
+    profiling.record_output("census", features=len(california))
+
+    output_csv: Optional[pathlib.PurePath] = None
+    if output_folder:
+        output_csv = output_folder / "census_FIPS.csv"
+        california.to_csv(str(output_csv), index=False)
+        log.debug(f"Census data written out to {str(output_csv)}")
+
+    log.info("Census retrieval complete")
+    return {'df': california, 'csv': output_csv}
 
 
-def _check_for_year_census_file(year, filepath_on_success):
+def _probe_census_years(years, max_workers=config.CENSUS_PROBE_WORKERS) -> list:
+    """
+        Checks which years have a Census file, sending the requests for all of the years concurrently.
 
+    Returns:
+        list: the years that have a file, in the same order they were provided
+    """
+    log = logging.getLogger("bunnyhop")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = dict(zip(years, executor.map(_census_file_exists, years)))
+
+    log.debug(f"Census files found for years {[year for year in years if found[year]]}")
+    return [year for year in years if found[year]]
+
+
+def _census_file_exists(year) -> bool:
     # census_folder = config.CENSUS_FOLDER_URL.substitute(year=year)
     census_file = config.CENSUS_FILE_URL.substitute(year=year)
+    return http_client.get_client().head(census_file).status_code != 404
+
+
+def _check_for_year_census_file(year) -> Optional[pandas.DataFrame]:
+    """
+        Downloads and validates the Census all-geocodes file for a single year.
+        The file should already be known to exist - see _probe_census_years.
+
+    Returns:
+        pandas.DataFrame: the California records if the year's file has the data we need, otherwise None
+    """
+
+    census_file = config.CENSUS_FILE_URL.substitute(year=year)
+
+    census_local = download_file(census_file, "xlsx")
+    df = _read_census_workbook(census_local, state_fips="06")
+    
+    # replace all the spaces in the column names with underscores using a dictionary comprehension
+    df.rename(columns={value: value.replace(" ", "_") for value in df.columns}, inplace=True)
+
+    california = df  # already filtered to California while reading the workbook
+    california["has_data"] = california.loc[:,["County_FIPS_Code", "County_Subdivision_FIPS_Code", "Place_FIPS_Code", "Consolidated_City_FIPS_Code"]].any(axis=1) 
+    # we'd expect a certain number of missing records. 2022's has 53 missing, but there could be more
+    missing_count = california["has_data"].count() - california["has_data"].sum()
+    if missing_count > 5: # we expect 1, but error out if there are more than a few in case we're missing some for new places.
+        return None
+
+    # We need to drop this record because it will mess up the California City (in Kern County) data
+    california.drop(california[california["Area_Name"] == "California"].index, axis=0, inplace=True)  # drop the statewide census record so it doesn't muck anything up later -- goodness, that's a verbose bit of code
+
+    # make fixes to the census data based on items in the config file. Most are encoding errors or them having an old name()
+    rule_engine.AdjustmentRules.compile(replacements=[config.CENSUS_ADJUSTMENTS]).apply_to_frame(california)
+
+    # if we're successful, hand back the filtered DF
+    del california["has_data"] # we don't need that column - it was just a check
+    california.reset_index(drop=True, inplace=True)
+    return california
+
+
+def _read_census_workbook(workbook_path, state_fips) -> pandas.DataFrame:
+    """
+        Streams through the Census all-geocodes workbook one row at a time and keeps only the rows for a single state, so we
+        never hold the national sheet in memory. The rows are grouped by state, so we stop reading once we're past the state's block.
+
+    Args:
+        workbook_path (str): path to the all-geocodes xlsx file
+        state_fips (str): two digit State FIPS code of the rows to keep
+
+    Returns:
+        pandas.DataFrame: the state's rows, with every column as text
+    """
+    workbook = openpyxl.load_workbook(workbook_path, read_only=True, data_only=True)  # read only mode parses the sheet lazily as we iterate
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+
+        # there are title rows above the header in the published files, so find it rather than assuming where it is
+        for row in rows:
+            if "State FIPS Code" in row:
+                header = [str(value).strip() for value in row]
+                break
+        else:
+            raise ValueError(f"Couldn't find the header row in Census workbook {workbook_path}")
+
+        state_index = header.index("State FIPS Code")
+        widths = [_CENSUS_CODE_WIDTHS.get(column) for column in header]
+
+        records = []
+        for row in rows:
+            values = [_census_cell_text(value, width) for value, width in zip(row, widths)]
+            if values[state_index] == state_fips:
+                records.append(values)
+            elif records:  # we've gone past the state's rows
+                break
+    finally:
+        workbook.close()
+
+    return pandas.DataFrame.from_records(records, columns=header)
+
 
-    # check for the year's file
-    if requests.head(census_file).status_code != 404:
-        census_local = download_file(census_file, "xlsx")
-        df = pandas.read_excel(census_local,
-                                skiprows=4,
-                                dtype={
-                                    "State FIPS Code": str,
-                                    "County FIPS Code": str,
-                                    "County Subdivision FIPS Code": str,
-                                    "Place FIPS Code": str,
-                                    "Consolidated City FIPS Code": str,
-                                    "Area Name": str,
-                               })
-        
-        # replace all the spaces in the column names with underscores using a dictionary comprehension
-        df.rename(columns={value: value.replace(" ", "_") for value in df.columns}, inplace=True)
-
-        california = df.loc[df["State_FIPS_Code"] == "06",].reset_index(drop=True)
-        california["has_data"] = california.loc[:,["County_FIPS_Code", "County_Subdivision_FIPS_Code", "Place_FIPS_Code", "Consolidated_City_FIPS_Code"]].any(axis=1) 
-        # we'd expect a certain number of missing records. 2022's has 53 missing, but there could be more
-        missing_count = california["has_data"].count() - california["has_data"].sum()
-        if missing_count > 5: # we expect 1, but error out if there are more than a few in case we're missing some for new places.
-            return False
-
-        # We need to drop this record because it will mess up the California City (in Kern County) data
-        california.drop(california[california["Area_Name"] == "California"].index, axis=0, inplace=True)  # drop the statewide census record so it doesn't muck anything up later -- goodness, that's a verbose bit of code
-
-        # make fixes to the census data based on items in the config file. Most are encoding errors or them having an old name()
-        for field in config.CENSUS_ADJUSTMENTS:
-            # we have adjustment by column,
-            # then values we look for that need to be fixed
-            for adjustment_value in config.CENSUS_ADJUSTMENTS[field]:
-                # fill the dictionary value in where the column is currently equal to the dictionary key.
-                california.loc[california[field] == adjustment_value, field] = config.CENSUS_ADJUSTMENTS[field][adjustment_value]
-
-        # if we're successful, write the filtered DF to the provided path and return True
-        del california["has_data"] # we don't need that column - it was just a check
-        california.reset_index(drop=True, inplace=True)
-        california.to_csv(str(filepath_on_success), index=False)
-        return True
-    else:
-        return False
\ No newline at end of file
+def _census_cell_text(value, width):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and width:
+        return str(int(value)).zfill(width)
+    return str(value)
@@ -0,0 +1,96 @@
+"""
+    Applies the one-off value fixes from the config (config.CDTFA_ADJUST, config.GNIS_ADJUSTMENTS, and config.CENSUS_ADJUSTMENTS).
+
+    The adjustments come in two shapes - "where this field has this value, set that field to that value" for CDTFA,
+    and "in this field, replace this value with that value" for GNIS and Census. Both get compiled into one lookup
+    table keyed by (where field, where value), holding the fields to update and their new values. Applying them is
+    then a dictionary lookup per where field for each record, so it doesn't get slower as we add adjustments, and
+    the values never get pasted into an expression string, so they don't need escaping.
+
+    Every rule is checked against a record's original values, so one adjustment can't trigger another.
+"""
+
+class AdjustmentRules:
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules (dict): (where field, where value) tuples mapped to dictionaries of {update field: new value}. Use AdjustmentRules.compile to build it from the config formats.
+        """
+        self.rules = rules
+        self.where_fields = sorted(set(where_field for where_field, where_value in rules))
+        self.update_fields = sorted(set(update_field for updates in rules.values() for update_field in updates))
+
+    @classmethod
+    def compile(cls, conditional=(), replacements=()):
+        """
+        Args:
+            conditional (list, optional): adjustments shaped like config.CDTFA_ADJUST - {"where": {field: value}, "field": {field: new value}}
+            replacements (list, optional): adjustments shaped like config.GNIS_ADJUSTMENTS - {field: {value: new value}}
+        """
+        rules = {}
+        for adjust in conditional:
+            check_field = list(adjust["where"].keys())[0]
+            check_value = adjust["where"][check_field]
+            rules.setdefault((check_field, check_value), {}).update(adjust["field"])
+
+        for replacement in replacements:
+            for field_name in replacement:
+                for old_value, new_value in replacement[field_name].items():
+                    rules.setdefault((field_name, old_value), {})[field_name] = new_value
+
+        return cls(rules)
+
+    def for_fields(self, field_names):
+        """
+            Returns only the rules that can be applied to data with these fields
+        """
+        field_names = set(field_names)
+        return AdjustmentRules({key: updates for key, updates in self.rules.items()
+                                if key[0] in field_names and all(update_field in field_names for update_field in updates)})
+
+    def updates_for(self, values) -> dict:
+        """
+            Returns the {field: new value} updates for a record, given a dictionary of its current values
+        """
+        updates = {}
+        for where_field in self.where_fields:
+            match = self.rules.get((where_field, values.get(where_field)))
+            if match:
+                updates.update(match)
+        return updates
+
+    @property
+    def fields(self) -> list:
+        """
+            Every field the rules read or write, so the rules can run as a step in derived_fields.calculate_fields
+        """
+        return sorted(set(self.where_fields) | set(self.update_fields))
+
+    def apply(self, values):
+        """
+            Applies the rules to a dictionary of a record's values in place
+        """
+        values.update(self.updates_for(values))
+
+    def apply_to_frame(self, df):
+        """
+            Applies the rules to a data frame in place, with one vectorized update per pair of where field and update field
+
+        Returns:
+            pandas.DataFrame: the same data frame, for convenience
+        """
+        rules = self.for_fields(df.columns)
+        original_values = {where_field: df[where_field].astype(object) for where_field in rules.where_fields}
+
+        for where_field in rules.where_fields:
+            for update_field in rules.update_fields:
+                mapping = {where_value: updates[update_field] for (field_name, where_value), updates in rules.rules.items()
+                           if field_name == where_field and update_field in updates}
+                if not mapping:
+                    continue
+
+                matched = original_values[where_field].isin(list(mapping.keys()))
+                df.loc[matched, update_field] = original_values[where_field][matched].map(mapping)
+
+        return df
@@ -0,0 +1,82 @@
+"""
+    A small static bounding box index (a Sort-Tile-Recursive packed R-tree) for prefiltering candidates before
+    running exact - and comparatively slow - geometry predicates like touches or disjoint.
+
+    The tree is built once from a list of envelopes and can't be modified afterward. Items are identified by their
+    position in that list. Envelopes are (xmin, ymin, xmax, ymax) tuples, and boxes that only share an edge or a
+    corner count as intersecting, since geometries that touch have envelopes that do at least that much.
+"""
+
+import math
+
+
+def intersects(envelope1, envelope2) -> bool:
+    return envelope1[0] <= envelope2[2] and envelope2[0] <= envelope1[2] and envelope1[1] <= envelope2[3] and envelope2[1] <= envelope1[3]
+
+
+def _combine(envelopes):
+    return (min(envelope[0] for envelope in envelopes),
+            min(envelope[1] for envelope in envelopes),
+            max(envelope[2] for envelope in envelopes),
+            max(envelope[3] for envelope in envelopes))
+
+
+def _center(envelope):
+    return (envelope[0] + envelope[2]) / 2, (envelope[1] + envelope[3]) / 2
+
+
+class STRTree:
+
+    def __init__(self, envelopes, node_capacity=8):
+        """
+        Args:
+            envelopes (list): (xmin, ymin, xmax, ymax) tuples for the items to index
+            node_capacity (int, optional): most children in one node of the tree
+        """
+        self.envelopes = [tuple(envelope) for envelope in envelopes]
+        self.node_capacity = node_capacity
+
+        # each node is (envelope, children, item index) - leaves have children set to None
+        level = [(envelope, None, index) for index, envelope in enumerate(self.envelopes)]
+        while len(level) > node_capacity:
+            level = self._pack(level)
+        self.root = (_combine([node[0] for node in level]), level, None) if level else None
+
+    def __len__(self):
+        return len(self.envelopes)
+
+    def _pack(self, nodes):
+        """
+            Groups one level of nodes into parent nodes - sorts them into vertical slices by x, then groups each slice by y
+        """
+        parent_count = math.ceil(len(nodes) / self.node_capacity)
+        slice_count = math.ceil(math.sqrt(parent_count))
+        slice_size = slice_count * self.node_capacity
+
+        nodes = sorted(nodes, key=lambda node: _center(node[0])[0])
+        parents = []
+        for slice_start in range(0, len(nodes), slice_size):
+            vertical_slice = sorted(nodes[slice_start:slice_start + slice_size], key=lambda node: _center(node[0])[1])
+            for start in range(0, len(vertical_slice), self.node_capacity):
+                children = vertical_slice[start:start + self.node_capacity]
+                parents.append((_combine([child[0] for child in children]), children, None))
+        return parents
+
+    def query(self, envelope) -> list:
+        """
+            Returns the indexes of the items whose envelopes intersect envelope, in index order
+        """
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node_envelope, children, index = stack.pop()
+            if not intersects(node_envelope, envelope):
+                continue
+            if children is None:
+                found.append(index)
+            else:
+                stack.extend(children)
+        return sorted(found)
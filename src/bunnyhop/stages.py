@@ -0,0 +1,155 @@
+"""
+    Runs the pipeline as a series of stages and keeps a manifest of the ones that finished, so that an interrupted run
+    can pick up where it left off instead of starting over.
+
+    Each stage reads its inputs from, and writes its outputs to, attributes of one shared object (the CDTFARetrieve
+    runner). When a stage finishes, the datasets among its outputs are moved to disk and the stage is recorded in the
+    manifest along with its outputs and a hash of its inputs. The input hash covers the input values, the stage's
+    settings (the config values and source edit dates it depends on), and which run of each upstream stage produced
+    the inputs - so when a stage reruns, everything downstream of it reruns too.
+
+    On a resumed run, a stage is skipped and its recorded outputs are put back on the object when its input hash
+    matches the manifest and all of its output datasets still exist. The first stage that doesn't match runs, along
+    with anything that depends on it.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from . import __version__
+from . import profiling
+
+log = logging.getLogger("bunnyhop.stages")
+
+MANIFEST_VERSION = 1
+
+
+class Stage:
+
+    def __init__(self, name, run, inputs=(), outputs=(), datasets=(), files=(), settings=None, when=None):
+        """
+        Args:
+            name (str): unique name for the stage in the manifest
+            run (callable): does the stage's work - called with no arguments
+            inputs (tuple, optional): attributes the stage reads
+            outputs (tuple, optional): attributes the stage sets. Their values need to be JSON serializable
+            datasets (tuple, optional): the outputs that hold dataset names or paths - they get moved to disk when the stage
+                finishes, and the stage reruns if any of them are missing
+            files (tuple, optional): the outputs that hold paths to plain files, like CSVs - the stage reruns if any of them are missing
+            settings (callable, optional): returns a JSON serializable dictionary of anything else the stage depends on
+            when (callable, optional): the stage only runs when this returns True
+        """
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.datasets = tuple(datasets)
+        self.files = tuple(files)
+        self.settings = settings
+        self.when = when
+
+
+class StageRunner:
+
+    def __init__(self, state, engine, manifest_path=None):
+        """
+        Args:
+            state: the object the stages read their inputs from and write their outputs to
+            engine: the geometry_engine holding the stages' datasets
+            manifest_path (str, optional): where to keep the manifest. Without one, the stages just run in order and nothing
+                is moved to disk or recorded
+        """
+        self.state = state
+        self.engine = engine
+        self.manifest_path = manifest_path
+        self.manifest = {"version": MANIFEST_VERSION, "stages": {}}
+
+    def load_manifest(self) -> dict:
+        if self.manifest_path is None or not os.path.exists(self.manifest_path):
+            return {"version": MANIFEST_VERSION, "stages": {}}
+
+        with open(self.manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("version") != MANIFEST_VERSION:
+            log.warning("The stage manifest is from a different version of bunnyhop - running every stage")
+            return {"version": MANIFEST_VERSION, "stages": {}}
+        return manifest
+
+    def save_manifest(self):
+        if self.manifest_path is None:
+            return
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, default=str)
+        os.replace(temp_path, self.manifest_path)
+
+    def run(self, stages, resume=False):
+        """
+            Runs the stages in order. When resume is True, skips the stages the manifest says already finished with the same inputs.
+        """
+        previous = self.load_manifest()["stages"] if resume else {}
+        self.manifest = {"version": MANIFEST_VERSION, "stages": {}}
+        producers = {}  # attribute -> the run ID of the stage that last set it
+
+        for stage in stages:
+            if stage.when is not None and not stage.when():
+                log.debug(f"Stage {stage.name} isn't needed on this run")
+                continue
+
+            inputs_hash = self.inputs_hash(stage, producers)
+            record = previous.get(stage.name)
+            if record is not None and record["inputs_hash"] == inputs_hash and self._outputs_exist(stage, record["outputs"]):
+                log.info(f"Skipping stage {stage.name} - it already finished with the same inputs")
+                for attribute, value in record["outputs"].items():
+                    setattr(self.state, attribute, value)
+            else:
+                log.info(f"Running stage {stage.name}")
+                with profiling.profile(f"stage {stage.name}"):
+                    stage.run()
+                record = {"inputs_hash": inputs_hash, "outputs": self._persist_outputs(stage), "run_id": uuid.uuid4().hex,
+                          "finished": datetime.datetime.now().isoformat()}
+
+            self.manifest["stages"][stage.name] = record
+            self.save_manifest()
+            for attribute in stage.outputs:
+                producers[attribute] = record["run_id"]
+
+    def inputs_hash(self, stage, producers) -> str:
+        inputs = {attribute: getattr(self.state, attribute) for attribute in stage.inputs}
+        description = {
+            "version": __version__,
+            "inputs": inputs,
+            "producers": {attribute: producers.get(attribute) for attribute in stage.inputs},
+            "settings": stage.settings() if stage.settings is not None else None,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _persist_outputs(self, stage) -> dict:
+        """
+            Moves the stage's output datasets to disk and returns its outputs for the manifest. Paths into the memory workspace
+            are replaced with the path they were moved to, while names stay names.
+        """
+        if self.manifest_path is not None:
+            for attribute in stage.datasets:
+                value = getattr(self.state, attribute)
+                if value is None:
+                    continue
+                on_disk = self.engine.on_disk(value)
+                if os.path.dirname(str(value)):
+                    setattr(self.state, attribute, on_disk)
+
+        return {attribute: _serializable(getattr(self.state, attribute)) for attribute in stage.outputs}
+
+    def _outputs_exist(self, stage, outputs) -> bool:
+        return (all(outputs.get(attribute) is None or self.engine.exists(outputs[attribute]) for attribute in stage.datasets)
+                and all(outputs.get(attribute) is None or os.path.exists(outputs[attribute]) for attribute in stage.files))
+
+
+def _serializable(value):
+    if value is None or isinstance(value, (str, int, float, bool, list, dict)):
+        return value
+    return str(value)  # paths
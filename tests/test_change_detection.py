@@ -0,0 +1,113 @@
+import contextlib
+import copy
+import os
+import types
+
+import pytest
+
+from bunnyhop import bunny
+from bunnyhop import change_detection
+
+
+class FakeArcpy:
+    """
+        Just enough of arcpy for change_detection - each feature class is a list of rows (dictionaries keyed by field name)
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.da = types.SimpleNamespace(SearchCursor=self.search_cursor)
+        self.management = types.SimpleNamespace(CreateFileGDB=self.create_file_gdb, Copy=self.copy, Delete=self.datasets.pop)
+        self.env = types.SimpleNamespace(workspace="workspace")
+
+    def ListFields(self, path):
+        return [types.SimpleNamespace(name=name, type="Geometry" if name == "Shape" else "String") for name in self.datasets[path][0]]
+
+    def Exists(self, path):
+        return path in self.datasets or os.path.isdir(path)
+
+    def search_cursor(self, path, fields):
+        return contextlib.nullcontext([tuple(row["Shape"] if field == "SHAPE@WKB" else row[field] for field in fields) for row in self.datasets[path]])
+
+    def create_file_gdb(self, folder, name):
+        os.makedirs(os.path.join(folder, name))
+
+    def copy(self, source, destination):
+        self.datasets[destination] = copy.deepcopy(self.datasets[source])
+
+
+def parcel(county, copri, shape):
+    return {"COUNTY": county, "COPRI": copri, "Shape": shape}
+
+
+@pytest.fixture
+def arcpy(monkeypatch):
+    fake = FakeArcpy({"cdtfa": [parcel("Alpine", "02001", b"a1"), parcel("Alpine", "02999", b"a2"), parcel("Kern", "15001", b"k1")]})
+    monkeypatch.setattr(change_detection, "arcpy", fake)
+    return fake
+
+
+def test_changed_partitions():
+    previous = {"partitions": {"Alpine": "1", "Kern": "2", "Lake": "3"}}
+    current = {"partitions": {"Alpine": "1", "Kern": "changed", "Mono": "4"}}
+    assert change_detection.changed_partitions(previous, current) == {"Kern", "Lake", "Mono"}  # changed, removed, and added
+    assert change_detection.changed_partitions(previous, previous) == set()
+
+
+def test_fingerprint_features(arcpy):
+    fingerprint = change_detection.fingerprint_features("cdtfa", "COUNTY")
+    assert fingerprint["count"] == 3
+    assert set(fingerprint["partitions"]) == {"Alpine", "Kern"}
+
+    arcpy.datasets["cdtfa"].reverse()  # download order doesn't matter
+    assert change_detection.fingerprint_features("cdtfa", "COUNTY") == fingerprint
+
+    arcpy.datasets["cdtfa"][0]["Shape"] = b"k1 edited"  # a geometry edit only changes its own county
+    edited = change_detection.fingerprint_features("cdtfa", "COUNTY")
+    assert change_detection.changed_partitions(fingerprint, edited) == {"Kern"}
+
+    arcpy.datasets["cdtfa"].append(parcel("Lake", "17001", b"l1"))
+    assert change_detection.changed_partitions(edited, change_detection.fingerprint_features("cdtfa", "COUNTY")) == {"Lake"}
+
+
+def test_run_state(arcpy, tmp_path):
+    arcpy.datasets[os.path.join("workspace", "cities")] = [parcel("Kern", "15001", b"k1")]
+    run_state = change_detection.RunState(tmp_path / "state")
+    assert run_state.load() is None
+
+    fingerprint = {"count": 1, "partitions": {"Kern": "1"}, "edit_date": 5, "inputs": "inputs"}
+    run_state.save(fingerprint, {"cities": "cities"})
+    assert run_state.load() == {"fingerprint": fingerprint, "outputs": {"cities": "cities"}}
+    assert arcpy.datasets[run_state.output_path("cities")] == arcpy.datasets[os.path.join("workspace", "cities")]
+
+    del arcpy.datasets[run_state.output_path("cities")]  # a state without its outputs can't be used
+    assert run_state.load() is None
+
+
+class FakeEngine:
+    supports_worker_processes = True
+
+    def field_names(self, dataset):
+        return ["CDTFA_COUNTY"]
+
+
+@pytest.mark.parametrize("changed, rebuild_counties", [
+    (0, None),
+    (2, ["County 0", "County 1"]),
+    (12, None),  # more than CDTFA_INCREMENTAL_MAX_COUNTIES, so the full layer gets rebuilt
+])
+def test_check_for_changes(monkeypatch, changed, rebuild_counties):
+    previous = {"count": 58, "partitions": {f"County {index}": "same" for index in range(58)}, "edit_date": 1, "inputs": "inputs"}
+    current = {"count": 58, "partitions": dict(previous["partitions"], **{f"County {index}": "edited" for index in range(changed)})}
+    monkeypatch.setattr(bunny.download_cache, "layer_edit_date", lambda url: 2)
+    monkeypatch.setattr(change_detection, "fingerprint_inputs", lambda tables, settings: "inputs")
+    monkeypatch.setattr(change_detection, "fingerprint_features", lambda features, partition_field: current)
+    monkeypatch.setattr(bunny.config, "CDTFA_INCREMENTAL_MAX_COUNTIES", 10)
+
+    runner = bunny.CDTFARetrieve(detect_changes=True, partition_by_county=False, engine=FakeEngine())
+    runner.run_state = types.SimpleNamespace(load=lambda: {"fingerprint": previous, "outputs": {}})
+    runner.cdtfa_input_path = "cdtfa_source_data"
+
+    assert runner.check_for_changes() == (changed > 0)
+    assert runner.rebuild_counties == rebuild_counties
+    assert runner.fingerprint["edit_date"] == 2
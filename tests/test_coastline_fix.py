@@ -1,30 +1,170 @@
-import pytest
 import logging
 
-import arcpy
+import numpy
+import pandas
+import pytest
 
-from bunnyhop import coastline, config
+from bunnyhop import coastline, config, geometry_engine
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
 
-# this is just a currently valid local file - needs to be abstracted out
-COUNTIES_SOURCE_DATA = r"counties_working"
-CITIES_SOURCE_DATA = r"cities_dissolved"
-WORKSPACE = r"C:\Users\nick.santos\AppData\Local\Temp\bunnyhop_workspace1om6mijr\bunnyhop_workspace.gdb"
+THRESHOLD = 100
 
-def test_coastline_fixes(counties_source_data=COUNTIES_SOURCE_DATA, cities_source_data=CITIES_SOURCE_DATA, workspace=WORKSPACE):
-    with arcpy.EnvManager(workspace=workspace, overwriteOutput=True):
-        coastline.coastal_cut(input_data=counties_source_data,
-                              output_name="testing_coastal_cut_counties",
-                              cities_counties="counties",
-                              log=log,
-                              run_sliver_fix=True
-                              )
-    
-        coastline.coastal_cut(input_data=cities_source_data,
-                              output_name="testing_coastal_cut_cities",
-                              cities_counties="cities",
+
+class FakeEngine:
+    name = "fake"
+    supports_worker_processes = True
+
+    def __init__(self, workspace="workspace.gdb"):
+        self.workspace = workspace
+        self.fetched = []
+
+    def exists(self, dataset):
+        return dataset in self.fetched
+
+    def fetch_layer(self, url, output, where=None, out_sr=None, query=None):
+        self.fetched.append(output)
+
+    def field_names(self, dataset):
+        return ["SOURCE_OBJECTID", config.COASTLINE_EXCLUSION_FIELD]
+
+    def delete_fields(self, dataset, field_names):
+        assert field_names == ["SOURCE_OBJECTID"]
+
+
+def test_coastline_provider_shares_layers():
+    engine = FakeEngine()
+    provider = coastline.CoastlineProvider(url="https://example.com/coastline/FeatureServer/0")
+
+    counties = provider.get(("ocean", "bay"), out_sr=3310, engine=engine)
+    cities = provider.get(("bay", "ocean"), out_sr=3310, engine=engine)  # same values in another order
+    assert cities == counties
+    assert counties.startswith("workspace.gdb")
+    assert len(engine.fetched) == 1
+
+    assert provider.get(("ocean",), out_sr=3310, engine=engine) != counties
+    assert provider.get(("ocean", "bay"), out_sr=3857, engine=engine) != counties
+    assert len(engine.fetched) == 3
+
+
+def test_coastline_provider_key():
+    provider = coastline.CoastlineProvider(url="https://example.com/coastline/FeatureServer/0")
+    first = FakeEngine()
+    provider.get(("ocean", "bay"), engine=first)
+
+    second = FakeEngine()
+    second.fetched = first.fetched  # the same workspace
+    provider.get(("ocean", "bay"), engine=second)  # another engine with the same name and workspace reuses the layer...
+    assert len(first.fetched) == 1
+    first.fetched.clear()
+    provider.get(("ocean", "bay"), engine=first)  # ...unless it's gone
+    assert len(first.fetched) == 1
+
+    elsewhere = FakeEngine(workspace="other.gdb")
+    provider.get(("ocean", "bay"), engine=elsewhere)  # a new workspace gets its own copy
+    assert elsewhere.fetched[0].startswith("other.gdb")
+
+
+def open_engine_slivers():
+    shapely = pytest.importorskip("shapely")
+    pytest.importorskip("pyproj")
+
+    land = shapely.union_all([shapely.box(0, 0, 1000, 1000),
+                              shapely.box(-1005, 0, -1000, 10),  # half the threshold and touching the ocean, so it moves there
+                              shapely.box(-1010, 500, -1000, 510)])  # exactly the threshold, so it counts as large and stays
+    ocean = shapely.box(-1000, 0, 0, 1000)
+    engine = geometry_engine.OpenEngine()
+    engine.from_frame("slivers", pandas.DataFrame({config.FIELD_NAMES['legal_place_name']: ["Place", "Place"]}), [land, ocean], crs=3857)
+    return engine
+
+
+def test_open_engine_fix_slivers_threshold():
+    engine = open_engine_slivers()
+    engine.fix_slivers("slivers", keep_fragment_geoms=[], threshold=THRESHOLD)
+
+    import shapely
+    land, ocean = engine.to_frame("slivers")[1]
+    assert shapely.area(land) == 1000 * 1000 + THRESHOLD
+    assert shapely.area(ocean) == 1000 * 1000 + THRESHOLD / 2
+
+
+def _cut_frame(engine, dataset):
+    import shapely
+    attributes, geometry = engine.to_frame(dataset)
+    frame = attributes.assign(area=shapely.area(geometry).round(3), wkt=shapely.to_wkt(shapely.normalize(geometry), rounding_precision=3))
+    return frame.sort_values(list(frame.columns), key=lambda column: column.astype(str)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("cities_counties", ["cities", "counties"])
+def test_targeted_overlay_matches_full_union(cities_counties):
+    shapely = pytest.importorskip("shapely")
+    pytest.importorskip("pyproj")
+    harness = pytest.importorskip("benchmarks.harness")
+
+    bench = harness.Workbench("open", 0.1)
+    features = dict(zip(("cities", "counties"), bench.joined()))[cities_counties]
+    coastal_layer = bench.dataset(f"coastline_{cities_counties}", lambda: harness.fixtures.make_coastline(cities_counties, bench.scale))
+
+    # an inland feature without any names - both ways of cutting should drop it
+    attributes, geometry = bench.engine.to_frame(features)
+    blank = attributes.iloc[[0]].copy()
+    blank[[config.FIELD_NAMES[field] for field in ("legal_place_name", "place_name", "place_type")]] = ""
+    bench.engine.from_frame("cut_input", pandas.concat([attributes, blank], ignore_index=True),
+                            numpy.append(geometry, shapely.box(500000, 500000, 501000, 501000)), crs=bench.engine.spatial_reference_code(features))
+
+    for targeted_overlay in (False, True):
+        coastline.coastal_cut("cut_input", f"cut_{targeted_overlay}", cities_counties, log, run_sliver_fix=True,
+                              coastal_layer=coastal_layer, targeted_overlay=targeted_overlay, engine=bench.engine)
+
+    full, targeted = _cut_frame(bench.engine, "cut_False"), _cut_frame(bench.engine, "cut_True")
+    names = [config.FIELD_NAMES[field] for field in ("legal_place_name", "place_name", "place_type")]
+    assert len(full) > len(attributes)  # the coastal places got their ocean polygons
+    assert not (full[names] == "").all(axis=1).any()
+    pandas.testing.assert_frame_equal(full, targeted)
+
+
+def arcpy_box(arcpy, x_min, y_min, x_max, y_max, hole=False):
+    points = [(x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)]  # clockwise, for an outer ring
+    return arcpy.Array([arcpy.Point(x, y) for x, y in (points[::-1] if hole else points)])
+
+
+def test_reconcile_parts():
+    arcpy = pytest.importorskip("arcpy")
+    sr = arcpy.SpatialReference(3857)
+
+    land = arcpy.Polygon(arcpy.Array([arcpy_box(arcpy, 0, 0, 1000, 1000),
+                                      arcpy_box(arcpy, -1005, 0, -1000, 10),  # moves to the ocean
+                                      arcpy_box(arcpy, -1010, 500, -1000, 510),  # exactly the threshold - stays
+                                      arcpy_box(arcpy, -1005, 900, -1000, 910),  # small, but one of the fragments we keep
+                                      arcpy_box(arcpy, -1008, 300, -1000, 308),  # a part with a hole moves to the ocean, hole and all
+                                      arcpy_box(arcpy, -1006, 302, -1004, 304, hole=True)]), sr)
+    ocean = arcpy.Polygon(arcpy_box(arcpy, -1000, 0, 0, 1000), sr)
+    bay = arcpy.Polygon(arcpy.Array([arcpy_box(arcpy, 1000, 0, 2000, 1000),
+                                     arcpy_box(arcpy, 500, 1000, 510, 1005)]), sr)  # a bay fragment stuck to the land moves into it
+    keep = [arcpy.PointGeometry(arcpy.Point(-1002, 905), sr)]
+    rows = [[land, "Place", 1], [ocean, "Place", 2], [bay, "Place", 3]]
+
+    changed = coastline.reconcile_parts(rows, keep, THRESHOLD, sr=sr)
+
+    assert [row[2] for row in changed] == [1, 2, 3]
+    assert rows[0][0].area == pytest.approx(1000 * 1000 + THRESHOLD + THRESHOLD / 2 + THRESHOLD / 2)
+    assert rows[1][0].area == pytest.approx(1000 * 1000 + THRESHOLD / 2 + 60)
+    assert rows[2][0].area == pytest.approx(1000 * 1000)
+
+
+def test_coastline_fixes():
+    arcpy = pytest.importorskip("arcpy")
+    harness = pytest.importorskip("benchmarks.harness")
+
+    bench = harness.Workbench("arcpy", 0.1)
+    for cities_counties, features in zip(("cities", "counties"), bench.joined()):
+        coastal_layer = bench.dataset(f"coastline_{cities_counties}", lambda: harness.fixtures.make_coastline(cities_counties, bench.scale))
+        coastline.coastal_cut(input_data=features,
+                              output_name=f"testing_coastal_cut_{cities_counties}",
+                              cities_counties=cities_counties,
                               log=log,
-                              run_sliver_fix=True
-                              )
\ No newline at end of file
+                              run_sliver_fix=True,
+                              coastal_layer=coastal_layer,
+                              engine=bench.engine)
+        assert arcpy.Exists(f"testing_coastal_cut_{cities_counties}")
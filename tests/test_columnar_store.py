@@ -0,0 +1,62 @@
+import numpy
+import pandas
+import pytest
+
+shapely = pytest.importorskip("shapely")
+pyproj = pytest.importorskip("pyproj")
+
+from bunnyhop import columnar_store, geometry_engine
+
+
+def test_round_trip(tmp_path):
+    attributes = pandas.DataFrame({
+        "CITY": ["Alpha", None, "Ñipomo"],
+        "COUNT": [1, 2, 3],
+        "AREA": [1.5, None, 2.5],
+        "LOOSE": pandas.Series([10, None, 30], dtype=object),  # the way calculate_fields leaves numbers
+    })
+    geometry = numpy.array([shapely.box(0, 0, 1, 1), None, shapely.Polygon()], dtype=object)
+    folder = str(tmp_path / "dataset")
+
+    columnar_store.write(folder, attributes, geometry, pyproj.CRS.from_epsg(3310))
+    stored = columnar_store.read(folder)
+
+    assert len(stored) == 3
+    assert stored.crs.to_epsg() == 3310
+    assert list(stored.column("CITY")) == ["Alpha", None, "Ñipomo"]
+    assert isinstance(stored.column("COUNT"), numpy.memmap)
+    assert list(stored.column("COUNT")) == [1, 2, 3]
+    assert numpy.isnan(stored.column("LOOSE")[1]) and stored.column("LOOSE")[2] == 30
+
+    read_geometry = stored.geometry()
+    assert shapely.equals(read_geometry[0], geometry[0])
+    assert read_geometry[1] is None
+    assert shapely.is_empty(read_geometry[2])
+    assert shapely.from_wkb(bytes(stored.wkb(0))).equals(geometry[0])
+
+
+def test_older_format_counts_as_missing(tmp_path):
+    folder = str(tmp_path / "dataset")
+    columnar_store.write(folder, pandas.DataFrame({"CITY": ["Alpha"]}))
+    assert columnar_store.exists(folder)
+
+    meta_path = tmp_path / "dataset" / "meta.json"
+    meta_path.write_text(meta_path.read_text().replace(f'"version": {columnar_store.FORMAT_VERSION}', '"version": 1'))
+    assert not columnar_store.exists(folder)
+    with pytest.raises(ValueError):
+        columnar_store.read(folder)
+
+
+def test_open_engine_save_and_load(tmp_path):
+    engine = geometry_engine.OpenEngine()
+    engine.from_frame("parcels", pandas.DataFrame({"CITY": ["Alpha", "Beta"]}), [shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1)], crs=3310)
+
+    folder = str(tmp_path / "parcels")
+    engine.save("parcels", folder)
+    engine.delete("parcels")
+    engine.load(folder)
+
+    attributes, geometry = engine.to_frame("parcels")
+    assert list(attributes["CITY"]) == ["Alpha", "Beta"]
+    assert list(shapely.area(geometry)) == [1, 1]
+    assert engine.spatial_reference_code("parcels") == 3310
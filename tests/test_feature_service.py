@@ -0,0 +1,154 @@
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+
+import pytest
+
+from bunnyhop import feature_service
+
+OBJECT_IDS = [1, 2, 3, 5, 8, 9, 10, 14]  # gaps on purpose, like a layer that's had deletes
+
+LAYER_INFO = {
+    "objectIdField": "OBJECTID",
+    "maxRecordCount": 3,
+    "geometryType": "esriGeometryPolygon",
+    "extent": {"spatialReference": {"wkid": 102100, "latestWkid": 3857}},
+    "editingInfo": {"lastEditDate": 1700000000000},
+    "fields": [
+        {"name": "OBJECTID", "type": "esriFieldTypeOID"},
+        {"name": "CITY", "type": "esriFieldTypeString", "length": 50},
+        {"name": "Shape__Area", "type": "esriFieldTypeDouble"},
+    ],
+}
+
+
+def _feature(oid):
+    return {"attributes": {"OBJECTID": oid, "CITY": f"City {oid}"},
+            "geometry": {"rings": [[[oid, 0], [oid, 1], [oid + 1, 1], [oid + 1, 0], [oid, 0]]]}}  # clockwise, like outer rings from a real server
+
+
+class StandInLayerHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the handful of REST requests the paged reader makes with canned JSON"""
+    requested_pages = []
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path == "/layer":
+            body = LAYER_INFO
+        elif parsed.path == "/layer/query" and params.get("returnIdsOnly") == "true":
+            body = {"objectIdFieldName": "OBJECTID", "objectIds": list(reversed(OBJECT_IDS))}
+        elif parsed.path == "/layer/query":
+            start, end = map(int, re.search(r"OBJECTID >= (\d+) AND OBJECTID <= (\d+)", params["where"]).groups())
+            self.requested_pages.append([start, end])
+            body = {"features": [_feature(oid) for oid in OBJECT_IDS if start <= oid <= end]}
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def layer_url():
+    StandInLayerHandler.requested_pages = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInLayerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/layer"
+    server.shutdown()
+    server.server_close()
+
+
+def test_plan_pages(layer_url):
+    reader = feature_service.PagedLayerReader(layer_url)
+
+    assert reader.page_size == 3  # from maxRecordCount
+    assert reader.plan_pages() == [[1, 3], [5, 9], [10, 14]]
+
+
+def test_iter_pages(layer_url):
+    reader = feature_service.PagedLayerReader(layer_url, max_workers=2)
+
+    features = [feature for page, page_features in reader.iter_pages(reader.plan_pages()) for feature in page_features]
+
+    assert sorted(feature["attributes"]["OBJECTID"] for feature in features) == OBJECT_IDS
+
+
+def test_checkpoint_resume(layer_url, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    reader = feature_service.PagedLayerReader(layer_url)
+    checkpoint = feature_service.PageCheckpoint(checkpoint_path, layer_url, reader.plan_pages(), edit_date=1700000000000)
+    checkpoint.mark_complete([1, 3])
+
+    resumed = feature_service.PageCheckpoint.load(checkpoint_path, layer_url, edit_date=1700000000000)
+    assert resumed.remaining == [[5, 9], [10, 14]]
+
+    list(reader.iter_pages(resumed.remaining))
+    assert sorted(StandInLayerHandler.requested_pages) == [[5, 9], [10, 14]]
+
+    # if the layer was edited since, the checkpoint doesn't apply anymore
+    assert feature_service.PageCheckpoint.load(checkpoint_path, layer_url, edit_date=1800000000000) is None
+
+
+def test_download_layer(layer_url, tmp_path):
+    arcpy = pytest.importorskip("arcpy")
+    arcpy.management.CreateFileGDB(str(tmp_path), "test.gdb")
+    out_feature_class = str(tmp_path / "test.gdb" / "downloaded")
+
+    feature_service.download_layer(layer_url, out_feature_class, checkpoint_path=str(tmp_path / "checkpoint.json"))
+
+    with arcpy.da.SearchCursor(out_feature_class, ["SOURCE_OBJECTID", "CITY"]) as cursor:
+        rows = sorted(cursor)
+    assert rows == [(oid, f"City {oid}") for oid in OBJECT_IDS]
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_layer_edit_date():
+    assert feature_service.layer_edit_date(LAYER_INFO) == 1700000000000
+    assert feature_service.layer_edit_date({"editingInfo": {"lastEditDate": 2, "dataLastEditDate": 1}}) == 1  # schema edits don't count
+    assert feature_service.layer_edit_date({}) is None
+
+
+def test_open_engine_fetch_layer(layer_url, tmp_path, monkeypatch):
+    pytest.importorskip("shapely")
+    pytest.importorskip("pyproj")
+    import pandas
+    import shapely
+    from bunnyhop import columnar_store, download_cache, geometry_engine
+
+    monkeypatch.setattr(download_cache.config, "DOWNLOAD_CACHE_ENABLED", True)
+    monkeypatch.setattr(download_cache, "_cache", download_cache.DownloadCache(folder=tmp_path / "cache"))
+    engine = geometry_engine.OpenEngine()
+
+    # an interrupted download already wrote the first page
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    checkpoint = feature_service.PageCheckpoint(checkpoint_path, layer_url, [[1, 3], [5, 9], [10, 14]], edit_date=1700000000000)
+    checkpoint.mark_complete([1, 3])
+    columnar_store.write(f"{checkpoint_path}.pages/1_3", pandas.DataFrame({"CDTFA_CITY": ["City 1", "City 2", "City 3"]}),
+                         shapely.box([1, 2, 3], 0, [2, 3, 4], 1), geometry_engine._crs(3857))
+
+    assert not engine.fetch_layer(layer_url, "downloaded", checkpoint_path=checkpoint_path, field_map={"CITY": "CDTFA_CITY"})
+    assert sorted(StandInLayerHandler.requested_pages) == [[5, 9], [10, 14]]
+    attributes, geometry = engine.to_frame("downloaded")
+    assert list(attributes["CDTFA_CITY"]) == [f"City {oid}" for oid in OBJECT_IDS]
+    assert list(shapely.bounds(geometry)[:, 0]) == OBJECT_IDS
+    assert engine.spatial_reference_code("downloaded") == 3857
+    assert not (tmp_path / "checkpoint.json").exists() and not (tmp_path / "checkpoint.json.pages").exists()
+
+    # the second time, it comes out of the cache
+    StandInLayerHandler.requested_pages = []
+    engine.delete("downloaded")
+    assert engine.fetch_layer(layer_url, "downloaded", field_map={"CITY": "CDTFA_CITY"})
+    assert StandInLayerHandler.requested_pages == []
+    assert list(engine.to_frame("downloaded")[0]["CDTFA_CITY"]) == [f"City {oid}" for oid in OBJECT_IDS]
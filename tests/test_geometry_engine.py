@@ -0,0 +1,133 @@
+import pandas
+import pytest
+
+shapely = pytest.importorskip("shapely")
+pytest.importorskip("pyproj")
+
+from bunnyhop import config, geometry_engine
+
+
+def square(x, y, size=10):
+    return shapely.box(x, y, x + size, y + size)
+
+
+@pytest.fixture
+def engine():
+    engine = geometry_engine.OpenEngine()
+    engine.from_frame("parcels",
+                      pandas.DataFrame({"CITY": ["Alpha", "Alpha", "Unincorporated", None], "COUNTY": ["One", "One", "One", "One"]}),
+                      [square(0, 0), square(10, 0), square(20, 0), square(30, 0)],
+                      crs=3310)
+    return engine
+
+
+def test_to_sql():
+    assert geometry_engine.to_sql(("CITY", "=", "O'Neill")) == "CITY = 'O''Neill'"
+    assert geometry_engine.to_sql(("AND", ("CITY", "IN", ["A", "B"]), (geometry_engine.AREA, ">", 1))) == "(CITY IN ('A','B')) AND (Shape_Area > 1)"
+    assert geometry_engine.to_sql(("CITY", "IN", [])) == "1=0"
+
+
+def test_select_skips_nulls(engine):
+    engine.select("parcels", "cities", ("CITY", "<>", "Unincorporated"))
+    attributes, geometry = engine.to_frame("cities")
+    assert list(attributes["CITY"]) == ["Alpha", "Alpha"]  # like SQL, the NULL city doesn't match
+    assert len(geometry) == 2
+
+
+def test_dissolve_and_join(engine):
+    engine.dissolve("parcels", "dissolved", ["CITY"])
+    engine.join_field("dissolved", "CITY", "parcels", "CITY", ["COUNTY"])
+    attributes, geometry = engine.to_frame("dissolved")
+
+    alpha = list(attributes["CITY"]).index("Alpha")
+    assert shapely.area(geometry[alpha]) == pytest.approx(200)
+    assert attributes["COUNTY"][alpha] == "One"
+
+
+def test_union_fills_in_blanks(engine):
+    engine.from_frame("coast", pandas.DataFrame({"OFFSHORE": ["Ocean"]}), [shapely.box(35, -5, 60, 15)], crs=3310)
+    engine.union(["parcels", "coast"], "unioned")
+    attributes, geometry = engine.to_frame("unioned")
+
+    assert "FID_parcels" in attributes.columns and "FID_coast" in attributes.columns
+    assert sum(shapely.area(geometry)) == pytest.approx(400 + 25 * 20 - 50)
+
+    only_coast = attributes[attributes["FID_parcels"] == -1]
+    assert list(only_coast["CITY"]) == [""]
+    assert set(attributes[attributes["FID_coast"] == -1]["OFFSHORE"]) == {""}
+
+
+def test_union_of_three(engine):
+    engine.from_frame("coast", pandas.DataFrame({"OFFSHORE": ["Ocean"], "CITY": ["Sea"]}), [shapely.box(35, -5, 60, 15)], crs=3310)
+    engine.from_frame("bay", pandas.DataFrame({"OFFSHORE": ["Bay"], "CITY": ["Harbor"]}), [shapely.box(0, 5, 40, 20)], crs=3310)
+    engine.union(["parcels", "coast", "bay"], "unioned")
+    attributes, geometry = engine.to_frame("unioned")
+
+    assert list(attributes.columns) == ["FID_parcels", "CITY", "COUNTY", "FID_coast", "OFFSHORE", "CITY_1", "FID_bay", "OFFSHORE_2", "CITY_2"]
+    assert sum(shapely.area(geometry)) == pytest.approx(shapely.area(shapely.union_all([shapely.box(0, 0, 40, 10), shapely.box(35, -5, 60, 15),
+                                                                                        shapely.box(0, 5, 40, 20)])))
+    everything = attributes[(attributes["FID_parcels"] != -1) & (attributes["FID_coast"] != -1) & (attributes["FID_bay"] != -1)]
+    assert list(everything["CITY_2"]) == ["Harbor"]
+    assert shapely.area(geometry[everything.index[0]]) == pytest.approx(25)  # x 35-40, y 5-10
+
+
+def test_erase_and_select_intersecting(engine):
+    engine.from_frame("cut", pandas.DataFrame({"ID": [1]}), [shapely.box(5, 0, 20, 10)], crs=3310)
+    engine.erase("parcels", "cut", "erased")
+    attributes, geometry = engine.to_frame("erased")
+    assert list(shapely.area(geometry)) == pytest.approx([50, 100, 100])  # the second square is erased entirely
+
+    count = engine.select_intersecting("parcels", "cut", "touching", "others", remainder_where=("CITY", "=", "Unincorporated"))
+    assert count == 3  # the third square shares an edge with the cut
+    assert list(engine.to_frame("others")[0]["CITY"]) == []
+
+
+def test_project_and_area(engine):
+    engine.project("parcels", "parcels_4326", 4326)
+    assert engine.spatial_reference_code("parcels_4326") == 4326
+
+    engine.calculate_fields("parcels_4326", [engine.area_field("AREA_SQ_METERS", 3310, "SQUARE_METERS")])
+    attributes, geometry = engine.to_frame("parcels_4326")
+    assert list(attributes["AREA_SQ_METERS"]) == pytest.approx([100, 100, 100, 100], rel=1e-6)
+
+
+def test_area_units(engine):
+    # the US survey units are a little bigger than the international ones, so they shouldn't come out the same
+    engine.calculate_fields("parcels", [engine.area_field("AREA_FT_INT", 3310, "SQUARE_FEET_INT"),
+                                        engine.area_field("AREA_FT_US", 3310, "SQUARE_FEET_US"),
+                                        engine.area_field("AREA_ACRES_US", 3310, "ACRES_US")])
+    attributes = engine.to_frame("parcels")[0]
+    assert attributes["AREA_FT_INT"][0] == pytest.approx(100 / 0.3048 ** 2)
+    assert attributes["AREA_FT_US"][0] == pytest.approx(100 / (1200 / 3937) ** 2)
+    assert attributes["AREA_ACRES_US"][0] == pytest.approx(attributes["AREA_FT_US"][0] / 43560)
+
+
+def test_spills_to_disk_over_budget(tmp_path):
+    engine = geometry_engine.OpenEngine(memory_budget_bytes=1, spill_folder=str(tmp_path))
+    engine.from_frame("first", pandas.DataFrame({"CITY": ["Alpha"]}), [square(0, 0)], crs=3310)
+    engine.from_frame("second", pandas.DataFrame({"CITY": ["Beta"]}), [square(10, 0)], crs=3310)
+
+    assert "first" in engine.spilled and engine.exists("first")
+    engine.merge(["first", "second"], "merged")  # reads first back in
+
+    attributes, geometry = engine.to_frame("merged")
+    assert list(attributes["CITY"]) == ["Alpha", "Beta"]
+    assert list(shapely.area(geometry)) == [100, 100]
+
+
+def test_get_engine_reads_config(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "GEOMETRY_ENGINE", "open")
+    monkeypatch.setattr(config, "WORKSPACE_TIERED", True)
+    monkeypatch.setattr(config, "WORKSPACE_MEMORY_BUDGET_BYTES", 1234)
+    monkeypatch.setattr(config, "FOLDER_WORKSPACE", tmp_path)
+
+    engine = geometry_engine.get_engine()
+    assert engine.name == "open"
+    assert engine.memory.budget_bytes == 1234
+
+
+def test_split(engine):
+    engine.split("parcels", "CITY", {"Alpha": "alpha", "Unincorporated": "unincorporated", "Nowhere": "nowhere"})
+    assert engine.count("alpha") == 2
+    assert list(engine.to_frame("unincorporated")[0]["CITY"]) == ["Unincorporated"]
+    assert engine.count("nowhere") == 0
@@ -0,0 +1,112 @@
+import concurrent.futures
+import gzip
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+from bunnyhop import http_client
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Fails the first few requests to /flaky, gzips /gzipped, and keeps track of how many requests to /slow overlap"""
+    failures_left = 0
+    requests_seen = 0
+    in_flight = 0
+    most_in_flight = 0
+    accept_encoding = None
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests_seen += 1
+        if self.path == "/flaky":
+            with cls.lock:
+                fail = cls.failures_left > 0
+                cls.failures_left -= 1
+            if fail:
+                self.send_error(503)
+                return
+            self._send(b'{"ok": true}')
+        elif self.path == "/gzipped":
+            cls.accept_encoding = self.headers.get("Accept-Encoding")
+            self._send(gzip.compress(b'{"ok": true}'), encoding="gzip")
+        elif self.path == "/slow":
+            with cls.lock:
+                cls.in_flight += 1
+                cls.most_in_flight = max(cls.most_in_flight, cls.in_flight)
+            time.sleep(0.05)
+            with cls.lock:
+                cls.in_flight -= 1
+            self._send(b'{"ok": true}')
+        else:
+            self.send_error(404)
+
+    def _send(self, data, encoding=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    StandInHandler.failures_left = 0
+    StandInHandler.requests_seen = 0
+    StandInHandler.most_in_flight = 0
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def client(**options):
+    return http_client.HttpClient(**dict({"retries": 3, "backoff": 0, "connect_timeout": 5, "read_timeout": 5}, **options))
+
+
+def test_retries_failed_requests(server_url):
+    StandInHandler.failures_left = 2
+    response = client().get(f"{server_url}/flaky")
+
+    assert response.json() == {"ok": True}
+    assert StandInHandler.requests_seen == 3
+
+
+def test_gives_up_after_retries(server_url):
+    StandInHandler.failures_left = 10
+    response = client(retries=1).get(f"{server_url}/flaky")
+
+    assert response.status_code == 503
+    assert StandInHandler.requests_seen == 2
+
+
+def test_gzip(server_url):
+    assert client().get(f"{server_url}/gzipped").json() == {"ok": True}
+    assert "gzip" in StandInHandler.accept_encoding
+
+
+def test_per_host_limit(server_url):
+    shared = client(max_connections_per_host=2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda index: shared.get(f"{server_url}/slow"), range(6)))
+
+    assert StandInHandler.most_in_flight == 2
+
+
+def test_stream_releases_its_slot(server_url):
+    shared = client(max_connections_per_host=1)
+    with shared.stream(f"{server_url}/flaky") as response:
+        assert b"".join(response.iter_content(chunk_size=4)) == b'{"ok": true}'
+
+    assert shared.get(f"{server_url}/flaky").status_code == 200  # would block forever if the slot was still taken
@@ -0,0 +1,28 @@
+from bunnyhop import memory_tier
+
+
+def test_spills_least_recently_used():
+    sizes = {"a": 40, "b": 40, "c": 40}
+    spilled = []
+    tier = memory_tier.MemoryTier(100, measure=sizes.get, spill=spilled.append)
+
+    tier.track("a")
+    tier.track("b")
+    tier.touch("a")  # b is now the least recently used
+    tier.track("c")
+
+    assert spilled == ["b"]
+    assert "a" in tier and "c" in tier and "b" not in tier
+    assert tier.total_bytes == 80
+
+
+def test_keeps_the_newest_dataset_even_over_budget():
+    spilled = []
+    tier = memory_tier.MemoryTier(100, measure=lambda name: 500, spill=spilled.append)
+
+    tier.track("big")
+    assert spilled == []
+
+    tier.track("bigger")
+    assert spilled == ["big"]
+    assert "bigger" in tier
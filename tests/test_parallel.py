@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+
+from bunnyhop import parallel
+
+
+# workers are spawned, so the functions they run have to be importable at the top level of a module
+def square_after(value, delay):
+    time.sleep(delay)
+    return value * value
+
+
+def fail_on(value, bad_value):
+    if value == bad_value:
+        raise ValueError(f"bad value {value}")
+    return value
+
+
+def test_map_in_processes_keeps_argument_order():
+    # the first arguments finish last, so the results have to be put back in order
+    arguments = [(value, (3 - value) * 0.1) for value in range(4)]
+    assert parallel.map_in_processes(square_after, arguments, max_workers=4) == [0, 1, 4, 9]
+
+
+def test_map_in_processes_raises_worker_errors():
+    with pytest.raises(ValueError, match="bad value 2"):
+        parallel.map_in_processes(fail_on, [(value, 2) for value in range(4)], max_workers=2)
+
+
+def running_times(delay):
+    started = time.time()
+    time.sleep(delay)
+    return started, time.time()
+
+
+def test_run_graph_waits_for_dependencies():
+    tasks = {
+        "squared": parallel.Task(square_after, (3, 0.5)),
+        "squared_again": parallel.Task(square_after, (parallel.Result("squared"), 0)),
+        "slow": parallel.Task(running_times, (0.5,)),
+        "after_slow": parallel.Task(running_times, (0,), depends_on=["slow"]),
+        "independent": parallel.Task(running_times, (0,)),
+    }
+    results = parallel.run_graph(tasks, max_workers=3)
+
+    assert results["squared"] == 9
+    assert results["squared_again"] == 81
+    assert results["after_slow"][0] >= results["slow"][1]
+    assert results["independent"][0] < results["slow"][1]  # it didn't have to wait for anything
+
+
+def test_run_graph_finds_cycles():
+    tasks = {
+        "first": parallel.Task(square_after, (1, 0)),
+        "second": parallel.Task(square_after, (parallel.Result("third"), 0), depends_on=["first"]),
+        "third": parallel.Task(square_after, (parallel.Result("second"), 0)),
+    }
+    with pytest.raises(ValueError, match="circular dependencies: second, third"):
+        parallel.run_graph(tasks, max_workers=2)
+
+
+def test_run_graph_missing_dependency():
+    tasks = {"first": parallel.Task(square_after, (parallel.Result("zeroth"), 0), depends_on=["setup"])}
+    with pytest.raises(ValueError, match="depends on tasks that don't exist: setup, zeroth"):
+        parallel.run_graph(tasks)
+
+
+def test_scratch_workspaces(tmp_path):
+    arcpy = pytest.importorskip("arcpy")
+    folder = str(tmp_path / "partitions")
+
+    gdb_path = parallel.create_scratch_geodatabase(folder, "county_0")
+    assert gdb_path == os.path.join(folder, "county_0.gdb")
+
+    # a worker picks up the geodatabase its parent made and writes into it
+    assert parallel.create_scratch_workspace(folder, "county_0") == gdb_path
+    assert arcpy.env.workspace == gdb_path
+    assert arcpy.env.scratchWorkspace == gdb_path
@@ -1,13 +1,84 @@
+import os
+
+import pandas
 from pandas import DataFrame
 import pytest
 
 
-from bunnyhop import retrieve, bunny
+from bunnyhop import bunny, rule_engine
+
+INPUTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "inputs")
+
+
+def test_gnis_processing(tmp_path):
+    arcpy = pytest.importorskip("arcpy")
+    from bunnyhop import parallel
+
+    parallel.create_scratch_workspace(str(tmp_path), "gnis")
+    gnis_csv = tmp_path / "gnis_raw_input_data.csv"
+    gnis_df = pandas.read_csv(os.path.join(INPUTS_FOLDER, "FederalCodes_CA.txt"), sep="|")
+    gnis_df.to_csv(gnis_csv, index=False)
+
+    gnis_table = bunny.process_gnis(str(gnis_csv))
+
+    assert int(arcpy.management.GetCount(gnis_table)[0]) == len(bunny.process_gnis_frame(gnis_df))
+
+
+def test_gnis_frame_processing():
+    gnis_df = pandas.read_csv(os.path.join(INPUTS_FOLDER, "FederalCodes_CA.txt"), sep="|")
+    gnis = bunny.process_gnis_frame(gnis_df)
+
+    assert set(gnis["state_name"]) == {"California"}
+    assert set(gnis["census_class_code"]) == {"C1", "H1"}
+
+    names = gnis.set_index("GNIS_PLACE_NAME")["GNIS_JOIN_NAME"]
+    assert names["City of Alameda"] == "Alameda"
+    assert names["Alameda County"] == "Alameda County"
+    assert names["City of San Buenaventura"] == "Ventura"  # from the hard-coded adjustments
+    assert (gnis["GNIS_ID"] == gnis["feature_id"]).all()
+
+
+def test_census_frame_processing():
+    census_df = pandas.read_excel(os.path.join(INPUTS_FOLDER, "all-geocodes-v2022.xlsx"), dtype=str)
+    census_df.rename(columns={value: value.replace(" ", "_") for value in census_df.columns}, inplace=True)
+    california = census_df.loc[census_df["State_FIPS_Code"] == "06"]
+
+    census = bunny.process_census_frame(california).set_index("Area_Name")
+
+    assert census.loc["Alameda County", "CENSUS_PLACE_TYPE"] == "County"
+    assert census.loc["Alameda County", "CENSUS_PLACE_NAME"] == "Alameda County"
+    assert census.loc["Alameda County", "CENSUS_GEOID"] == "06001"
+    assert census.loc["Berkeley city", "CENSUS_PLACE_TYPE"] == "City"
+    assert census.loc["Berkeley city", "CENSUS_PLACE_NAME"] == "Berkeley"
+    assert census.loc["Berkeley city", "CENSUS_GEOID"] == "0606000"
+
+
+def test_adjustment_rules_on_frame():
+    rules = rule_engine.AdjustmentRules.compile(
+        conditional=[{"where": {"place_name": "Angel's Camp"}, "field": {"place_name": "Angels Camp", "place_abbr": "AGC"}}],
+        replacements=[{"county": {"Angels County": "Calaveras County"}}],
+    )
+    df = DataFrame({"place_name": ["Angel's Camp", "Lodi"], "place_abbr": [None, "LOD"], "county": ["Angels County", "San Joaquin County"]})
+    rules.apply_to_frame(df)
+
+    assert list(df["place_name"]) == ["Angels Camp", "Lodi"]  # the quote in the value doesn't need escaping
+    assert list(df["place_abbr"]) == ["AGC", "LOD"]
+    assert list(df["county"]) == ["Calaveras County", "San Joaquin County"]
+    assert rules.updates_for({"place_name": "Lodi"}) == {}
+
+
+def test_run_joins_leaves_its_inputs_alone():
+    pytest.importorskip("shapely")
+    pytest.importorskip("pyproj")
+    harness = pytest.importorskip("benchmarks.harness")
+
+    bench = harness.Workbench("open", 0.1)
+    cities, counties = bench.pathways()
+    fields = bench.engine.field_names(cities)
+    joined_cities = bench.engine.to_frame(bench.joined()[0])[0]
+    assert bench.engine.field_names(cities) == fields
 
-def test_gnis_processing():
-    folder, gdb = bunny.create_workspace()
-    print(folder)
-    gnis_data: DataFrame = retrieve.retrieve_gnis(output_folder=folder)
-    print("retrieved")
-    bunny.process_gnis(str(gnis_data['csv']))
-    print("processed")
+    runner = bench.runner()  # a resumed run can run the joins again on the same inputs
+    runner.cities_output_path, runner.counties_output_path = cities, counties
+    runner.run_joins()
+    pandas.testing.assert_frame_equal(bench.engine.to_frame(runner.cities_output_path)[0], joined_cities)
@@ -0,0 +1,92 @@
+import json
+import types
+
+import pytest
+
+from bunnyhop import profiling
+
+
+class FakeEngine:
+
+    def count(self, dataset):
+        return {"parcels": 3, "dissolved": 1}[dataset]
+
+    def vertex_count(self, dataset):
+        return {"parcels": 15, "dissolved": 8}[dataset]
+
+
+class Runner:
+
+    def __init__(self):
+        self.engine = FakeEngine()
+        self.input_path = "parcels"
+        self.output_path = None
+
+    @profiling.profiled(inputs=("input_path",), outputs=("output_path",))
+    def dissolve(self):
+        with profiling.profile("inner"):
+            pass
+        self.output_path = "dissolved"
+
+
+@pytest.fixture(autouse=True)
+def fresh_report():
+    profiling.reset()
+    yield
+    profiling.reset()
+
+
+def test_nested_sections_and_counts(monkeypatch):
+    monkeypatch.setattr(profiling.config, "PROFILE_COUNT_VERTICES", True)
+    Runner().dissolve()
+
+    report = profiling.report()
+    section = report["sections"][0]
+    assert section["name"] == "Runner.dissolve"
+    assert section["wall_seconds"] >= section["children"][0]["wall_seconds"]
+    assert section["children"][0]["name"] == "inner"
+    assert section["inputs"] == {"input_path": {"features": 3, "vertices": 15}}
+    assert section["outputs"] == {"output_path": {"features": 1, "vertices": 8}}
+    assert [total["name"] for total in report["summary"]] == ["Runner.dissolve", "inner"]
+
+
+def test_vertex_counts_are_opt_in():
+    Runner().dissolve()
+
+    assert profiling.report()["sections"][0]["inputs"] == {"input_path": {"features": 3, "vertices": None}}
+
+
+def test_records_errors():
+    with pytest.raises(ValueError):
+        with profiling.profile("failing"):
+            raise ValueError("bad geometry")
+
+    assert profiling.report()["sections"][0]["error"] == "ValueError: bad geometry"
+
+
+def test_counting_never_fails():
+    broken = types.SimpleNamespace(count=lambda dataset: 1 / 0)
+    assert profiling.count_dataset(broken, "parcels") == {"features": None, "vertices": None}
+
+
+def test_adopts_worker_sections(tmp_path):
+    with profiling.profile("worker task"):
+        profiling.record_output("rows", features=10)
+    sections = profiling.worker_sections()  # what a worker process sends back
+    assert profiling.report()["sections"] == []
+
+    with profiling.profile("parent"):
+        profiling.adopt(sections)
+
+    path = tmp_path / "run_report.json"
+    profiling.write_report(path)
+    with open(path) as report_file:
+        report = json.load(report_file)
+    child = report["sections"][0]["children"][0]
+    assert child["name"] == "worker task" and child["outputs"]["rows"]["features"] == 10
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(profiling.config, "PROFILE_ENABLED", False)
+    Runner().dissolve()
+    assert profiling.report()["sections"] == []
@@ -1,10 +1,196 @@
+import functools
+import http.server
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
 import pandas
 
 from bunnyhop import config
 import bunnyhop
 import pytest
 
+INPUTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "inputs")
+
+
+def test_retrieve_gnis(local_server, monkeypatch):
+    monkeypatch.setattr(config, "DOWNLOAD_CACHE_ENABLED", False)
+    folder, url = local_server
+    with zipfile.ZipFile(folder / "FedCodes_CA_Text.zip", "w") as zipf:
+        zipf.write(os.path.join(INPUTS_FOLDER, "FederalCodes_CA.txt"), arcname=config.GNIS_ZIP_FILE_PATH)
+    output_folder = folder / "output"
+    output_folder.mkdir()
+
+    gnis_data = bunnyhop.retrieve.retrieve_gnis(source=f"{url}/FedCodes_CA_Text.zip", output_folder=output_folder)
+
+    assert isinstance(gnis_data['df'], pandas.DataFrame)
+    assert gnis_data['csv'] == output_folder / "gnis_raw_input_data.csv"
+    assert len(pandas.read_csv(gnis_data['csv'])) == len(gnis_data['df'])
+
+
+@pytest.fixture
+def local_server(tmp_path):
+    """Serves files out of tmp_path over HTTP so retrieval can be tested without hitting the real sources"""
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield tmp_path, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_retrieve_gnis_streaming(local_server, monkeypatch):
+    monkeypatch.setattr(config, "DOWNLOAD_CACHE_ENABLED", False)
+    folder, url = local_server
+    with zipfile.ZipFile(folder / "FedCodes_CA_Text.zip", "w") as zipf:
+        zipf.write(os.path.join(INPUTS_FOLDER, "FederalCodes_CA.txt"), arcname=config.GNIS_ZIP_FILE_PATH)
+
+    gnis_data = bunnyhop.retrieve.retrieve_gnis(source=f"{url}/FedCodes_CA_Text.zip")
+
+    assert gnis_data['csv'] is None
+    assert list(gnis_data['df'].columns) == list(config.GNIS_COLUMNS.keys())
+    assert len(gnis_data['df']) == 6965
+
+
+def test_download_cache_revalidates(local_server):
+    folder, url = local_server
+    (folder / "source.txt").write_text("first version")
+    cache = bunnyhop.download_cache.DownloadCache(folder=folder / "cache")
+
+    first_path = cache.fetch(f"{url}/source.txt")
+    assert first_path.read_text() == "first version"
+    assert cache.index["files"][f"{url}/source.txt"]["last_modified"] is not None
+
+    # nothing changed upstream, so we should get a 304 and the same cached object back
+    assert cache.fetch(f"{url}/source.txt") == first_path
+
+    (folder / "source.txt").write_text("second version")
+    os.utime(folder / "source.txt", (os.path.getmtime(folder / "source.txt") + 10,) * 2)  # make sure Last-Modified moves forward
+    second_path = cache.fetch(f"{url}/source.txt")
+    assert second_path.read_text() == "second version"
+    assert not first_path.exists()  # nothing references the old content anymore
+
+
+def test_download_cache_open(local_server):
+    folder, url = local_server
+    (folder / "source.txt").write_text("contents")
+    cache = bunnyhop.download_cache.DownloadCache(folder=folder / "cache")
+
+    with cache.open(f"{url}/source.txt") as downloaded:  # a miss is read from the spooled copy, and stored in the cache too
+        assert downloaded.read() == b"contents"
+        assert isinstance(downloaded, tempfile.SpooledTemporaryFile)
+    assert cache.fetch(f"{url}/source.txt").read_text() == "contents"
+
+    with cache.open(f"{url}/source.txt") as cached:  # a hit is read from the cache
+        assert cached.read() == b"contents"
+        assert cached.name == str(cache.fetch(f"{url}/source.txt"))
+
+
+def test_download_cache_eviction(local_server):
+    folder, url = local_server
+    for name in ("one.txt", "two.txt"):
+        (folder / name).write_text(name * 20)
+    cache = bunnyhop.download_cache.DownloadCache(folder=folder / "cache", max_bytes=250)
+
+    cache.fetch(f"{url}/one.txt")
+    cache.fetch(f"{url}/two.txt")
+
+    assert list(cache.index["files"].keys()) == [f"{url}/two.txt"]
+
+
+def test_download_cache_counts_shared_content_once(local_server):
+    folder, url = local_server
+    for name in ("one.txt", "two.txt"):
+        (folder / name).write_text("x" * 100)
+    cache = bunnyhop.download_cache.DownloadCache(folder=folder / "cache", max_bytes=150)
+
+    cache.fetch(f"{url}/one.txt")
+    cache.fetch(f"{url}/two.txt")
+
+    assert list(cache.index["files"].keys()) == [f"{url}/one.txt", f"{url}/two.txt"]
+
+
+def test_download_cache_cleans_up_downloads(local_server):
+    folder, url = local_server
+    (folder / "source.txt").write_text("contents")
+    cache = bunnyhop.download_cache.DownloadCache(folder=folder / "cache")
+    stale = cache.objects_folder / "download_interrupted"
+    stale.write_text("partial")
+    os.utime(stale, (time.time() - 2 * bunnyhop.download_cache.STALE_DOWNLOAD_SECONDS,) * 2)
+    in_progress = cache.objects_folder / "download_in_progress"
+    in_progress.write_text("partial")
+
+    class BrokenCopy:
+        def write(self, chunk):
+            raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        cache._fetch(f"{url}/source.txt", copy_to=BrokenCopy())
+    assert sorted(path.name for path in cache.objects_folder.iterdir()) == ["download_in_progress", "download_interrupted"]
+
+    cache.fetch(f"{url}/source.txt")
+    assert not stale.exists()
+    assert in_progress.exists()
+
+
+class NotModifiedHandler(http.server.BaseHTTPRequestHandler):
+    """Answers 304 Not Modified to conditional requests (or to every request, with always set), and serves "fresh" otherwise"""
+    always = False
+    remove_on_request = None  # a file to delete as each request comes in
+
+    def do_GET(self):
+        if self.remove_on_request is not None:
+            self.remove_on_request.unlink(missing_ok=True)
+        if self.always or self.headers.get("If-None-Match"):
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"fresh")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def not_modified_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), NotModifiedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield NotModifiedHandler, f"http://127.0.0.1:{server.server_address[1]}/source.txt"
+    server.shutdown()
+    server.server_close()
+    NotModifiedHandler.always = False
+    NotModifiedHandler.remove_on_request = None
+
+
+def test_download_cache_not_modified_without_validators(not_modified_server, tmp_path):
+    handler, url = not_modified_server
+    handler.always = True
+    cache = bunnyhop.download_cache.DownloadCache(folder=tmp_path / "cache")
+
+    with pytest.raises(RuntimeError, match="without validators"):
+        cache.fetch(url)
+
+
+def test_download_cache_not_modified_copy_removed(not_modified_server, tmp_path):
+    handler, url = not_modified_server
+    cache = bunnyhop.download_cache.DownloadCache(folder=tmp_path / "cache")
+    cache.index["files"][url] = {"sha256": "removed", "size": 5, "etag": '"1"', "last_modified": None, "last_used": time.time()}
+    (cache.objects_folder / "removed").write_text("stale")
+    handler.remove_on_request = cache.objects_folder / "removed"  # gone between checking for it and the 304
+
+    assert cache.fetch(url).read_text() == "fresh"
+
+
+def test_read_census_workbook():
+    california = bunnyhop.retrieve._read_census_workbook(os.path.join(INPUTS_FOLDER, "all-geocodes-v2022.xlsx"), state_fips="06")
 
-def test_retrieve_gnis():
-    df = bunnyhop.retrieve.gnis_retrieve(config.GNIS_URL)
-    assert(isinstance(df, pandas.DataFrame))
\ No newline at end of file
+    assert len(california) == 541
+    assert set(california["State FIPS Code"]) == {"06"}
+    assert california.loc[california["Area Name"] == "Alameda County", "County FIPS Code"].item() == "001"
@@ -0,0 +1,25 @@
+import random
+
+from bunnyhop import spatial_index
+
+
+def test_str_tree_matches_brute_force():
+    generator = random.Random(42)
+    envelopes = []
+    for _ in range(500):
+        x, y = generator.uniform(0, 1000), generator.uniform(0, 1000)
+        envelopes.append((x, y, x + generator.uniform(0, 20), y + generator.uniform(0, 20)))
+    tree = spatial_index.STRTree(envelopes)
+
+    for _ in range(100):
+        x, y = generator.uniform(0, 1000), generator.uniform(0, 1000)
+        query = (x, y, x + 50, y + 50)
+        expected = [index for index, envelope in enumerate(envelopes) if spatial_index.intersects(envelope, query)]
+        assert tree.query(query) == expected
+
+
+def test_str_tree_edges_count_as_intersecting():
+    tree = spatial_index.STRTree([(0, 0, 1, 1), (2, 2, 3, 3)])
+    assert tree.query((1, 1, 2, 2)) == [0, 1]  # shares a corner with both
+    assert tree.query((1.5, 0, 1.75, 1)) == []
+    assert spatial_index.STRTree([]).query((0, 0, 1, 1)) == []
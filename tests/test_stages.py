@@ -0,0 +1,96 @@
+import types
+
+from bunnyhop import stages
+
+
+class FakeEngine:
+
+    def __init__(self):
+        self.existing = set()
+
+    def on_disk(self, dataset):
+        self.existing.add(dataset)
+        return dataset
+
+    def exists(self, dataset):
+        return dataset in self.existing
+
+
+def pipeline(state, calls, settings):
+    def first():
+        calls.append("first")
+        state.first_output = "first_dataset"
+
+    def second():
+        calls.append("second")
+        state.second_output = f"{state.first_output}_joined"
+
+    return [
+        stages.Stage("first", first, outputs=("first_output",), datasets=("first_output",), settings=lambda: settings),
+        stages.Stage("second", second, inputs=("first_output",), outputs=("second_output",), datasets=("second_output",)),
+    ]
+
+
+def run(tmp_path, engine, settings, resume):
+    state = types.SimpleNamespace()
+    calls = []
+    stages.StageRunner(state, engine, manifest_path=str(tmp_path / "manifest.json")).run(pipeline(state, calls, settings), resume=resume)
+    return state, calls
+
+
+def test_resume_skips_finished_stages(tmp_path):
+    engine = FakeEngine()
+    run(tmp_path, engine, {"threshold": 1}, resume=False)
+
+    state, calls = run(tmp_path, engine, {"threshold": 1}, resume=True)
+    assert calls == []
+    assert state.second_output == "first_dataset_joined"  # restored from the manifest
+
+
+def test_changed_settings_rerun_downstream_stages(tmp_path):
+    engine = FakeEngine()
+    run(tmp_path, engine, {"threshold": 1}, resume=False)
+
+    state, calls = run(tmp_path, engine, {"threshold": 2}, resume=True)
+    assert calls == ["first", "second"]
+
+
+def test_missing_output_reruns_stage(tmp_path):
+    engine = FakeEngine()
+    run(tmp_path, engine, {"threshold": 1}, resume=False)
+    engine.existing.discard("first_dataset_joined")
+
+    state, calls = run(tmp_path, engine, {"threshold": 1}, resume=True)
+    assert calls == ["second"]
+
+
+def test_without_resume_everything_runs(tmp_path):
+    engine = FakeEngine()
+    run(tmp_path, engine, {"threshold": 1}, resume=False)
+
+    state, calls = run(tmp_path, engine, {"threshold": 1}, resume=False)
+    assert calls == ["first", "second"]
+
+
+def test_new_run_only_clears_its_own_workspace_files(tmp_path, monkeypatch):
+    from bunnyhop import config
+    monkeypatch.setattr(config, "STAGE_WORKSPACE_FOLDER", tmp_path)
+    monkeypatch.setattr(config, "arcpy", None)
+    (tmp_path / config.STAGE_WORKSPACE_GDB_NAME).mkdir()
+    (tmp_path / config.STAGE_MANIFEST_NAME).write_text("{}")
+    (tmp_path / "notes.txt").write_text("not ours")
+    for folder in config.STAGE_SCRATCH_FOLDER_NAMES + (f"{config.CDTFA_CHECKPOINT_NAME}.pages",):
+        (tmp_path / folder).mkdir()
+    (tmp_path / config.CDTFA_CHECKPOINT_NAME).write_text("{}")
+
+    config.create_workspace(resume=True)
+    assert (tmp_path / config.STAGE_MANIFEST_NAME).exists()
+    assert (tmp_path / config.CDTFA_CHECKPOINT_NAME).exists()
+
+    config.create_workspace(resume=False)
+    assert not (tmp_path / config.STAGE_WORKSPACE_GDB_NAME).exists()
+    assert not (tmp_path / config.STAGE_MANIFEST_NAME).exists()
+    assert not any((tmp_path / folder).exists() for folder in config.STAGE_SCRATCH_FOLDER_NAMES)
+    assert not (tmp_path / config.CDTFA_CHECKPOINT_NAME).exists()
+    assert not (tmp_path / f"{config.CDTFA_CHECKPOINT_NAME}.pages").exists()
+    assert (tmp_path / "notes.txt").read_text() == "not ours"
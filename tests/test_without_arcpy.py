@@ -0,0 +1,42 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("shapely")
+pytest.importorskip("pyproj")
+
+# runs in a fresh interpreter, since this one may already have imported bunnyhop with arcpy
+SCRIPT = """
+import sys
+sys.modules["arcpy"] = None  # import arcpy raises ImportError, even on a machine with ArcGIS
+
+import pandas
+import shapely
+
+import bunnyhop
+from bunnyhop import geometry_engine
+
+engine = geometry_engine.get_engine("open")
+engine.from_frame("parcels", pandas.DataFrame({"CITY": ["Alpha", "Alpha", "Beta"]}),
+                  [shapely.box(0, 0, 10, 10), shapely.box(10, 0, 20, 10), shapely.box(20, 0, 30, 10)], crs=3310)
+engine.from_frame("places", pandas.DataFrame({"NAME": ["Alpha", "Beta"], "GEOID": ["0601", "0602"]}))
+engine.from_frame("coast", pandas.DataFrame({"OFFSHORE": ["ocean"]}), [shapely.box(25, -10, 40, 20)], crs=3310)
+
+engine.dissolve("parcels", "cities", ["CITY"])
+engine.join_field("cities", "CITY", "places", "NAME", ["GEOID"])
+engine.union(["cities", "coast"], "cut")
+
+attributes, geometry = engine.to_frame("cut")
+rows = sorted(zip(attributes["CITY"], attributes["GEOID"], attributes["OFFSHORE"], shapely.area(geometry)))
+assert rows == [("", "", "ocean", 400.0), ("Alpha", "0601", "", 200.0), ("Beta", "0602", "", 50.0), ("Beta", "0602", "ocean", 50.0)], rows
+"""
+
+
+def test_open_engine_runs_without_arcpy():
+    package_folder = os.path.dirname(os.path.dirname(importlib.util.find_spec("bunnyhop").origin))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([package_folder, os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-c", SCRIPT], capture_output=True, text=True, env=environment)
+    assert result.returncode == 0, result.stderr